@@ -14,6 +14,7 @@ if __name__ == "__main__":
     data_folder, start_date, end_date, data_sources, databricks_secret_scope = parse_shared_config(config)
 
     store_intermediate_data = config.get("data_pipeline", {}).get("store_intermediate_data", False)
+    near_duplicates = config.get("data_pipeline", {}).get("near_duplicates")
 
     # access ACLED email and keys from Databricks secret for databricks implementation if provided
     acled_email = None
@@ -29,5 +30,5 @@ if __name__ == "__main__":
     data_pipeline.verify_args(data_folder, start_date, end_date, data_sources, acled_email, acled_key)
 
     logger.info(f"Pulling data from {data_sources} from {start_date} to {end_date}. Output data will be stored in {data_folder}.")
-    data_pipeline.run_data_pipeline(data_sources, start_date, end_date, data_folder, store_intermediate_data, acled_email, acled_key)
+    data_pipeline.run_data_pipeline(data_sources, start_date, end_date, data_folder, store_intermediate_data, acled_email, acled_key, near_duplicates)
 
@@ -1,19 +1,34 @@
 import argparse
-import json
+import collections
+import functools
 import os
+import queue
+import threading
+import time
 import pandas as pd
 import numpy as np
 from src.db_utils import load_config, parse_args, parse_shared_config, configure_default_logger
-from src.utils.utils import load_data
+from src.utils.utils import load_data_cached, to_csv_atomic
+from src.utils.checkpoint import get_prediction_checkpoint
+from src.utils.llm_backends import DEFAULT_API_KEY_SECRETS, backend_api_key, get_llm_backend
+from src.utils.llm_metrics import get_hedge_report, get_llm_usage_report, get_truncation_report
+from src.utils.llm_telemetry import get_llm_telemetry
+from src.utils.prediction_ledger import config_fingerprint, event_answer_sources, event_content_hash, event_predictions, get_prediction_ledger, ledger_run_report, merge_predictions
+from src.utils.prompt_compiler import get_prompt_compiler
+from src.classification_pipeline.cascade_classifier import get_cascade_classifier
+from src.classification_pipeline.rule_engine import get_rule_engine
+from src.classification_pipeline.spark_classification import get_spark_session, partition_checkpoint_paths, run_spark_classification, spark_task_slots, stage_config_slice
 from src.classification_pipeline.event_relevance_classification import predict_event_relevance
-from src.classification_pipeline.event_type_classification import predict_event_type
+from src.classification_pipeline.event_type_classification import EVENT_TYPE_LABELS, predict_event_type
 
 # Configure logging
 logger = configure_default_logger()
 
-def load_secrets(databricks_secret_scope):
+def load_secrets(databricks_secret_scope, llm_backends=None):
     secret_dict = {}
     potential_secrets_keys = ["openai_api_key", "mistralai_api_key"]
+    # Api keys of the configured backends stored as secrets
+    potential_secrets_keys += [backend["api_key_secret"] for backend in (llm_backends or {}).values() if backend.get("api_key_secret")]
     if databricks_secret_scope in [scope.name for scope in dbutils.secrets.listScopes()]:
         secrets = dbutils.secrets.list(databricks_secret_scope)
         existing_secret_keys = [secret.key for secret in secrets]
@@ -26,60 +41,259 @@ def load_secrets(databricks_secret_scope):
     return secret_dict
 
 
-def valid_model_configs(llm, few_shot_num, train_example_path, secret_dict, output_folder):
+def valid_model_configs(llm, few_shot_num, train_example_path, secret_dict, output_folder, offline=False, llm_backends=None):
     if few_shot_num > 0 and not train_example_path:
         raise ValueError("train_example_path must be provided if few_shot_num > 0")
     
-    if llm == "gpt4" and "openai_api_key" not in secret_dict:
-        raise ValueError("openai_api_key must be provided in secret_dict for gpt4 model")
-    elif llm == "mistral" and "mistralai_api_key" not in secret_dict:
-        raise ValueError(f"mistralai_api_key must be provided in secret_dict for mistral model")
+    backend = get_llm_backend(llm, llm_backends)
+    if offline:
+        # Replayed runs do not call the LLM, no api key is needed
+        pass
+    elif backend["provider"] in ["openai", "mistral"] and not backend_api_key(backend, secret_dict):
+        secret_key = backend.get("api_key_secret", DEFAULT_API_KEY_SECRETS[backend["provider"]])
+        raise ValueError(f"{secret_key} must be provided in secret_dict for {llm} model")
     
     if not output_folder:
         raise ValueError("output_folder must be provided")
 
 
-def run_event_relevance_classification(df_test, secret_dict, llm, max_tokens=512, temperature=0, few_shot_num=0, train_example_path=None, mistralai_rps=0):
-    # load train data
-    if train_example_path:
-        df_train, _, _ = load_data(train_example_path)
-    else:
-        df_train = pd.DataFrame()
-    # run event relevance model
-    event_relevance_args = argparse.Namespace(
-        llm_name=llm,
-        max_tokens=max_tokens,
-        temperature=temperature,
-        few_shot_num=few_shot_num,
+# Settings of the classification stages, read from their config with these defaults, see config/model_config.yaml
+STAGE_CONFIG_DEFAULTS = {
+    "llm_name": None,
+    "few_shot_num": 0,
+    "train_example_path": None,
+    "max_tokens": 512,
+    "temperature": 0,
+    "top_p": None,
+    "mistralai_rps": 0,
+    "execution_mode": "sequential",
+    "max_concurrency": 8,
+    "batch_poll_interval": 60,
+    "pack_size": 1,
+    "pack_max_tokens": 0,
+    "request_timeout": 180,
+    "prompt_layout": "original",
+    "few_shot_format": "full",
+    "max_description_tokens": 0,
+    "answer_mode": "reason",
+    "answer_max_tokens": 16,
+    "answer_audit_fraction": 0,
+    "score_threshold": 0.5,
+}
+EVENT_RELEVANCE_CONFIG_DEFAULTS = {**STAGE_CONFIG_DEFAULTS, "cascade": None}
+EVENT_TYPE_CONFIG_DEFAULTS = {**STAGE_CONFIG_DEFAULTS, "type_prompt_mode": "per_label"}
+
+
+def load_hedging_config(stage_config, rate_limits):
+    """
+    Hedging config of a stage, with the rate limit of its alternate LLM. None if the stage is not hedged.
+    """
+    hedging_config = stage_config.get("hedging")
+    if not hedging_config:
+        return None
+    hedging_config = dict(hedging_config)
+    if hedging_config.get("alternate_llm_name"):
+        hedging_config["rate_limit"] = rate_limits.get(hedging_config["alternate_llm_name"])
+    return hedging_config
+
+
+def load_stage_config(stage_config, defaults, rate_limits):
+    """
+    Settings of a classification stage: the settings of `defaults` read from the config of the stage, the rate limit
+    of its LLM and its hedging config.
+    """
+    settings = {key: stage_config.get(key, default) for key, default in defaults.items()}
+    settings["rate_limit"] = rate_limits.get(settings["llm_name"])
+    settings["hedging"] = load_hedging_config(stage_config, rate_limits)
+    return settings
+
+
+def stage_args(stage_config, run_config):
+    """
+    Arguments of a classification stage: the settings of the stage (see load_stage_config) and those shared by the
+    stages of the run (secret_dict, llm_backends, llm_cache, llm_cassette, retry, circuit_breaker, http_pool,
+    batch_state_dir, checkpoint_path, rules_path).
+    """
+    secret_dict = run_config["secret_dict"]
+    run_settings = {key: value for key, value in run_config.items() if key != "secret_dict"}
+    return argparse.Namespace(
+        **stage_config,
+        **run_settings,
         openai_api_key=secret_dict.get("openai_api_key"),
         mistralai_api_key=secret_dict.get("mistralai_api_key"),
-        mistralai_rps=mistralai_rps,
+        api_keys=secret_dict,
     )
-    _, event_relevance_prediction = predict_event_relevance(event_relevance_args, df_train, df_test)
 
-    return event_relevance_prediction
-    
-def run_event_type_classification(df_test, secret_dict, llm, max_tokens=512, temperature=0, few_shot_num=0, train_example_path=None, mistralai_rps=0):
-    # load train data
+
+def load_train_data(train_example_path):
     if train_example_path:
-        df_train, _, _ = load_data(train_example_path)
+        df_train, _, _ = load_data_cached(train_example_path)
     else:
         df_train = pd.DataFrame()
+    return df_train
 
-    # run event type model
-    event_type_args = argparse.Namespace(
-        llm_name=llm,
-        max_tokens=max_tokens,
-        temperature=temperature,
-        few_shot_num=few_shot_num,
-        openai_api_key=secret_dict.get("openai_api_key"),
-        mistralai_api_key=secret_dict.get("mistralai_api_key"),
-        mistralai_rps=mistralai_rps,
-    )
+
+def run_event_relevance_classification(df_test, stage_config, run_config):
+    # load train data
+    df_train = load_train_data(stage_config["train_example_path"])
+    # run event relevance model
+    event_relevance_args = stage_args(stage_config, run_config)
+    _, event_relevance_prediction, event_relevance_scores = predict_event_relevance(event_relevance_args, df_train, df_test, return_scores=True)
+
+    return event_relevance_prediction, event_relevance_scores
     
-    _, event_type_prediction = predict_event_type(event_type_args, df_train, df_test)
+def run_event_type_classification(df_test, stage_config, run_config):
+    # load train data
+    df_train = load_train_data(stage_config["train_example_path"])
+
+    # run event type model
+    event_type_args = stage_args(stage_config, run_config)
+    _, event_type_prediction, event_type_scores = predict_event_type(event_type_args, df_train, df_test, return_scores=True)
+
+    return event_type_prediction, event_type_scores
+
+
+def add_prediction_columns(df, event_relevance_prediction, event_relevance_scores, relevant_index, event_type_prediction, event_type_scores, event_relevance_answer_mode="reason", event_type_answer_mode="reason"):
+    """
+    Add the prediction columns of both stages to `df`: the predictions and scores of the event relevance, and those of
+    the event type for the relevant events (`relevant_index`).
+    """
+    df["event_relevance_prediction"] = event_relevance_prediction
+    if event_relevance_answer_mode == "score":
+        df["event_relevance_score"] = event_relevance_scores
+    # The predictions are sets of event types, NaN for the events which are not relevant
+    df["event_type_prediction"] = pd.Series(list(event_type_prediction), index=relevant_index, dtype=object)
+    if event_type_answer_mode == "score":
+        # One score column per event type, e.g. event_type_tribal_score
+        for label in EVENT_TYPE_LABELS:
+            df[f"event_type_{label}_score"] = np.nan
+            df.loc[relevant_index, f"event_type_{label}_score"] = [scores[label] for scores in event_type_scores]
+
+
+def near_duplicate_representatives(df):
+    """
+    Index of the representative of the near-duplicate cluster of each event (see the "cluster_id" column of the GDELT
+    data): the event whose Index is the cluster_id. Events without cluster are their own representative.
+    """
+    if "cluster_id" not in df.columns:
+        return list(df.index)
+    clustered = df["cluster_id"].notna()
+    representatives = clustered & (df["cluster_id"] == df["Index"])
+    representative_of_cluster = dict(zip(df.loc[representatives, "cluster_id"], df.index[representatives]))
+    # An event whose representative is missing (e.g. filtered out) is its own representative
+    return [representative_of_cluster.get(cluster_id, idx) if is_clustered else idx for idx, cluster_id, is_clustered in zip(df.index, df["cluster_id"], clustered)]
+
 
-    return event_type_prediction
+def run_streaming_classification(df_test, run_event_relevance, run_event_type, add_predictions, partial_output_path=None, chunk_size=100, queue_size=4, fixed_type_chunks=False):
+    """
+    Classify the events with both stages overlapping: the event relevance runs on chunks of `chunk_size` events, and the
+    events found relevant are queued straight into the event type classification, which runs in a worker thread on the
+    relevant events queued so far, at most `chunk_size` at a time. The queue holds at most `queue_size` chunks: the
+    relevance waits when the event type falls behind. The predictions are the ones of the two stages run one after the other.
+
+    :param callable run_event_relevance: Takes a DataFrame of events, returns their relevance predictions and scores
+    :param callable run_event_type: Takes a DataFrame of relevant events, returns their type predictions and scores
+    :param callable add_predictions: Adds the prediction columns to a DataFrame of events, see add_prediction_columns
+    :param str partial_output_path: CSV the events are appended to as soon as they are classified by both stages, in
+        completion order. Not written if not provided
+    :param bool fixed_type_chunks: Classify the event types on chunks of exactly `chunk_size` relevant events (but the last
+        one), e.g. to pack the type requests as when all the relevant events are classified at once
+    :return tuple: Relevance predictions and scores aligned with `df_test`, index of the relevant events, type predictions
+        and scores aligned with the relevant events
+    """
+    relevance_predictions, relevance_scores, type_predictions, type_scores = {}, {}, {}, {}
+    relevant_queue = queue.Queue(maxsize=max(1, queue_size))
+    relevance_done = threading.Event()
+    stop = threading.Event()
+    type_errors = []
+    write_lock = threading.Lock()
+    busy_seconds = {"event_relevance": 0.0, "event_type": 0.0}
+    if partial_output_path and os.path.exists(partial_output_path):
+        os.remove(partial_output_path)
+
+    def write_completed(index):
+        if not partial_output_path or not index:
+            return
+        relevant_index = [idx for idx in index if relevance_predictions[idx] == "Yes"]
+        rows = df_test.loc[index].copy()
+        add_predictions(
+            rows, [relevance_predictions[idx] for idx in index], [relevance_scores[idx] for idx in index],
+            relevant_index, [type_predictions[idx] for idx in relevant_index], [type_scores[idx] for idx in relevant_index],
+        )
+        with write_lock:
+            rows.to_csv(partial_output_path, mode="a", header=not os.path.exists(partial_output_path), index=False)
+
+    def classify_types(index):
+        start = time.perf_counter()
+        predictions, scores = run_event_type(df_test.loc[index])
+        busy_seconds["event_type"] += time.perf_counter() - start
+        type_predictions.update(zip(index, predictions))
+        type_scores.update(zip(index, scores))
+        write_completed(index)
+
+    def type_worker():
+        pending = []
+        try:
+            while not stop.is_set():
+                try:
+                    pending.extend(relevant_queue.get(timeout=0.5))
+                    while not relevant_queue.empty():
+                        pending.extend(relevant_queue.get_nowait())
+                except queue.Empty:
+                    if relevance_done.is_set() and relevant_queue.empty():
+                        break
+                    continue
+                while pending and len(pending) >= (chunk_size if fixed_type_chunks else 1):
+                    classify_types(pending[:chunk_size])
+                    pending = pending[chunk_size:]
+            if pending and not stop.is_set():
+                classify_types(pending)
+        except Exception as e:
+            type_errors.append(e)
+
+    wall_start = time.perf_counter()
+    worker = threading.Thread(target=type_worker, name="event_type_stream", daemon=True)
+    worker.start()
+    try:
+        for chunk_start in range(0, len(df_test), chunk_size):
+            if type_errors:
+                break
+            chunk = df_test.iloc[chunk_start: chunk_start + chunk_size]
+            start = time.perf_counter()
+            predictions, scores = run_event_relevance(chunk)
+            busy_seconds["event_relevance"] += time.perf_counter() - start
+            relevance_predictions.update(zip(chunk.index, predictions))
+            relevance_scores.update(zip(chunk.index, scores))
+            relevant = [idx for idx, prediction in zip(chunk.index, predictions) if prediction == "Yes"]
+            write_completed([idx for idx, prediction in zip(chunk.index, predictions) if prediction != "Yes"])
+            while relevant and not type_errors:
+                try:
+                    relevant_queue.put(relevant, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        relevance_done.set()
+    worker.join()
+    if type_errors:
+        raise type_errors[0]
+
+    relevant_index = [idx for idx in df_test.index if relevance_predictions[idx] == "Yes"]
+    logger.info(
+        f"Streaming classification: {len(df_test)} events, {len(relevant_index)} relevant, "
+        f"{busy_seconds['event_relevance']:.1f}s of event relevance and {busy_seconds['event_type']:.1f}s of event type "
+        f"in {time.perf_counter() - wall_start:.1f}s"
+    )
+    return (
+        [relevance_predictions[idx] for idx in df_test.index],
+        [relevance_scores[idx] for idx in df_test.index],
+        relevant_index,
+        [type_predictions[idx] for idx in relevant_index],
+        [type_scores[idx] for idx in relevant_index],
+    )
 
     
 if __name__ == "__main__":
@@ -90,33 +304,91 @@ if __name__ == "__main__":
     # load shared config
     data_folder, start_date, end_date, data_sources, databricks_secret_scope = parse_shared_config(config)
 
+    # load LLM cassette config, shared by all the stages. A replayed run needs no secrets nor network
+    llm_cassette_config = config.get("model_pipeline", {}).get("llm_cassette")
+    offline = bool(llm_cassette_config) and llm_cassette_config.get("mode", "replay") == "replay"
+    logger.info(f"LLM cassette: {llm_cassette_config}")
+
+    # load LLM backends, selectable by the llm_name of the stages in addition to "gpt4" and "mistral"
+    llm_backends = config.get("model_pipeline", {}).get("llm_backends") or {}
+    logger.info(f"LLM backends: {list(llm_backends)}")
+
     # load secrets
-    secret_dict = load_secrets(databricks_secret_scope)
+    secret_dict = {} if offline else load_secrets(databricks_secret_scope, llm_backends)
     
     # load output folder
     output_folder = config.get("model_pipeline", {}).get("output_folder")
 
+    # load rate limits, shared by all the stages using the same LLM
+    rate_limits = config.get("model_pipeline", {}).get("rate_limits", {})
+    logger.info(f"Rate limits: {rate_limits}")
+
+    # load retry config. No LLM request is sent or retried after run_deadline_hours
+    retry_config = dict(config.get("model_pipeline", {}).get("retry", {}) or {})
+    run_deadline_hours = retry_config.pop("run_deadline_hours", 0)
+    if run_deadline_hours:
+        retry_config["deadline"] = time.time() + run_deadline_hours * 3600
+    logger.info(f"Retry policy: {retry_config}")
+
+    # load circuit breaker config, shared by all the stages using the same LLM
+    circuit_breaker_config = config.get("model_pipeline", {}).get("circuit_breaker", {})
+    logger.info(f"Circuit breaker: {circuit_breaker_config}")
+
+    # load HTTP connection pool config, the clients are shared by all the stages
+    http_pool_config = config.get("model_pipeline", {}).get("http_pool")
+    logger.info(f"HTTP connection pool: {http_pool_config}")
+
+    # load LLM response cache config, shared by all the stages
+    llm_cache_config = config.get("model_pipeline", {}).get("llm_cache")
+    logger.info(f"LLM response cache: {llm_cache_config}")
+
+    run_name = f"{'_'.join(data_sources).lower()}_{start_date}_{end_date}"
+
+    # load checkpoint config. The answered events of both stages are checkpointed, an interrupted run resumes from them
+    checkpoint_config = config.get("model_pipeline", {}).get("checkpoint", {}) or {}
+    checkpoint_path = None
+    if checkpoint_config.get("enabled", True):
+        checkpoint_path = checkpoint_config.get("path") or os.path.join(output_folder, "checkpoints", f"{run_name}_checkpoint.jsonl")
+    logger.info(f"Checkpoint: {checkpoint_path}")
+
+    # load streaming config. Relevant events are queued straight into the event type classification, both stages overlap
+    streaming_config = config.get("model_pipeline", {}).get("streaming", {}) or {}
+    logger.info(f"Streaming: {streaming_config}")
+
+    # load spark config. The events are partitioned across the executors of the cluster, each classifies its partition
+    spark_config = config.get("model_pipeline", {}).get("spark", {}) or {}
+    logger.info(f"Spark: {spark_config}")
+
+    # load rules config. The labels the rules decide from the structured fields of the events are not asked to the LLM
+    rules_path = config.get("model_pipeline", {}).get("rules_path")
+    logger.info(f"Rules: {rules_path}")
+
+    # load prediction ledger config. The events classified by past runs with the same content and settings are not sent again
+    ledger_config = config.get("model_pipeline", {}).get("ledger", {}) or {}
+    logger.info(f"Prediction ledger: {ledger_config}")
+
+    # load LLM telemetry config: JSON summary of the run and Prometheus textfile, written at the end of the run
+    telemetry_config = config.get("model_pipeline", {}).get("telemetry", {}) or {}
+    telemetry_summary_path = telemetry_config.get("summary_path") or os.path.join(output_folder, "telemetry", f"{run_name}_llm_telemetry.json")
+    telemetry_prometheus_path = telemetry_config.get("prometheus_path")
+    get_llm_telemetry().prices.update(telemetry_config.get("prices", {}) or {})
+    logger.info(f"LLM telemetry: {telemetry_config}")
+
     # load event relevance classification config
     event_relevance_classification_config = config.get("model_pipeline", {}).get("event_relevance_classification", {})
-    event_relevance_llm = event_relevance_classification_config.get("llm_name")
-    event_relevance_few_shot_num = event_relevance_classification_config.get("few_shot_num", 0)
-    event_relevance_train_example_path = event_relevance_classification_config.get("train_example_path")
-    event_relevance_max_tokens = event_relevance_classification_config.get("max_tokens", 512)
-    event_relevance_temperature = event_relevance_classification_config.get("temperature", 0)
-    event_relevance_mistralai_rps = event_relevance_classification_config.get("mistralai_rps", 0)
-    valid_model_configs(event_relevance_llm, event_relevance_few_shot_num, event_relevance_train_example_path, secret_dict, output_folder)
-    logger.info(f"Selected models for Event Relevance Classification: -LLM: {event_relevance_llm}\n -few_shot_num: {event_relevance_few_shot_num}\n -train_example_path: {event_relevance_train_example_path}\n -max_tokens: {event_relevance_max_tokens}\n -temperature: {event_relevance_temperature}")
+    event_relevance_config = load_stage_config(event_relevance_classification_config, EVENT_RELEVANCE_CONFIG_DEFAULTS, rate_limits)
+    valid_model_configs(event_relevance_config["llm_name"], event_relevance_config["few_shot_num"], event_relevance_config["train_example_path"], secret_dict, output_folder, offline=offline, llm_backends=llm_backends)
+    if event_relevance_config["hedging"] and event_relevance_config["hedging"].get("alternate_llm_name"):
+        valid_model_configs(event_relevance_config["hedging"]["alternate_llm_name"], 0, None, secret_dict, output_folder, offline=offline, llm_backends=llm_backends)
+    logger.info("Selected models for Event Relevance Classification:" + "".join(f"\n -{key}: {value}" for key, value in event_relevance_config.items() if key != "rate_limit"))
     
     # load event type classification config
     event_type_classification_config = config.get("model_pipeline", {}).get("event_type_classification", {})
-    event_type_llm = event_type_classification_config.get("llm_name")
-    event_type_few_shot_num = event_type_classification_config.get("few_shot_num", 0)
-    event_type_train_example_path = event_type_classification_config.get("train_example_path")
-    event_type_max_tokens = event_type_classification_config.get("max_tokens", 512)
-    event_type_temperature = event_type_classification_config.get("temperature", 0)
-    event_type_mistralai_rps = event_type_classification_config.get("mistralai_rps", 0)
-    valid_model_configs(event_type_llm, event_type_few_shot_num, event_type_train_example_path, secret_dict, output_folder)
-    logger.info(f"Selected models for Event Type Classification: -LLM: {event_type_llm}\n -few_shot_num: {event_type_few_shot_num}\n -train_example_path: {event_type_train_example_path}\n -max_tokens: {event_type_max_tokens}\n -temperature: {event_type_temperature}")
+    event_type_config = load_stage_config(event_type_classification_config, EVENT_TYPE_CONFIG_DEFAULTS, rate_limits)
+    valid_model_configs(event_type_config["llm_name"], event_type_config["few_shot_num"], event_type_config["train_example_path"], secret_dict, output_folder, offline=offline, llm_backends=llm_backends)
+    if event_type_config["hedging"] and event_type_config["hedging"].get("alternate_llm_name"):
+        valid_model_configs(event_type_config["hedging"]["alternate_llm_name"], 0, None, secret_dict, output_folder, offline=offline, llm_backends=llm_backends)
+    logger.info("Selected models for Event Type Classification:" + "".join(f"\n -{key}: {value}" for key, value in event_type_config.items() if key != "rate_limit"))
 
     # load test data 
     if "ACLED" in data_sources:
@@ -129,25 +401,144 @@ if __name__ == "__main__":
         gdelt_data = pd.DataFrame()
     final_test_data = pd.concat([acled_data, gdelt_data], ignore_index=True)
 
-    # event relevance classification
-    logger.info("Running Event Relevance Classification")
-    event_relevance_prediction = run_event_relevance_classification(final_test_data, secret_dict, event_relevance_llm, max_tokens=event_relevance_max_tokens, temperature=event_relevance_temperature, few_shot_num=event_relevance_few_shot_num, train_example_path=event_relevance_train_example_path, mistralai_rps=event_relevance_mistralai_rps)
-    final_test_data["event_relevance_prediction"] = event_relevance_prediction
-    
-    # save results
-    os.makedirs(output_folder, exist_ok=True)
-    final_test_data.to_csv(os.path.join(output_folder, f"{'_'.join(data_sources).lower()}_{start_date}_{end_date}_with_predictions.csv"), index=False)
+    # batch jobs state of this run, used to resume the batch jobs if the run is interrupted
+    batch_state_dir = os.path.join(output_folder, "batch_state", run_name)
+
+    if spark_config.get("enabled", False) and streaming_config.get("enabled", False):
+        raise ValueError("spark and streaming modes are exclusive, each partition of the spark mode runs both stages")
+    if streaming_config.get("enabled", False) or spark_config.get("enabled", False):
+        if "batch" in [event_relevance_config["execution_mode"], event_type_config["execution_mode"]]:
+            raise ValueError(f"{'spark' if spark_config.get('enabled', False) else 'streaming'} mode needs the sequential or async execution_mode, a batch job classifies all the events at once")
+        if event_relevance_config["cascade"] and event_relevance_config["cascade"].get("retrain"):
+            # The cascade classifier is retrained once, not for every chunk or partition
+            get_cascade_classifier(event_relevance_config["cascade"]["model_path"], event_relevance_config["cascade"].get("train_data_path"), retrain=True)
+            event_relevance_config["cascade"] = {**event_relevance_config["cascade"], "retrain": False}
+
+    # stage runners, called on all the events, or on chunks of events in streaming mode
+    run_config = {
+        "secret_dict": secret_dict,
+        "llm_backends": llm_backends,
+        "llm_cache": llm_cache_config,
+        "llm_cassette": llm_cassette_config,
+        "retry": retry_config,
+        "circuit_breaker": circuit_breaker_config,
+        "http_pool": http_pool_config,
+        "batch_state_dir": batch_state_dir,
+        "checkpoint_path": checkpoint_path,
+        "rules_path": rules_path,
+    }
+    run_event_relevance = functools.partial(run_event_relevance_classification, stage_config=event_relevance_config, run_config=run_config)
+    run_event_type = functools.partial(run_event_type_classification, stage_config=event_type_config, run_config=run_config)
+    add_predictions = functools.partial(add_prediction_columns, event_relevance_answer_mode=event_relevance_config["answer_mode"], event_type_answer_mode=event_type_config["answer_mode"])
+    output_path = os.path.join(output_folder, f"{run_name}_with_predictions.csv")
+
+    # only one event per near-duplicate cluster is classified, its predictions are fanned out to the whole cluster
+    representative_index = near_duplicate_representatives(final_test_data)
+    cluster_events = final_test_data.loc[[idx for idx, representative in zip(final_test_data.index, representative_index) if idx == representative]]
+    if len(cluster_events) < len(final_test_data):
+        logger.info(f"Near-duplicates: {len(final_test_data) - len(cluster_events)} events take the predictions of their cluster, {len(cluster_events)} events classified")
+        cluster_events = cluster_events.copy()
+    else:
+        cluster_events = final_test_data
+
+    # events classified by past runs are taken from the ledger, only the new and changed events are classified
+    classify_data = cluster_events
+    if ledger_config.get("path"):
+        ledger = get_prediction_ledger(ledger_config["path"])
+        ledger_fingerprint = config_fingerprint([event_relevance_classification_config, event_type_classification_config], llm_backends, get_rule_engine(rules_path).rules if rules_path else None)
+        ledger_entries = {}
+        ledger_statuses = collections.Counter()
+        for idx, event in zip(cluster_events.index, cluster_events.to_dict("records")):
+            entry, status = ledger.lookup(event, event_content_hash(event), ledger_fingerprint)
+            if entry is not None:
+                ledger_entries[idx] = entry
+            ledger_statuses[status] += 1
+        ledger_predictions = {idx: entry["predictions"] for idx, entry in ledger_entries.items()}
+        classify_data = cluster_events.loc[~cluster_events.index.isin(list(ledger_predictions))].copy()
+        ledger_report = ledger_run_report(
+            run_name, len(cluster_events), list(ledger_entries.values()), ledger_statuses["new"], ledger_statuses["changed"], ledger_statuses["stale"],
+        )
+        logger.info(
+            f"Prediction ledger: {ledger_report['reused_events']} events reused, {ledger_report['new_events']} new, "
+            f"{ledger_report['changed_events']} changed, {ledger_report['stale_events']} classified with other settings"
+        )
+
+    if spark_config.get("enabled", False):
+        # each partition of the events is classified by both stages on an executor, with a slice of the rate limits
+        logger.info("Running Event Relevance and Event Type Classification on Spark")
+        spark = get_spark_session(spark_config.get("master"))
+        num_partitions = spark_config.get("num_partitions") or spark.sparkContext.defaultParallelism
+        num_slices = spark_task_slots(spark, num_partitions)
+        logger.info(f"Spark: {num_partitions} partitions, {num_slices} classified at the same time")
+        spark_run_event_relevance = functools.partial(run_event_relevance_classification, stage_config=stage_config_slice(event_relevance_config, num_slices))
+        spark_run_event_type = functools.partial(run_event_type_classification, stage_config=stage_config_slice(event_type_config, num_slices))
+        event_relevance_prediction, event_relevance_scores, relevant_index, event_type_prediction, event_type_scores = run_spark_classification(
+            classify_data, spark_run_event_relevance, spark_run_event_type, spark, num_partitions, run_config,
+        )
+    elif streaming_config.get("enabled", False):
+        # relevant events are classified by type while the relevance of the next events is classified
+        logger.info("Running Event Relevance and Event Type Classification in streaming mode")
+        partial_output_path = os.path.join(output_folder, f"{run_name}_with_predictions_partial.csv")
+        event_relevance_prediction, event_relevance_scores, relevant_index, event_type_prediction, event_type_scores = run_streaming_classification(
+            classify_data, run_event_relevance, run_event_type, add_predictions, partial_output_path,
+            chunk_size=streaming_config.get("chunk_size", 100), queue_size=streaming_config.get("queue_size", 4), fixed_type_chunks=event_type_config["pack_size"] != 1,
+        )
+    else:
+        # event relevance classification
+        logger.info("Running Event Relevance Classification")
+        event_relevance_prediction, event_relevance_scores = run_event_relevance(classify_data)
+        classify_data["event_relevance_prediction"] = event_relevance_prediction
+        if event_relevance_config["answer_mode"] == "score":
+            classify_data["event_relevance_score"] = event_relevance_scores
+
+        # save results. The file is replaced at once, readers never see a partial file
+        to_csv_atomic(classify_data, output_path, index=False)
 
+        # event type classification on relevant event
+        logger.info("Running Event Type Classification")
+        relevant_events = classify_data[classify_data["event_relevance_prediction"] == "Yes"]
+        relevant_index = relevant_events.index
+        event_type_prediction, event_type_scores = run_event_type(relevant_events)
 
-    # event type classification on relevant event
-    logger.info("Running Event Type Classification")
-    relevant_events = final_test_data[final_test_data["event_relevance_prediction"] == "Yes"]
-    event_type_prediction = run_event_type_classification(relevant_events, secret_dict, event_type_llm, max_tokens=event_type_max_tokens, temperature=event_type_temperature, few_shot_num=event_type_few_shot_num, train_example_path=event_type_train_example_path, mistralai_rps=event_type_mistralai_rps)
-    final_test_data["event_type_prediction"] = np.nan
-    final_test_data.loc[relevant_events.index, "event_type_prediction"] = event_type_prediction
+    if ledger_config.get("path") or cluster_events is not final_test_data:
+        # predictions of the classified events merged with those of the ledger, and fanned out to the near-duplicates
+        new_predictions = event_predictions(classify_data.index, event_relevance_prediction, event_relevance_scores, relevant_index, event_type_prediction, event_type_scores)
+        cluster_predictions = {**(ledger_predictions if ledger_config.get("path") else {}), **dict(zip(classify_data.index, new_predictions))}
+        event_relevance_prediction, event_relevance_scores, relevant_index, event_type_prediction, event_type_scores = merge_predictions(
+            final_test_data.index, [cluster_predictions[representative] for representative in representative_index]
+        )
+    add_predictions(final_test_data, event_relevance_prediction, event_relevance_scores, relevant_index, event_type_prediction, event_type_scores)
+    if rules_path:
+        final_test_data["rules_fired"] = get_rule_engine(rules_path).fired(final_test_data)
 
-    # save results
-    os.makedirs(output_folder, exist_ok=True)
-    final_test_data.to_csv(os.path.join(output_folder, f"{'_'.join(data_sources).lower()}_{start_date}_{end_date}_with_predictions.csv"), index=False)
+    # save results, then record the classified events in the ledger and drop the checkpoint: the run is complete
+    to_csv_atomic(final_test_data, output_path, index=False)
+    if streaming_config.get("enabled", False) and os.path.exists(partial_output_path):
+        os.remove(partial_output_path)
+    if ledger_config.get("path"):
+        classified_events = classify_data.to_dict("records")
+        ledger.add(classified_events, new_predictions, ledger_fingerprint, run_name, event_answer_sources(classified_events))
+        ledger.record_run(ledger_report)
+        logger.info(
+            f"Prediction ledger: predictions of {ledger_report['reused_events']} events reused ({ledger_report['reused_relevant_events']} relevant events "
+            f"with their event types), saving {ledger_report['skipped_relevance_llm_calls']} event relevance and {ledger_report['skipped_type_llm_calls']} "
+            f"event type LLM calls, {ledger.stats()}"
+        )
+    if checkpoint_path and not checkpoint_config.get("keep", False):
+        get_prediction_checkpoint(checkpoint_path).remove()
+        # The checkpoints of the partitions of the spark mode, of this run and of the interrupted runs it resumed
+        for partition_path in partition_checkpoint_paths(checkpoint_path):
+            os.remove(partition_path)
 
+    # token usage and prefix cache hit rate per stage
+    logger.info(f"LLM usage per stage: {get_llm_usage_report()}")
+    logger.info(f"Event description truncation per stage: {get_truncation_report()}")
+    logger.info(f"Hedged LLM calls per stage: {get_hedge_report()}")
+    logger.info(f"Prompt compiler: {get_prompt_compiler().stats()}")
 
+    # latency percentiles, tokens, retries, parse failures and estimated cost per stage label and provider
+    telemetry_summary = get_llm_telemetry().write_summary(telemetry_summary_path)
+    logger.info(f"LLM telemetry: {telemetry_summary['total']}, summary written to {telemetry_summary_path}")
+    if telemetry_prometheus_path:
+        get_llm_telemetry().write_prometheus(telemetry_prometheus_path, prefix=telemetry_config.get("prometheus_prefix", "ceha_llm"))
+        logger.info(f"LLM telemetry exported to {telemetry_prometheus_path}")
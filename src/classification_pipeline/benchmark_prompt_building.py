@@ -0,0 +1,130 @@
+"""
+Microbenchmark of the per-event prompt-building cost, without any LLM call.
+
+Compares building the few-shot prompts of the CEHA test split the per-event way (the few-shot examples are
+formatted and dedented again for every event) with the prompt compiler (the static system / guideline /
+few-shot blocks are rendered once per run and reused for every event).
+
+Usage (from the repository root):
+    python -m src.classification_pipeline.benchmark_prompt_building --few_shot_num 6
+"""
+import argparse
+import time
+from textwrap import dedent
+
+from .event_relevance_classification import (
+    build_event_relevance_prompt,
+    build_event_relevance_prompt_prefix,
+    sample_event_relevance_few_shot_examples,
+)
+from .event_type_classification import (
+    EVENT_TYPE_LABELS,
+    build_event_type_prompt_prefixes,
+    build_event_type_prompts,
+    sample_event_type_few_shot_examples,
+)
+from ..utils.prompt_compiler import get_prompt_compiler
+from ..utils.prompts import (
+    databricks_llm_prompt_chat,
+    generate_few_shot_prompt_list,
+    generate_few_shot_prompt_list_type,
+    system_prompt,
+    system_prompt_type,
+)
+from ..utils.utils import load_data
+
+
+def per_event_relevance_prompt(i, few_shot_examples):
+    prompt, pos_examples, neg_examples = generate_few_shot_prompt_list(i["Event Description"], i["Country"], few_shot_examples)
+    return databricks_llm_prompt_chat(dedent(system_prompt).strip(), dedent(prompt).strip(), pos_examples, neg_examples)
+
+
+def per_event_type_prompts(i, few_shot_examples):
+    prompts = []
+    for label in EVENT_TYPE_LABELS:
+        prompt, pos_examples, neg_examples = generate_few_shot_prompt_list_type(
+            i["Event Description"], i["Actor 1"], i["Actor 2"], few_shot_examples[label], label
+        )
+        prompts.append(databricks_llm_prompt_chat(dedent(system_prompt_type).strip(), dedent(prompt).strip(), pos_examples, neg_examples))
+    return prompts
+
+
+def _microseconds_per_event(build_stage_prompts, records, repeat):
+    """
+    Times `build_stage_prompts(records)` once per pass, after clearing the prompt compiler: the cost of rendering the
+    static blocks is included once per pass, as in a run.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        get_prompt_compiler().clear()
+        build_stage_prompts(records)
+    return 1e6 * (time.perf_counter() - start) / (repeat * len(records))
+
+
+def benchmark_prompt_building(df_train, df_test, few_shot_num, repeat=3):
+    """
+    Returns:
+        list: One dict per stage with the microseconds per event of the per-event and compiled prompt building.
+    """
+    records = df_test.to_dict("records")
+    relevance_examples = sample_event_relevance_few_shot_examples(df_train, few_shot_num)
+    df_train_relevant = df_train[df_train["Is the event relevant?_DM"] == "Yes"]
+    type_examples = sample_event_type_few_shot_examples(df_train_relevant, few_shot_num)
+
+    def per_event_relevance(records):
+        return [per_event_relevance_prompt(i, relevance_examples) for i in records]
+
+    def compiled_relevance(records):
+        prompt_prefix = build_event_relevance_prompt_prefix(few_shot_num, relevance_examples)
+        return [build_event_relevance_prompt(i, few_shot_num, relevance_examples, prompt_prefix) for i in records]
+
+    def per_event_type(records):
+        return [prompts for i in records for prompts in per_event_type_prompts(i, type_examples)]
+
+    def compiled_type(records):
+        prompt_prefixes = build_event_type_prompt_prefixes(few_shot_num, type_examples)
+        return [prompts for i in records for prompts in build_event_type_prompts(i, few_shot_num, type_examples, prompt_prefixes=prompt_prefixes)]
+
+    results = []
+    for stage, per_event, compiled in [("relevance", per_event_relevance, compiled_relevance), ("type_per_label", per_event_type, compiled_type)]:
+        # Both ways build the same prompts
+        assert per_event(records[:5]) == compiled(records[:5])
+        per_event_us = _microseconds_per_event(per_event, records, repeat)
+        compiled_us = _microseconds_per_event(compiled, records, repeat)
+        results.append(
+            {
+                "stage": stage,
+                "per_event_us": round(per_event_us, 1),
+                "compiled_us": round(compiled_us, 1),
+                "speedup": round(per_event_us / max(compiled_us, 1e-9), 1),
+            }
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the per-event prompt-building cost on the CEHA test split")
+    parser.add_argument("--data_path", type=str, default="data/CEHA_dataset.csv", help="path of the CEHA dataset")
+    parser.add_argument(
+        "--few_shot_num", type=int, default=6, help="number of few shot examples"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="number of passes over the test split"
+    )
+    args = parser.parse_args()
+
+    # Load Data
+    df_train, df_dev, df_test = load_data(args.data_path)
+
+    results = benchmark_prompt_building(df_train, df_test, args.few_shot_num, args.repeat)
+
+    print(f"{len(df_test)} test events, few_shot_num: {args.few_shot_num}")
+    for result in results:
+        print(
+            f"{result['stage']}: per-event: {result['per_event_us']} us/event; compiled: {result['compiled_us']} us/event; "
+            f"x{result['speedup']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
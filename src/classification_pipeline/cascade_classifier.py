@@ -0,0 +1,144 @@
+"""
+Local relevance classifier run before the LLM.
+
+A TF-IDF + logistic regression model trained on the train split of the CEHA dataset scores each event.
+Events scored below `low_threshold` are labeled "No" and, if set, events scored at or above `high_threshold`
+are labeled "Yes" without any LLM call; only the uncertain band in between is sent to the LLM. Irrelevant
+events skipped this way also skip the event type classification.
+"""
+import os
+import pickle
+import threading
+
+from ..utils.utils import load_data_cached
+from ..db_utils import configure_default_logger
+
+try:
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+except ImportError:
+    # scikit-learn is optional, it is only needed when the cascade is enabled
+    make_pipeline = None
+
+# Configure logging
+logger = configure_default_logger()
+
+
+def cascade_event_text(i):
+    """
+    Text of an event scored by the cascade classifier.
+    """
+    return f"{i['Country']}\n{i['Event Description']}"
+
+
+class CascadeClassifier:
+    """
+    TF-IDF + logistic regression relevance classifier.
+    """
+
+    def __init__(self, max_features=50000, ngram_range=(1, 2), C=4.0):
+        if make_pipeline is None:
+            raise ImportError("The cascade classifier requires scikit-learn: pip install scikit-learn")
+        self.model = make_pipeline(
+            TfidfVectorizer(max_features=max_features, ngram_range=tuple(ngram_range), sublinear_tf=True, min_df=1),
+            LogisticRegression(C=C, class_weight="balanced", max_iter=1000),
+        )
+
+    def fit(self, df_train):
+        """
+        Trains the classifier on events labeled with the "Is the event relevant?_DM" column.
+        """
+        texts = [cascade_event_text(i) for i in df_train.to_dict("records")]
+        labels = [1 if label == "Yes" else 0 for label in df_train["Is the event relevant?_DM"]]
+        self.model.fit(texts, labels)
+        return self
+
+    def predict_proba(self, records):
+        """
+        Returns the probability of each event to be relevant.
+        """
+        if not records:
+            return []
+        return self.model.predict_proba([cascade_event_text(i) for i in records])[:, 1].tolist()
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+def train_cascade_classifier(train_data_path, **model_kwargs):
+    """
+    Trains a cascade classifier on the train split of the CEHA dataset at `train_data_path`.
+    """
+    df_train, _, _ = load_data_cached(train_data_path)
+    return CascadeClassifier(**model_kwargs).fit(df_train)
+
+
+_CASCADE_CLASSIFIERS = {}
+_CASCADE_CLASSIFIERS_LOCK = threading.Lock()
+
+
+def get_cascade_classifier(model_path, train_data_path=None, retrain=False):
+    """
+    Get the cascade classifier stored at `model_path`. If it does not exist (or `retrain` is set) it is trained on
+    `train_data_path` and saved to `model_path`. It is loaded on first use and shared afterwards.
+    """
+    with _CASCADE_CLASSIFIERS_LOCK:
+        if model_path not in _CASCADE_CLASSIFIERS or retrain:
+            if os.path.exists(model_path) and not retrain:
+                _CASCADE_CLASSIFIERS[model_path] = CascadeClassifier.load(model_path)
+                logger.info(f"Loaded cascade classifier from {model_path}")
+            else:
+                if not train_data_path:
+                    raise ValueError(f"No cascade classifier at {model_path}, train_data_path is required to train it")
+                classifier = train_cascade_classifier(train_data_path)
+                classifier.save(model_path)
+                _CASCADE_CLASSIFIERS[model_path] = classifier
+                logger.info(f"Trained cascade classifier on {train_data_path}, saved to {model_path}")
+        return _CASCADE_CLASSIFIERS[model_path]
+
+
+def cascade_labels(scores, low_threshold=0.1, high_threshold=None):
+    """
+    Labels of the events the cascade classifier is confident about: "No" if the score is below `low_threshold`,
+    "Yes" if it is at least `high_threshold` (None never labels an event "Yes"), otherwise None, meaning the
+    event is sent to the LLM.
+    """
+    if high_threshold is not None and low_threshold > high_threshold:
+        raise ValueError(f"low_threshold {low_threshold} must not be above high_threshold {high_threshold}")
+    labels = []
+    for score in scores:
+        if score < low_threshold:
+            labels.append("No")
+        elif high_threshold is not None and score >= high_threshold:
+            labels.append("Yes")
+        else:
+            labels.append(None)
+    return labels
+
+
+def cascade_relevance(records, model_path, train_data_path=None, low_threshold=0.1, high_threshold=None, retrain=False):
+    """
+    Scores the events with the cascade classifier and stores the score in their "cascade_score" field.
+
+    Returns:
+        list: The cascade label of each event, None for the events to send to the LLM.
+    """
+    classifier = get_cascade_classifier(model_path, train_data_path, retrain)
+    scores = classifier.predict_proba(records)
+    for i, score in zip(records, scores):
+        i["cascade_score"] = score
+    labels = cascade_labels(scores, low_threshold, high_threshold)
+    skipped = sum(label is not None for label in labels)
+    logger.info(
+        f"Cascade classifier: {skipped}/{len(labels)} events labeled without the LLM "
+        f"({labels.count('No')} not relevant, {labels.count('Yes')} relevant)"
+    )
+    return labels
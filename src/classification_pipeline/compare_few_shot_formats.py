@@ -0,0 +1,107 @@
+"""
+Compare the prompt tokens of the "full" and "compact" few-shot formats on the CEHA test split, without any LLM call.
+
+For the relevance prompts and the "per_label" and "fused" event type prompts, reports the number of prompts,
+the prompt tokens per prompt and the total prompt tokens of each few-shot format.
+
+Usage (from the repository root):
+    python -m src.classification_pipeline.compare_few_shot_formats --few_shot_num 6
+"""
+import argparse
+
+from .event_relevance_classification import (
+    build_event_relevance_prompt,
+    build_event_relevance_prompt_prefix,
+    sample_event_relevance_few_shot_examples,
+)
+from .event_type_classification import (
+    TYPE_PROMPT_MODES,
+    build_event_type_prompt_prefixes,
+    build_event_type_prompts,
+    sample_event_type_few_shot_examples,
+)
+from ..utils.prompts import FEW_SHOT_FORMATS
+from ..utils.utils import count_prompt_tokens, load_data
+
+
+def build_relevance_prompts(df_train, df_test, few_shot_num, few_shot_format):
+    """
+    Builds the relevance prompts of `df_test` as `predict_event_relevance` does.
+    """
+    few_shot_examples = sample_event_relevance_few_shot_examples(df_train, few_shot_num)
+    prompt_prefix = build_event_relevance_prompt_prefix(few_shot_num, few_shot_examples, few_shot_format=few_shot_format)
+    return [
+        build_event_relevance_prompt(i, few_shot_num, few_shot_examples, prompt_prefix, few_shot_format=few_shot_format)
+        for i in df_test.to_dict("records")
+    ]
+
+
+def build_type_prompts(df_train, df_test, few_shot_num, type_prompt_mode, few_shot_format):
+    """
+    Builds the event type prompts of `df_test` as `predict_event_type` does.
+    """
+    few_shot_examples = sample_event_type_few_shot_examples(df_train, few_shot_num)
+    prompt_prefixes = build_event_type_prompt_prefixes(few_shot_num, few_shot_examples, type_prompt_mode, few_shot_format=few_shot_format)
+    prompts = []
+    for i in df_test.to_dict("records"):
+        prompts.extend(
+            build_event_type_prompts(i, few_shot_num, few_shot_examples, type_prompt_mode, prompt_prefixes, few_shot_format=few_shot_format)
+        )
+    return prompts
+
+
+def compare_few_shot_formats(df_train, df_test, few_shot_num):
+    """
+    Returns:
+        list: One dict per stage and few-shot format with its number of prompts and prompt tokens.
+    """
+    df_train_relevant = df_train[df_train["Is the event relevant?_DM"] == "Yes"]
+    df_test_relevant = df_test[df_test["Is the event relevant?_DM"] == "Yes"]
+    results = []
+    for few_shot_format in FEW_SHOT_FORMATS:
+        stage_prompts = {"relevance": build_relevance_prompts(df_train, df_test, few_shot_num, few_shot_format)}
+        for type_prompt_mode in TYPE_PROMPT_MODES:
+            stage_prompts[f"type_{type_prompt_mode}"] = build_type_prompts(
+                df_train_relevant, df_test_relevant, few_shot_num, type_prompt_mode, few_shot_format
+            )
+        for stage, prompts in stage_prompts.items():
+            prompt_tokens = sum(count_prompt_tokens(prompt) for prompt in prompts)
+            results.append(
+                {
+                    "stage": stage,
+                    "few_shot_format": few_shot_format,
+                    "prompts": len(prompts),
+                    "prompt_tokens": prompt_tokens,
+                    "tokens_per_prompt": round(prompt_tokens / max(1, len(prompts)), 1),
+                }
+            )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the prompt tokens of the few-shot formats on the CEHA test split")
+    parser.add_argument("--data_path", type=str, default="data/CEHA_dataset.csv", help="path of the CEHA dataset")
+    parser.add_argument(
+        "--few_shot_num", type=int, default=6, help="number of few shot examples"
+    )
+    args = parser.parse_args()
+
+    # Load Data
+    df_train, df_dev, df_test = load_data(args.data_path)
+
+    results = compare_few_shot_formats(df_train, df_test, args.few_shot_num)
+
+    print(f"{len(df_test)} test events, few_shot_num: {args.few_shot_num}")
+    for result in results:
+        print(
+            f"{result['stage']} ({result['few_shot_format']}): prompts: {result['prompts']}; "
+            f"prompt tokens: {result['prompt_tokens']}; tokens per prompt: {result['tokens_per_prompt']}"
+        )
+    full = {result["stage"]: result for result in results if result["few_shot_format"] == "full"}
+    for result in results:
+        if result["few_shot_format"] == "compact":
+            print(f"{result['stage']}: compact / full prompt tokens x{result['prompt_tokens'] / max(1, full[result['stage']]['prompt_tokens']):.2f}")
+
+
+if __name__ == "__main__":
+    main()
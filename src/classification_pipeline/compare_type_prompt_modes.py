@@ -0,0 +1,112 @@
+"""
+Compare the "per_label" and "fused" event type prompt modes on the CEHA test split.
+
+For each mode, reports the number of LLM calls, the number of prompt tokens, the wall-clock time and the
+precision / recall / F1 of the event type classification of the relevant test events.
+
+Usage (from the repository root):
+    python -m src.classification_pipeline.compare_type_prompt_modes --llm_name gpt4 --openai_api_key <key>
+"""
+import argparse
+import copy
+import time
+
+from .event_type_classification import (
+    TYPE_PROMPT_MODES,
+    build_event_type_prompts,
+    predict_event_type,
+    sample_event_type_few_shot_examples,
+)
+from ..utils.evaluation import event_type_scorer_type
+from ..utils.llm_dispatch import EXECUTION_MODES
+from ..utils.utils import count_prompt_tokens, load_data
+
+
+def compare_type_prompt_modes(args, df_train, df_test):
+    """
+    Runs the event type classification of `df_test` once per prompt mode.
+
+    Returns:
+        list: One dict per prompt mode with the calls, prompt tokens, seconds and scores of the run.
+    """
+    few_shot_examples = sample_event_type_few_shot_examples(df_train, args.few_shot_num)
+    results = []
+    for type_prompt_mode in TYPE_PROMPT_MODES:
+        prompts = []
+        for i in df_test.to_dict("records"):
+            prompts.extend(build_event_type_prompts(i, args.few_shot_num, few_shot_examples, type_prompt_mode))
+
+        mode_args = copy.copy(args)
+        mode_args.type_prompt_mode = type_prompt_mode
+        start = time.time()
+        all_gold_labels, all_sys_labels = predict_event_type(mode_args, df_train, df_test)
+        seconds = time.time() - start
+
+        scores = event_type_scorer_type(all_sys_labels, all_gold_labels)["overall"]
+        results.append(
+            {
+                "type_prompt_mode": type_prompt_mode,
+                "llm_calls": len(prompts),
+                "prompt_tokens": sum(count_prompt_tokens(prompt) for prompt in prompts),
+                "seconds": round(seconds, 2),
+                "precision": scores["precision"],
+                "recall": scores["recall"],
+                "f1": scores["f1"],
+            }
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the event type prompt modes on the CEHA test split")
+    parser.add_argument("--data_path", type=str, default="data/CEHA_dataset.csv", help="path of the CEHA dataset")
+    parser.add_argument("--llm_name", type=str, default="gpt4", help="llm name")
+    parser.add_argument(
+        "--max_tokens", type=int, default=512, help="max tokens for llm"
+    )
+    parser.add_argument(
+        "--temperature", type=float, default=0.0, help="temperature of llm"
+    )
+    parser.add_argument(
+        "--few_shot_num", type=int, default=0, help="number of few shot examples"
+    )
+    parser.add_argument(
+        "--openai_api_key", type=str, default=None, help="openai api key"
+    )
+    parser.add_argument(
+        "--mistralai_api_key", type=str, default=None, help="mistral.ai api key"
+    )
+    parser.add_argument(
+        "--mistralai_rps", type=float, default=0, help="mistral.ai request per second limit"
+    )
+    parser.add_argument(
+        "--execution_mode", type=str, default="async", choices=[mode for mode in EXECUTION_MODES if mode != "batch"], help="how LLM calls are executed"
+    )
+    parser.add_argument(
+        "--max_concurrency", type=int, default=8, help="max number of concurrent LLM calls in async mode"
+    )
+    args = parser.parse_args()
+
+    # Load Data
+    df_train, df_dev, df_test = load_data(args.data_path)
+    df_train = df_train[df_train["Is the event relevant?_DM"] == "Yes"]
+    df_test = df_test[df_test["Is the event relevant?_DM"] == "Yes"]
+
+    results = compare_type_prompt_modes(args, df_train, df_test)
+
+    print(f"{len(df_test)} relevant test events, llm: {args.llm_name}, few_shot_num: {args.few_shot_num}")
+    for result in results:
+        print(
+            f"{result['type_prompt_mode']}: calls: {result['llm_calls']}; prompt tokens: {result['prompt_tokens']}; "
+            f"seconds: {result['seconds']}; precision: {result['precision'][:-1]}; recall: {result['recall'][:-1]}; f1: {result['f1'][:-1]}"
+        )
+    per_label, fused = results
+    print(
+        f"fused / per_label: calls x{fused['llm_calls'] / max(1, per_label['llm_calls']):.2f}; "
+        f"prompt tokens x{fused['prompt_tokens'] / max(1, per_label['prompt_tokens']):.2f}; "
+        f"seconds x{fused['seconds'] / max(0.01, per_label['seconds']):.2f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Report the LLM calls saved by the cascade classifier against the precision / recall lost, on the CEHA dev and test splits.
+
+The cascade classifier is trained on the train split. The LLM labels every event of a split once; the labels of
+each (low_threshold, high_threshold) pair are then the cascade labels of the confident events and the LLM labels
+of the others, so the whole grid costs a single LLM run per split.
+
+Usage (from the repository root):
+    python -m src.classification_pipeline.evaluate_cascade --llm_name gpt4 --openai_api_key <key>
+"""
+import argparse
+
+from .cascade_classifier import CascadeClassifier, cascade_labels
+from .event_relevance_classification import predict_event_relevance
+from ..utils.evaluation import event_type_scorer
+from ..utils.llm_dispatch import EXECUTION_MODES
+from ..utils.utils import load_data
+
+LOW_THRESHOLDS = [0.1, 0.2, 0.3, 0.4]
+HIGH_THRESHOLDS = [None, 0.9, 0.8, 0.7]
+
+
+def _scores(system_labels, gold_labels):
+    return {key: float(value[:-1]) for key, value in event_type_scorer(system_labels, gold_labels).items()}
+
+
+def evaluate_cascade(args, df_train, df_eval, low_thresholds=LOW_THRESHOLDS, high_thresholds=HIGH_THRESHOLDS):
+    """
+    Trains the cascade classifier on `df_train` and evaluates every threshold pair on `df_eval`.
+
+    Returns:
+        tuple:
+            - llm_scores (dict): Precision / recall / F1 of the LLM alone, in percent.
+            - results (list): One dict per threshold pair with the LLM calls left, the share of LLM calls saved
+              and the precision / recall / F1 of the cascade, with their difference to the LLM alone (negative when points are lost).
+    """
+    classifier = CascadeClassifier().fit(df_train)
+    scores = classifier.predict_proba(df_eval.to_dict("records"))
+    gold_labels, llm_labels = predict_event_relevance(args, df_train, df_eval)
+    llm_scores = _scores(llm_labels, gold_labels)
+
+    results = []
+    for high_threshold in high_thresholds:
+        for low_threshold in low_thresholds:
+            labels = cascade_labels(scores, low_threshold, high_threshold)
+            system_labels = [llm_label if label is None else label for label, llm_label in zip(labels, llm_labels)]
+            cascade_scores = _scores(system_labels, gold_labels)
+            skipped = sum(label is not None for label in labels)
+            results.append(
+                {
+                    "low_threshold": low_threshold,
+                    "high_threshold": high_threshold,
+                    "llm_calls": len(labels) - skipped,
+                    "calls_saved": round(skipped / max(1, len(labels)), 4),
+                    **cascade_scores,
+                    **{f"{key}_delta": round(value - llm_scores[key], 2) for key, value in cascade_scores.items()},
+                }
+            )
+    return llm_scores, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the cascade classifier on the CEHA dev and test splits")
+    parser.add_argument("--data_path", type=str, default="data/CEHA_dataset.csv", help="path of the CEHA dataset")
+    parser.add_argument("--llm_name", type=str, default="gpt4", help="llm name")
+    parser.add_argument(
+        "--max_tokens", type=int, default=512, help="max tokens for llm"
+    )
+    parser.add_argument(
+        "--temperature", type=float, default=0.0, help="temperature of llm"
+    )
+    parser.add_argument(
+        "--few_shot_num", type=int, default=0, help="number of few shot examples"
+    )
+    parser.add_argument(
+        "--openai_api_key", type=str, default=None, help="openai api key"
+    )
+    parser.add_argument(
+        "--mistralai_api_key", type=str, default=None, help="mistral.ai api key"
+    )
+    parser.add_argument(
+        "--mistralai_rps", type=float, default=0, help="mistral.ai request per second limit"
+    )
+    parser.add_argument(
+        "--execution_mode", type=str, default="async", choices=[mode for mode in EXECUTION_MODES if mode != "batch"], help="how LLM calls are executed"
+    )
+    parser.add_argument(
+        "--max_concurrency", type=int, default=8, help="max number of concurrent LLM calls in async mode"
+    )
+    parser.add_argument(
+        "--llm_cache_path", type=str, default=None, help="path of the LLM response cache, to rerun the report without new LLM calls"
+    )
+    args = parser.parse_args()
+    if args.llm_cache_path:
+        args.llm_cache = {"path": args.llm_cache_path}
+
+    # Load Data
+    df_train, df_dev, df_test = load_data(args.data_path)
+
+    for split, df_eval in [("dev", df_dev), ("test", df_test)]:
+        llm_scores, results = evaluate_cascade(args, df_train, df_eval)
+        print(
+            f"{split}: {len(df_eval)} events, llm: {args.llm_name}; LLM only precision: {llm_scores['precision']:.2f}; "
+            f"recall: {llm_scores['recall']:.2f}; f1: {llm_scores['f1']:.2f}"
+        )
+        for result in results:
+            print(
+                f"  low: {result['low_threshold']}; high: {result['high_threshold']}; llm calls: {result['llm_calls']}; "
+                f"calls saved: {100 * result['calls_saved']:.1f}%; precision: {result['precision']:.2f} ({result['precision_delta']:+.2f}); "
+                f"recall: {result['recall']:.2f} ({result['recall_delta']:+.2f}); f1: {result['f1']:.2f} ({result['f1_delta']:+.2f})"
+            )
+
+
+if __name__ == "__main__":
+    main()
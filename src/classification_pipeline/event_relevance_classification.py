@@ -1,40 +1,172 @@
 import argparse
+import os
 import random
-import time
 from textwrap import dedent
 
-import openai
-from tqdm import tqdm
 
+from .cascade_classifier import cascade_relevance
+from .rule_engine import get_rule_engine
+from ..utils.checkpoint import EventCheckpoint, event_key, get_prediction_checkpoint
 from ..utils.evaluation import event_type_scorer
-from ..utils.llm_backbone import MistralAiLLMCaller, OpenAILLMCaller
+from ..utils.llm_backbone import RetryPolicy, get_circuit_breaker, get_rate_limiter
+from ..utils.llm_backends import create_llm_caller, get_llm_backend
+from ..utils.llm_cache import CachedLLMCaller, get_llm_cache
+from ..utils.llm_cassette import CASSETTE_MODES, CassetteLLMCaller, get_llm_cassette
+from ..utils.llm_dispatch import EXECUTION_MODES, dispatch_audited_llm_calls, dispatch_llm_calls, sample_audit_events
+from ..utils.llm_hedging import HedgedLLMCaller, create_hedged_llm_caller
+from ..utils.llm_metrics import get_answer_sources, get_hedge_stats, get_llm_usage, get_truncation_stats
+from ..utils.llm_packing import dispatch_packed_llm_calls
+from ..utils.llm_telemetry import get_llm_telemetry
+from ..utils.prompt_compiler import few_shot_key, get_prompt_compiler
 from ..utils.prompts import (
-    databricks_llm_prompt,
-    databricks_llm_prompt_chat,
+    ANSWER_MODES,
+    FEW_SHOT_FORMATS,
+    PROMPT_LAYOUTS,
+    answer_stop_sequence,
+    apply_prompt_layout_examples,
+    databricks_llm_prompt_packed,
+    databricks_llm_prompt_prefix,
     format_prompt,
+    format_prompt_few_shot,
+    format_prompt_packed,
+    format_system_prompt_compact,
+    format_user_prompt,
+    generate_few_shot_packed,
     generate_few_shot_prompt_list,
+    get_answer_mode_prompt_format,
     system_prompt,
 )
-from ..utils.utils import extract_between_tags, load_data
+from ..utils.utils import extract_answer_score, extract_between_tags, load_data, truncate_event_descriptions
 from ..db_utils import configure_default_logger
 
 # Configure logging
 logger = configure_default_logger()
 
-def predict_event_relevance(args, df_train, df_test):
+def sample_event_relevance_few_shot_examples(df_train, few_shot_num):
+    """
+    Randomly selects `few_shot_num` relevant and `few_shot_num` not relevant few-shot examples.
+    """
+    # randomly select few-shot examples
+    rng = random.Random(42)
+    if few_shot_num > 0:
+        df_train_pos = df_train[df_train["Is the event relevant?_DM"] == "Yes"]
+        df_train_neg = df_train[df_train["Is the event relevant?_DM"] != "Yes"]
+
+        few_shot_examples = {"pos": [], "neg": []}
+        random_train_pos = rng.sample(range(0, len(df_train_pos)), few_shot_num)
+        random_train_neg = rng.sample(range(0, len(df_train_neg)), few_shot_num)
+        few_shot_examples["pos"] = df_train_pos.iloc[random_train_pos]
+        few_shot_examples["neg"] = df_train_neg.iloc[random_train_neg]
+        return few_shot_examples
+    return None
+
+
+def build_event_relevance_prompt_prefix(few_shot_num=0, few_shot_examples=None, prompt_layout="original", few_shot_format="full", answer_mode="reason"):
+    """
+    Builds the messages shared by the prompts of all the events: the system prompt and the few-shot turns.
+    In the "compact" few-shot format the guidelines are written once in the system prompt.
+    The prefix is rendered once per run by the prompt compiler, do not modify it.
+    """
+
+    def render():
+        pos_examples, neg_examples = [], []
+        if few_shot_num > 0:
+            _, pos_examples, neg_examples = generate_few_shot_prompt_list("", "", few_shot_examples)
+        stage_system_prompt = dedent(system_prompt).strip()
+        if few_shot_format == "compact":
+            format_event_prompt = get_answer_mode_prompt_format(format_prompt_few_shot if few_shot_num > 0 else format_prompt, answer_mode)
+            stage_system_prompt = dedent(format_system_prompt_compact(stage_system_prompt, format_event_prompt("", ""))).strip()
+        return databricks_llm_prompt_prefix(
+            stage_system_prompt,
+            apply_prompt_layout_examples(pos_examples, prompt_layout, few_shot_format),
+            apply_prompt_layout_examples(neg_examples, prompt_layout, few_shot_format),
+        )
+
+    key = ("event_relevance", few_shot_num, few_shot_key(few_shot_examples) if few_shot_num > 0 else None, prompt_layout, few_shot_format, answer_mode)
+    return get_prompt_compiler().compile(key, render)
+
+
+def build_event_relevance_prompt(i, few_shot_num=0, few_shot_examples=None, prompt_prefix=None, prompt_layout="original", few_shot_format="full", answer_mode="reason"):
+    """
+    Builds the LLM prompt of an event. `prompt_prefix` is the prefix built by `build_event_relevance_prompt_prefix`
+    with the same options, pass it to avoid rebuilding the few-shot turns for every event.
+    In the "answer_only" answer mode the prompt does not ask for a reason.
+    """
+    if prompt_prefix is None:
+        prompt_prefix = build_event_relevance_prompt_prefix(few_shot_num, few_shot_examples, prompt_layout, few_shot_format, answer_mode)
+    format_event_prompt = get_answer_mode_prompt_format(format_prompt_few_shot if few_shot_num > 0 else format_prompt, answer_mode)
+    i["prompt"] = format_event_prompt(i["Event Description"], i["Country"])
+    return prompt_prefix + [
+        {"role": "user", "content": dedent(format_user_prompt(i["prompt"], prompt_layout, few_shot_format)).strip()}
+    ]
+
+
+def predict_event_relevance(args, df_train, df_test, return_scores=False):
     """
     Predicts the relevance of events in the given test dataset using a specified 
     language model (LLM) and zero-shot/few-shot learning if specified.
 
     Args:
         args: 
-            - llm_name (str, default="gpt4"): Name of the LLM to use ("mistral", "gpt4"). 
+            - llm_name (str, default="gpt4"): Name of the LLM backend to use: "mistral", "gpt4" or a backend of llm_backends.
+            - llm_backends (dict, default={}): LLM backends by name in addition to the built-in ones, e.g. self-hosted OpenAI compatible
+              servers or local models, see get_llm_backend.
+            - api_keys (dict, default={}): Api keys by secret name, for the backends authenticated with api_key_secret.
             - max_tokens (int, default=512): Maximum number of tokens for LLM responses.
             - temperature (float, default=0.0): Sampling temperature for LLM.
+            - top_p (float, default=None): Nucleus sampling parameter of the LLM, 0.001 if not provided.
             - few_shot_num (int, default=0): Number of few-shot examples to include in the prompts.
             - openai_api_key (str, default=None): API key for OpenAI (if using GPT models).
             - mistralai_api_key (str, default=None): API key for Mistral.ai (if using mistral models).
-            - mistralai_rps (float, default=0): Request per second limit for Mistral.ai (if using mistral models).
+            - mistralai_rps (float, default=0): Request per second limit for Mistral.ai (if using mistral models). Used when rate_limit does not set requests_per_second.
+            - rate_limit (dict, default={}): Keyword arguments of the AdaptiveRateLimiter shared by all the callers of the LLM,
+              e.g. requests_per_second, tokens_per_minute, max_concurrency.
+            - llm_cache (dict, default=None): Keyword arguments of the on-disk LLM response cache (path, max_entries, read_only).
+              No cache is used if not provided.
+            - llm_cassette (dict, default=None): Keyword arguments of the LLM cassette (path, mode, replay_latency, latency_scale).
+              In "record" mode the LLM calls are recorded with their latency and usage, in "replay" mode they are answered from
+              the cassette without any LLM client or api key. The calls of the "batch" execution mode are then sent one by one.
+            - execution_mode (str, default="sequential"): "sequential", "async" or "batch". In "async" mode the LLM calls are sent concurrently, in "batch" mode they are sent to the provider batch API.
+            - max_concurrency (int, default=8): Maximum number of concurrent LLM calls in "async" mode.
+            - batch_state_dir (str, default=None): Folder of the batch job state, required in "batch" mode.
+            - batch_poll_interval (float, default=60): Seconds between two status checks of the batch job in "batch" mode.
+            - request_timeout (float, default=180): Timeout of a LLM request in seconds.
+            - retry (dict, default={}): Keyword arguments of the RetryPolicy of the failed LLM requests
+              (max_retries, backoff_seconds, max_backoff_seconds, deadline).
+            - circuit_breaker (dict, default={}): Keyword arguments of the CircuitBreaker shared by all the callers of the LLM
+              (failure_threshold, reset_seconds).
+            - hedging (dict, default=None): Keyword arguments of the HedgedLLMCaller sending a duplicate request for the slow calls
+              (percentile, min_delay, alternate_llm_name, ...), see create_hedged_llm_caller. No hedging if not provided.
+            - http_pool (dict, default=None): Settings of the HTTP connection pool shared by all the callers of the LLM
+              (max_connections, max_keepalive_connections, keepalive_expiry, http2).
+            - pack_size (int, default=1): Maximum number of events classified per LLM request. 1 disables packing, 0 means no limit (pack_max_tokens must be set).
+              Events missing from a packed answer are asked again one by one.
+            - pack_max_tokens (int, default=0): Maximum number of prompt tokens of a packed LLM request, 0 means no limit.
+            - prompt_layout (str, default="original"): "original" or "prefix_cache". With "prefix_cache" the article comes last in the prompts,
+              so that all the prompts share their system prompt, guidelines and few-shot turns as a byte-identical prefix the provider can cache.
+            - max_description_tokens (int, default=0): Token budget of the event descriptions. Longer descriptions are cut to their leading
+              sentences that fit in the budget before prompting, 0 means no limit.
+            - few_shot_format (str, default="full"): "full" or "compact". "compact" writes the guidelines, the question and the answer format
+              once in the system prompt and the few-shot and event turns only carry the article and its country. Packed prompts are not affected.
+            - cascade (dict, default=None): Keyword arguments of the local cascade classifier run before the LLM
+              (model_path, train_data_path, low_threshold, high_threshold, retrain). Events scored below low_threshold are labeled "No"
+              and events scored at or above high_threshold are labeled "Yes" without any LLM call. No cascade is used if not provided.
+            - answer_mode (str, default="reason"): "reason", "answer_only" or "score". "answer_only" prompts do not ask for a reason, and their generation
+              is limited to answer_max_tokens and stops at the closing answer tag. Packed requests do not ask for reasons in either mode.
+              "score" prompts ask for a single-word answer and a single token is generated with its logprobs: the probability of "Yes"
+              is the score of the event, labeled "Yes" if the score is at least score_threshold. Providers without logprobs (Mistral)
+              score 1.0 or 0.0 from the answer. Packing is not supported in "score" mode.
+            - answer_max_tokens (int, default=16): Maximum number of tokens of the LLM responses in "answer_only" mode.
+            - answer_audit_fraction (float, default=0): Share of the events still asked for a reason in "answer_only" and "score" modes, with max_tokens.
+              Their answers are logged to audit the answer-only labels.
+            - score_threshold (float, default=0.5): Threshold of the scores in "score" mode, see tune_score_thresholds to tune it on the CEHA dev split.
+            - checkpoint_path (str, default=None): Path of the PredictionCheckpoint of the run. The answers of each event are appended to it
+              as soon as the event is answered, and the events already in it (with the same requests) are not sent again when the run
+              is resumed. No checkpoint is used if not provided.
+            - checkpoint_resume_paths (list, default=None): Other checkpoints of the run whose events are resumed too, e.g. those of the
+              other partitions of a Spark run, see PredictionCheckpoint.
+            - rules_path (str, default=None): Path of the YAML rules deciding the relevance of the events from their structured fields,
+              see rule_engine. The decided events are labeled without any LLM call, before the cascade. No rules are used if not provided.
 
         df_train (pd.DataFrame): 
             A DataFrame containing training data with event descriptions and their relevance labels. 
@@ -43,6 +175,9 @@ def predict_event_relevance(args, df_train, df_test):
         df_test (pd.DataFrame): 
             A DataFrame containing test data with event descriptions. 
 
+        return_scores (bool, default=False):
+            Also return the relevance score of each event.
+
     Returns:
         tuple:
             - all_gold_labels (list): A list of ground truth relevance labels ("Yes" or "No")
@@ -50,78 +185,211 @@ def predict_event_relevance(args, df_train, df_test):
               Otherwise, this list will be empty.
             - all_sys_labels (list): A list of predicted relevance labels ("Yes" or "No")
               generated by the LLM for the test dataset.
+            - all_scores (list): Only if `return_scores` is set. The probability of "Yes" of each event in "score" mode
+              (the rule or cascade score for the events labeled by the rules or the cascade classifier), None otherwise.
 
     Notes:
         - This function uses different LLM backends based on the specified `llm_name`. Please refer to the instruction to set up correct access.
         - The relevance labels are expected to be in the format "Yes" or "No".   
     """
-    model_id_dic = {
-        "gpt4": "gpt-4o",
-        "mistral": "mistral-large-latest",
-    }
+    # Backend of the LLM: a built-in one ("gpt4", "mistral") or one of the llm_backends config
+    backend = get_llm_backend(args.llm_name, getattr(args, "llm_backends", None))
 
-    # randomly select few-shot examples
-    random.seed(42)
-    if args.few_shot_num > 0:
-        df_train_pos = df_train[df_train["Is the event relevant?_DM"] == "Yes"]
-        df_train_neg = df_train[df_train["Is the event relevant?_DM"] != "Yes"]
+    few_shot_examples = sample_event_relevance_few_shot_examples(df_train, args.few_shot_num)
 
-        few_shot_examples = {"pos": [], "neg": []}
-        random_train_pos = random.sample(range(0, len(df_train_pos)), args.few_shot_num)
-        random_train_neg = random.sample(range(0, len(df_train_neg)), args.few_shot_num)
-        few_shot_examples["pos"] = df_train_pos.iloc[random_train_pos]
-        few_shot_examples["neg"] = df_train_neg.iloc[random_train_neg]
+    # Rate limiter shared with the other stages using the same LLM. mistralai_rps is the requests per second limit of Mistral.ai
+    rate_limit_config = dict(getattr(args, "rate_limit", None) or {})
+    if backend["provider"] == "mistral" and args.mistralai_rps and not rate_limit_config.get("requests_per_second"):
+        rate_limit_config["requests_per_second"] = args.mistralai_rps
+    rate_limiter = get_rate_limiter(args.llm_name, **rate_limit_config)
 
-    if args.llm_name == "mistral":
-        # Define LLM
-        llm_caller = MistralAiLLMCaller(mistralai_api_key=args.mistralai_api_key, model_name=model_id_dic["mistral"], timeout=180)
-    elif args.llm_name == "gpt4":
+    # Retries of transient errors, bounded by the deadline of the run, and circuit breaker shared with the other stages using the same LLM
+    retry_policy = RetryPolicy(**(getattr(args, "retry", None) or {}))
+    circuit_breaker = get_circuit_breaker(args.llm_name, **(getattr(args, "circuit_breaker", None) or {}))
+    request_timeout = getattr(args, "request_timeout", 180)
+    # Token usage of the stage, including the prompt tokens served from the provider prefix cache
+    usage = get_llm_usage("event_relevance")
+    # Latency, tokens, retries and parse failures of the calls, reported at the end of the run
+    telemetry = get_llm_telemetry().stage("event_relevance", args.llm_name, backend["model_name"])
+
+    # Record the LLM calls to a cassette, or replay them offline without calling the LLM
+    cassette = get_llm_cassette(**args.llm_cassette) if getattr(args, "llm_cassette", None) else None
+
+    # Serve repeated prompts from the on-disk response cache. The hedged calls cache the LLM and its alternate separately
+    llm_cache = get_llm_cache(**args.llm_cache) if getattr(args, "llm_cache", None) else None
+
+    if cassette is not None and cassette.mode == "replay":
+        # No LLM client is created, no api key is needed
+        llm_caller = None
+    else:
         # Define LLM
-        llm_caller = OpenAILLMCaller(openai_api_key=args.openai_api_key, model_name=model_id_dic["gpt4"], timeout=180)
+        api_keys = {"openai_api_key": args.openai_api_key, "mistralai_api_key": args.mistralai_api_key, **(getattr(args, "api_keys", None) or {})}
+        llm_caller = create_llm_caller(backend, api_keys, timeout=request_timeout, rate_limiter=rate_limiter, retry_policy=retry_policy, circuit_breaker=circuit_breaker, http_pool=getattr(args, "http_pool", None), usage=usage, telemetry=telemetry)
+        # Hedge the slow calls, and fail over to the alternate LLM while the circuit of the LLM is open. Batch jobs are not hedged
+        if getattr(args, "hedging", None) and getattr(args, "execution_mode", "sequential") != "batch":
+            llm_caller = create_hedged_llm_caller(
+                llm_caller, args.hedging, get_hedge_stats("event_relevance"), getattr(args, "llm_backends", None), api_keys, getattr(args, "circuit_breaker", None),
+                usage=usage, llm_cache=llm_cache, timeout=request_timeout, retry_policy=retry_policy, http_pool=getattr(args, "http_pool", None), telemetry=telemetry,
+            )
+
+    if llm_cache is not None and llm_caller is not None and not isinstance(llm_caller, HedgedLLMCaller):
+        llm_caller = CachedLLMCaller(llm_caller, llm_cache)
+    if cassette is not None:
+        llm_caller = CassetteLLMCaller(cassette, llm_caller, backend["model_name"], usage, telemetry)
 
     # Define sampling parameters
     sampling_params = {
         "max_tokens": args.max_tokens,
         "temperature": args.temperature,
     }
+    if getattr(args, "top_p", None) is not None:
+        sampling_params["top_p"] = args.top_p
 
     # evaluation
     all_gold_labels = []
     all_sys_labels = []
+    all_scores = []
     evaluation_flag = True if "Is the event relevant?_DM" in df_test else False
 
+    records = df_test.to_dict("records")
+    # Events decided by the rules on their structured fields, then those the local cascade classifier is confident about, are labeled without the LLM
+    rules_path = getattr(args, "rules_path", None)
+    event_rule_decisions = get_rule_engine(rules_path).decisions(df_test, "event_relevance") if rules_path else [{}] * len(records)
+    cascade_config = getattr(args, "cascade", None)
+    event_cascade_labels = cascade_relevance(records, **cascade_config) if cascade_config else [None] * len(records)
+    event_cascade_labels = [
+        decisions["relevance"]["answer"] if "relevance" in decisions else cascade_label for decisions, cascade_label in zip(event_rule_decisions, event_cascade_labels)
+    ]
+    llm_records = [i for i, cascade_label in zip(records, event_cascade_labels) if cascade_label is None]
+    # Long descriptions are cut to the token budget of the stage, which bounds the size of the requests
+    max_description_tokens = getattr(args, "max_description_tokens", 0)
+    truncation_stats = get_truncation_stats("event_relevance")
+    if max_description_tokens:
+        truncate_event_descriptions(llm_records, max_description_tokens, truncation_stats)
 
-    for i in tqdm(df_test.to_dict("records")):
-        i["llm_answer"] = None
+    prompt_layout = getattr(args, "prompt_layout", "original")
+    few_shot_format = getattr(args, "few_shot_format", "full")
+    answer_mode = getattr(args, "answer_mode", "reason")
+    if answer_mode == "score" and getattr(args, "pack_size", 1) != 1:
+        raise ValueError("Packing is not supported in score answer_mode, pack_size must be 1")
+    score_threshold = getattr(args, "score_threshold", 0.5)
+    # The system prompt and the few-shot turns are the same for all the events, build them once
+    prompt_prefix = build_event_relevance_prompt_prefix(args.few_shot_num, few_shot_examples, prompt_layout, few_shot_format, answer_mode)
+    input_prompts = [
+        build_event_relevance_prompt(i, args.few_shot_num, few_shot_examples, prompt_prefix, prompt_layout, few_shot_format, answer_mode)
+        for i in llm_records
+    ]
+    # Events answered before an interruption of the run are read from the checkpoint, only the others are sent to the LLM
+    checkpoint = get_prediction_checkpoint(args.checkpoint_path, getattr(args, "checkpoint_resume_paths", None) or ()) if getattr(args, "checkpoint_path", None) else None
+    event_checkpoint = EventCheckpoint(
+        checkpoint, "event_relevance", llm_records, input_prompts, 1, backend["model_name"],
+        {**sampling_params, "answer_mode": answer_mode, "answer_max_tokens": getattr(args, "answer_max_tokens", 16), "pack_size": getattr(args, "pack_size", 1)},
+    )
+    pending_records = event_checkpoint.pending_events(llm_records)
+    input_prompts = event_checkpoint.pending_prompts(input_prompts)
+    pending_sources = []
+
+    dispatch_options = {
+        "execution_mode": getattr(args, "execution_mode", "sequential"),
+        "max_concurrency": getattr(args, "max_concurrency", 8),
+        "batch_state_path": os.path.join(args.batch_state_dir, "event_relevance_batch_state.json") if getattr(args, "batch_state_dir", None) else None,
+        "batch_poll_interval": getattr(args, "batch_poll_interval", 60),
+        "on_answer": event_checkpoint.on_answer,
+        "answer_sources": pending_sources,
+    }
+    pack_size = getattr(args, "pack_size", 1)
+    if pack_size != 1:
+        # Several events per request, the few-shot examples are packed the same way
+        def render_packed_example():
+            _, pos_examples, neg_examples = generate_few_shot_prompt_list("", "", few_shot_examples)
+            return generate_few_shot_packed(pos_examples, neg_examples, ["answer"], prompt_layout)
+
+        packed_example = None
         if args.few_shot_num > 0:
-            i["prompt"], pos_examples, neg_examples = generate_few_shot_prompt_list(
-                i["Event Description"], i["Country"], few_shot_examples
-            )
-            input_prompt = databricks_llm_prompt_chat(
-                dedent(system_prompt).strip(),
-                dedent(i["prompt"]).strip(),
-                pos_examples,
-                neg_examples,
+            packed_example = get_prompt_compiler().compile(
+                ("event_relevance_packed", args.few_shot_num, few_shot_key(few_shot_examples), prompt_layout), render_packed_example
             )
+
+        def build_packed_prompts(event_indices):
+            packed_prompt = format_prompt_packed([pending_records[idx]["prompt"] for idx in event_indices], ["answer"], prompt_layout)
+            return [databricks_llm_prompt_packed(dedent(system_prompt).strip(), dedent(packed_prompt).strip(), packed_example)]
+
+        llm_answers = dispatch_packed_llm_calls(
+            llm_caller,
+            input_prompts,
+            build_packed_prompts,
+            [["answer"]],
+            sampling_params,
+            pack_size=pack_size,
+            pack_max_tokens=getattr(args, "pack_max_tokens", 0),
+            **dispatch_options,
+        )
+    elif answer_mode in ["answer_only", "score"]:
+        if answer_mode == "answer_only":
+            # Only the answer is generated: few output tokens, and the generation stops at the closing answer tag
+            format_event_prompt = format_prompt_few_shot if args.few_shot_num > 0 else format_prompt
+            answer_sampling_params = {
+                **sampling_params,
+                "max_tokens": getattr(args, "answer_max_tokens", 16),
+                "stop": [answer_stop_sequence(format_event_prompt("", ""))],
+            }
         else:
-            pos_examples, neg_examples = [], []
-            i["prompt"] = format_prompt(i["Event Description"], i["Country"])
-            input_prompt = databricks_llm_prompt(
-                dedent(system_prompt).strip(), dedent(i["prompt"]).strip()
-            )
-        # Wait for some time between requests for Mistral.ai to avoid rate limit
-        if args.llm_name == "mistral" and args.mistralai_rps:
-            time.sleep(1/args.mistralai_rps)
-        i["llm_answer"] = llm_caller(input_prompt, sampling_params)[0].strip()
-
-        assert i["llm_answer"] is not None
-        try:
-            i["llm_answer_parsed_relevance"] = extract_between_tags(
-            "answer", i["llm_answer"]
-        )[0]
-        except:
-            i["llm_answer_parsed_relevance"] = ""
-            logger.info(f"LLM answer not in expected pattern for {i['ACLED/GDELT']}, {i['index']}, {i['Event Description']}, defaulting to no")
+            # A single token is generated, the probability of "Yes" is read from the logprobs of the first token
+            answer_sampling_params = {**sampling_params, "max_tokens": 1, "logprobs": True, "top_logprobs": 5}
+        # The events sampled for audit are still asked for a reason
+        audit_flags = sample_audit_events(
+            len(pending_records), getattr(args, "answer_audit_fraction", 0), keys=[event_key(i) for i in pending_records]
+        )
+        audit_prompts = [
+            build_event_relevance_prompt(dict(i), args.few_shot_num, few_shot_examples, None, prompt_layout, few_shot_format) if audited else None
+            for i, audited in zip(pending_records, audit_flags)
+        ]
+        llm_answers = dispatch_audited_llm_calls(llm_caller, input_prompts, audit_prompts, audit_flags, answer_sampling_params, sampling_params, **dispatch_options)
+        for i, audited, llm_answer in zip(pending_records, audit_flags, llm_answers):
+            if audited:
+                logger.info(f"Audited LLM answer for {i['ACLED/GDELT']}, {i['Index']}: {llm_answer}")
+    else:
+        llm_answers = dispatch_llm_calls(llm_caller, input_prompts, sampling_params, **dispatch_options)
+    llm_answers = event_checkpoint.merge_answers(llm_answers)
+    llm_sources = iter(event_checkpoint.merge_sources(pending_sources))
+    if checkpoint is not None:
+        logger.info(f"Checkpoint stats: {checkpoint.stats()}")
+    if llm_cache is not None:
+        logger.info(f"LLM cache stats: {llm_cache.stats()}")
+    if cassette is not None:
+        logger.info(f"LLM cassette stats: {cassette.stats()}")
+    logger.info(f"LLM retry stats: {retry_policy.stats()}, circuit breaker: {circuit_breaker.state}")
+    logger.info(f"LLM usage: {usage.stats()}")
+    if max_description_tokens:
+        logger.info(f"Event description truncation: {truncation_stats.stats()}")
+
+    llm_answers = iter(llm_answers)
+    answer_sources = []
+    for i, cascade_label, decisions in zip(records, event_cascade_labels, event_rule_decisions):
+        i["llm_score_relevance"] = None
+        answer_sources.append(["rule" if "relevance" in decisions else "cascade"] if cascade_label is not None else [next(llm_sources)])
+        if cascade_label is not None:
+            i["llm_answer_parsed_relevance"] = cascade_label
+            if answer_mode == "score":
+                i["llm_score_relevance"] = decisions["relevance"]["score"] if "relevance" in decisions else i["cascade_score"]
+        elif answer_mode == "score":
+            i["llm_answer"] = next(llm_answers)
+            i["llm_score_relevance"] = extract_answer_score(i["llm_answer"])
+            if not extract_between_tags("answer", i["llm_answer"]):
+                telemetry.record_parse_failures()
+            i["llm_answer_parsed_relevance"] = "Yes" if i["llm_score_relevance"] >= score_threshold else "No"
+        else:
+            i["llm_answer"] = next(llm_answers)
+
+            assert i["llm_answer"] is not None
+            try:
+                i["llm_answer_parsed_relevance"] = extract_between_tags(
+                "answer", i["llm_answer"]
+            )[0]
+            except:
+                i["llm_answer_parsed_relevance"] = ""
+                telemetry.record_parse_failures()
+                logger.info(f"LLM answer not in expected pattern for {i['ACLED/GDELT']}, {i['Index']}, {i['Event Description']}, defaulting to no")
         
         if evaluation_flag:
             gold_label = "Yes" if i["Is the event relevant?_DM"] == "Yes" else "No"
@@ -131,7 +399,12 @@ def predict_event_relevance(args, df_train, df_test):
             "Yes" if i["llm_answer_parsed_relevance"].strip().lower() == "yes" else "No"
         )
         all_sys_labels.append(system_label)
-    
+        all_scores.append(i["llm_score_relevance"])
+    # The ledger of the predictions reports the LLM calls its reused predictions save, see ledger_run_report
+    get_answer_sources("event_relevance").record([event_key(i) for i in records], answer_sources)
+
+    if return_scores:
+        return all_gold_labels, all_sys_labels, all_scores
     return all_gold_labels, all_sys_labels
 
     
@@ -145,19 +418,91 @@ def main():
     parser.add_argument(
         "--temperature", type=float, default=0.0, help="temperature of llm"
     )
+    parser.add_argument(
+        "--top_p", type=float, default=None, help="top_p of llm"
+    )
     parser.add_argument(
         "--few_shot_num", type=int, default=0, help="number of few shot examples"
     )
     parser.add_argument(
         "--openai_api_key", type=str, default=None, help="openai api key"
     )
-    parser.add_augment(
+    parser.add_argument(
         "--mistralai_api_key", type=str, default=None, help="mistral.ai api key"
     )
-    parser.add_augment(
+    parser.add_argument(
         "--mistralai_rps", type=float, default=0, help="mistral.ai request per second limit"
     )
+    parser.add_argument(
+        "--execution_mode", type=str, default="sequential", choices=EXECUTION_MODES, help="how LLM calls are executed"
+    )
+    parser.add_argument(
+        "--max_concurrency", type=int, default=8, help="max number of concurrent LLM calls in async mode"
+    )
+    parser.add_argument(
+        "--batch_state_dir", type=str, default=None, help="folder of the batch job state in batch mode"
+    )
+    parser.add_argument(
+        "--request_timeout", type=float, default=180, help="timeout of a llm request in seconds"
+    )
+    parser.add_argument(
+        "--pack_size", type=int, default=1, help="max number of events per LLM request, 1 disables packing"
+    )
+    parser.add_argument(
+        "--pack_max_tokens", type=int, default=0, help="max number of prompt tokens per packed LLM request"
+    )
+    parser.add_argument(
+        "--prompt_layout", type=str, default="original", choices=PROMPT_LAYOUTS, help="prompt layout, prefix_cache puts the article last"
+    )
+    parser.add_argument(
+        "--max_description_tokens", type=int, default=0, help="token budget of the event descriptions, 0 means no limit"
+    )
+    parser.add_argument(
+        "--few_shot_format", type=str, default="full", choices=FEW_SHOT_FORMATS, help="few-shot format, compact writes the guidelines once"
+    )
+    parser.add_argument(
+        "--answer_mode", type=str, default="reason", choices=ANSWER_MODES, help="answer mode, answer_only does not ask for reasons, score reads the probability of Yes from the logprobs"
+    )
+    parser.add_argument(
+        "--answer_max_tokens", type=int, default=16, help="max tokens for llm in answer_only mode"
+    )
+    parser.add_argument(
+        "--answer_audit_fraction", type=float, default=0, help="share of the events still asked for a reason in answer_only mode"
+    )
+    parser.add_argument(
+        "--cassette_path", type=str, default=None, help="path of the LLM cassette to record or replay"
+    )
+    parser.add_argument(
+        "--cassette_mode", type=str, default="replay", choices=CASSETTE_MODES, help="record the LLM calls or replay them offline"
+    )
+    parser.add_argument(
+        "--score_threshold", type=float, default=0.5, help="threshold of the relevance scores in score mode"
+    )
+    parser.add_argument(
+        "--checkpoint_path", type=str, default=None, help="path of the checkpoint of the answered events, to resume an interrupted run"
+    )
+    parser.add_argument(
+        "--rules_path", type=str, default=None, help="path of the YAML rules deciding labels from the structured fields of the events"
+    )
+    parser.add_argument(
+        "--cascade_model_path", type=str, default=None, help="path of the cascade classifier run before the LLM, trained if missing"
+    )
+    parser.add_argument(
+        "--cascade_low_threshold", type=float, default=0.1, help="events scored below it by the cascade classifier are labeled No"
+    )
+    parser.add_argument(
+        "--cascade_high_threshold", type=float, default=None, help="events scored at or above it by the cascade classifier are labeled Yes"
+    )
     args = parser.parse_args()
+    if args.cassette_path:
+        args.llm_cassette = {"path": args.cassette_path, "mode": args.cassette_mode}
+    if args.cascade_model_path:
+        args.cascade = {
+            "model_path": args.cascade_model_path,
+            "train_data_path": "../../data/CEHA_dataset.csv",
+            "low_threshold": args.cascade_low_threshold,
+            "high_threshold": args.cascade_high_threshold,
+        }
 
     # Load Data
     df_train, df_dev, df_test = load_data("../../data/CEHA_dataset.csv")
@@ -1,9 +1,7 @@
 import argparse
+import os
 import random
-import time
-from tqdm import tqdm
 from textwrap import dedent
-import openai
 
 from ..utils.prompts import (
     system_prompt_type,
@@ -11,53 +9,59 @@ from ..utils.prompts import (
     format_prompt_zero_shot_religious,
     format_prompt_zero_shot_female,
     format_prompt_zero_shot_climate,
-    databricks_llm_prompt,
+    format_prompt_few_shot_tribal,
+    format_prompt_few_shot_religious,
+    format_prompt_few_shot_female,
+    format_prompt_few_shot_climate,
     generate_few_shot_prompt_list_type,
     clean_label,
-    databricks_llm_prompt_chat,
+    databricks_llm_prompt_prefix,
+    databricks_llm_prompt_packed,
+    format_prompt_packed,
+    generate_few_shot_packed,
+    system_prompt_type_fused,
+    format_prompt_zero_shot_fused,
+    format_prompt_few_shot_fused,
+    generate_few_shot_prompt_list_fused,
+    PROMPT_LAYOUTS,
+    FEW_SHOT_FORMATS,
+    apply_prompt_layout_examples,
+    format_system_prompt_compact,
+    format_user_prompt,
+    ANSWER_MODES,
+    answer_stop_sequence,
+    get_answer_mode_prompt_format,
 )
 from ..utils.evaluation import event_type_scorer_type
-from ..utils.utils import extract_between_tags, load_data
-from ..utils.llm_backbone import OpenAILLMCaller, MistralAiLLMCaller
-
-def predict_event_type(args, df_train, df_test):
+from ..utils.utils import extract_answer_score, extract_between_tags, load_data, truncate_event_descriptions
+from ..utils.checkpoint import EventCheckpoint, event_key, get_prediction_checkpoint
+from ..utils.llm_backbone import RetryPolicy, get_circuit_breaker, get_rate_limiter
+from ..utils.llm_backends import create_llm_caller, get_llm_backend
+from ..utils.llm_cache import CachedLLMCaller, get_llm_cache
+from ..utils.llm_cassette import CASSETTE_MODES, CassetteLLMCaller, get_llm_cassette
+from ..utils.llm_dispatch import EXECUTION_MODES, dispatch_audited_llm_calls, dispatch_llm_calls, sample_audit_events
+from ..utils.llm_hedging import HedgedLLMCaller, create_hedged_llm_caller
+from ..utils.llm_metrics import get_answer_sources, get_hedge_stats, get_llm_usage, get_truncation_stats
+from ..utils.llm_packing import dispatch_packed_llm_calls
+from ..utils.llm_telemetry import get_llm_telemetry
+from ..utils.prompt_compiler import few_shot_key, get_prompt_compiler
+from ..db_utils import configure_default_logger
+from .rule_engine import DecidedPrompts, get_rule_engine, rule_answer
+
+# Configure logging
+logger = configure_default_logger()
+
+EVENT_TYPE_LABELS = ["tribal", "religious", "female", "climate"]
+TYPE_PROMPT_MODES = ["per_label", "fused"]
+
+
+def sample_event_type_few_shot_examples(df_train, few_shot_num):
     """
-    Predicts the event type for given test data using a specified large language model (LLM).
-    
-    Args:
-        args (argparse.Namespace):
-            - llm_name (str, default="gpt4"): Name of the LLM to use ("mistral", "gpt4"). 
-            - max_tokens (int, default=512): Maximum number of tokens for LLM responses.
-            - temperature (float, default=0.0): Sampling temperature for LLM.
-            - few_shot_num (int, default=0): Number of few-shot examples to include in the prompts.
-            - openai_api_key (str, default=None): API key for OpenAI (if using GPT models).
-            - mistralai_api_key (str, default=None): API key for Mistral.ai (if using mistral models).
-            - mistralai_rps (float, default=0): Request per second limit for Mistral.ai (if using mistral models).
-
-        df_train (pd.DataFrame): 
-            A DataFrame containing training data with event descriptions and their event types. 
-            Used for generating few-shot examples if `few_shot_num > 0`.
-
-        df_test (pd.DataFrame): 
-            A DataFrame containing test data with event descriptions. 
-    
-    Returns:
-        tuple:
-            - all_gold_labels (list): A list of ground truth event type labels for the test dataset if provided. Otherwise, this list will be empty.
-            - all_sys_labels (list): A list of sets where each set contains the predicted event type labels for an event in the test dataset.
-
-    Notes:
-        - This function uses different LLM backends based on the specified `llm_name`. Please refer to the instruction to set up correct access.
+    Randomly selects `few_shot_num` positive and negative few-shot examples for each event type.
     """
-    model_id_dic = {
-        "gpt4": "gpt-4o",
-        "mistral": "mistral-large-latest",
-    }
-
-
     # randomly select few-shot examples
-    random.seed(42)
-    if args.few_shot_num > 0:
+    rng = random.Random(42)
+    if few_shot_num > 0:
         df_train_trial = df_train[df_train["tribal/communal/ethnic conflict"] == "X"]
         df_train_religious = df_train[df_train["religious conflict"] == "X"]
         df_train_female = df_train[
@@ -86,234 +90,511 @@ def predict_event_type(args, df_train, df_test):
             "other": {"pos": [], "neg": []},
         }
 
-        for _ in range(0, args.few_shot_num):
-            random_trial_pos = random.sample(
-                range(0, len(df_train_trial)), args.few_shot_num
+        # The draws are repeated few_shot_num times and the last one is kept, as the examples were always selected
+        for _ in range(0, few_shot_num):
+            random_trial_pos = rng.sample(
+                range(0, len(df_train_trial)), few_shot_num
             )
-            random_trial_neg = random.sample(
-                range(0, len(df_train_trial_neg)), args.few_shot_num
+            random_trial_neg = rng.sample(
+                range(0, len(df_train_trial_neg)), few_shot_num
             )
-            random_religious_pos = random.sample(
-                range(0, len(df_train_religious)), args.few_shot_num
+            random_religious_pos = rng.sample(
+                range(0, len(df_train_religious)), few_shot_num
             )
-            random_religious_neg = random.sample(
-                range(0, len(df_train_religious_neg)), args.few_shot_num
+            random_religious_neg = rng.sample(
+                range(0, len(df_train_religious_neg)), few_shot_num
             )
-            random_female_pos = random.sample(
-                range(0, len(df_train_female)), args.few_shot_num
+            random_female_pos = rng.sample(
+                range(0, len(df_train_female)), few_shot_num
             )
-            random_female_neg = random.sample(
-                range(0, len(df_train_female_neg)), args.few_shot_num
+            random_female_neg = rng.sample(
+                range(0, len(df_train_female_neg)), few_shot_num
             )
-            random_climate_pos = random.sample(
-                range(0, len(df_train_climate)), args.few_shot_num
+            random_climate_pos = rng.sample(
+                range(0, len(df_train_climate)), few_shot_num
             )
-            random_climate_neg = random.sample(
-                range(0, len(df_train_climate_neg)), args.few_shot_num
+            random_climate_neg = rng.sample(
+                range(0, len(df_train_climate_neg)), few_shot_num
             )
-            random_other_pos = random.sample(
-                range(0, len(df_train_other)), args.few_shot_num
+            random_other_pos = rng.sample(
+                range(0, len(df_train_other)), few_shot_num
             )
-            random_other_neg = random.sample(
-                range(0, len(df_train_other_neg)), args.few_shot_num
+            random_other_neg = rng.sample(
+                range(0, len(df_train_other_neg)), few_shot_num
             )
 
-            few_shot_examples["tribal"]["pos"] = df_train_trial.iloc[random_trial_pos]
-            few_shot_examples["tribal"]["neg"] = df_train_trial_neg.iloc[
-                random_trial_neg
-            ]
-            few_shot_examples["religious"]["pos"] = df_train_religious.iloc[
-                random_religious_pos
-            ]
-            few_shot_examples["religious"]["neg"] = df_train_religious_neg.iloc[
-                random_religious_neg
-            ]
-            few_shot_examples["female"]["pos"] = df_train_female.iloc[random_female_pos]
-            few_shot_examples["female"]["neg"] = df_train_female_neg.iloc[
-                random_female_neg
-            ]
-            few_shot_examples["climate"]["pos"] = df_train_climate.iloc[
-                random_climate_pos
-            ]
-            few_shot_examples["climate"]["neg"] = df_train_climate_neg.iloc[
-                random_climate_neg
-            ]
-            few_shot_examples["other"]["pos"] = df_train_other.iloc[random_other_pos]
-            few_shot_examples["other"]["neg"] = df_train_other_neg.iloc[
-                random_other_neg
-            ]
-
-    if args.llm_name == "mistral":
-        # Define LLM
-        llm_caller = MistralAiLLMCaller(mistralai_api_key=args.mistralai_api_key, model_name=model_id_dic["mistral"], timeout=180)
-    elif args.llm_name == "gpt4":
+        few_shot_examples["tribal"]["pos"] = df_train_trial.iloc[random_trial_pos]
+        few_shot_examples["tribal"]["neg"] = df_train_trial_neg.iloc[
+            random_trial_neg
+        ]
+        few_shot_examples["religious"]["pos"] = df_train_religious.iloc[
+            random_religious_pos
+        ]
+        few_shot_examples["religious"]["neg"] = df_train_religious_neg.iloc[
+            random_religious_neg
+        ]
+        few_shot_examples["female"]["pos"] = df_train_female.iloc[random_female_pos]
+        few_shot_examples["female"]["neg"] = df_train_female_neg.iloc[
+            random_female_neg
+        ]
+        few_shot_examples["climate"]["pos"] = df_train_climate.iloc[
+            random_climate_pos
+        ]
+        few_shot_examples["climate"]["neg"] = df_train_climate_neg.iloc[
+            random_climate_neg
+        ]
+        few_shot_examples["other"]["pos"] = df_train_other.iloc[random_other_pos]
+        few_shot_examples["other"]["neg"] = df_train_other_neg.iloc[
+            random_other_neg
+        ]
+        return few_shot_examples
+    return None
+
+
+FEW_SHOT_PROMPT_FORMATS = {
+    "tribal": format_prompt_few_shot_tribal,
+    "religious": format_prompt_few_shot_religious,
+    "female": format_prompt_few_shot_female,
+    "climate": format_prompt_few_shot_climate,
+}
+ZERO_SHOT_PROMPT_FORMATS = {
+    "tribal": format_prompt_zero_shot_tribal,
+    "religious": format_prompt_zero_shot_religious,
+    "female": format_prompt_zero_shot_female,
+    "climate": format_prompt_zero_shot_climate,
+}
+
+
+def get_event_type_few_shot_prompts(few_shot_num=0, few_shot_examples=None, type_prompt_mode="per_label"):
+    """
+    Returns the (pos_examples, neg_examples) few-shot examples of each prompt of an event, they do not depend on the event.
+    """
+    if type_prompt_mode == "fused":
+        if few_shot_num > 0:
+            _, pos_examples, neg_examples = generate_few_shot_prompt_list_fused("", "", "", few_shot_examples)
+            return [(pos_examples, neg_examples)]
+        return [([], [])]
+
+    examples = []
+    for label in EVENT_TYPE_LABELS:
+        if few_shot_num > 0:
+            _, pos_examples, neg_examples = generate_few_shot_prompt_list_type("", "", "", few_shot_examples[label], label)
+            examples.append((pos_examples, neg_examples))
+        else:
+            examples.append(([], []))
+    return examples
+
+
+def get_event_type_prompt_formats(few_shot_num=0, type_prompt_mode="per_label", answer_mode="reason"):
+    """
+    Returns the format_prompt* functions building the prompts of an event, in the order of `build_event_type_prompts`.
+    In the "answer_only" answer mode the prompts do not ask for a reason.
+    """
+    if type_prompt_mode == "fused":
+        prompt_formats = [format_prompt_few_shot_fused if few_shot_num > 0 else format_prompt_zero_shot_fused]
+    else:
+        prompt_formats = FEW_SHOT_PROMPT_FORMATS if few_shot_num > 0 else ZERO_SHOT_PROMPT_FORMATS
+        prompt_formats = [prompt_formats[label] for label in EVENT_TYPE_LABELS]
+    return [get_answer_mode_prompt_format(format_event_prompt, answer_mode) for format_event_prompt in prompt_formats]
+
+
+def build_event_type_prompt_prefixes(few_shot_num=0, few_shot_examples=None, type_prompt_mode="per_label", prompt_layout="original", few_shot_format="full", answer_mode="reason"):
+    """
+    Builds the messages shared by the prompts of all the events: the system prompt and the few-shot turns.
+    In the "compact" few-shot format the guidance is written once in the system prompt.
+    The prefixes are rendered once per run by the prompt compiler, do not modify them.
+
+    Returns:
+        list: One prefix per prompt of an event, in the order of `build_event_type_prompts`.
+    """
+
+    def render():
+        system = dedent(system_prompt_type_fused if type_prompt_mode == "fused" else system_prompt_type).strip()
+        prefixes = []
+        for format_event_prompt, (pos_examples, neg_examples) in zip(
+            get_event_type_prompt_formats(few_shot_num, type_prompt_mode, answer_mode),
+            get_event_type_few_shot_prompts(few_shot_num, few_shot_examples, type_prompt_mode),
+        ):
+            prompt_system = system
+            if few_shot_format == "compact":
+                prompt_system = dedent(format_system_prompt_compact(system, format_event_prompt("", "", ""))).strip()
+            prefixes.append(
+                databricks_llm_prompt_prefix(
+                    prompt_system,
+                    apply_prompt_layout_examples(pos_examples, prompt_layout, few_shot_format),
+                    apply_prompt_layout_examples(neg_examples, prompt_layout, few_shot_format),
+                )
+            )
+        return prefixes
+
+    key = ("event_type", few_shot_num, few_shot_key(few_shot_examples) if few_shot_num > 0 else None, type_prompt_mode, prompt_layout, few_shot_format, answer_mode)
+    return get_prompt_compiler().compile(key, render)
+
+
+def build_event_type_prompts(i, few_shot_num=0, few_shot_examples=None, type_prompt_mode="per_label", prompt_prefixes=None, prompt_layout="original", few_shot_format="full", answer_mode="reason"):
+    """
+    Builds the LLM prompts of an event.
+
+    `prompt_prefixes` are the prefixes built by `build_event_type_prompt_prefixes` with the same options, pass them
+    to avoid rebuilding the few-shot turns for every event.
+
+    Returns:
+        list: The prompts of the tribal, religious, female and climate event types in "per_label" mode,
+        or a single prompt carrying the guidance of all four event types in "fused" mode.
+    """
+    if prompt_prefixes is None:
+        prompt_prefixes = build_event_type_prompt_prefixes(few_shot_num, few_shot_examples, type_prompt_mode, prompt_layout, few_shot_format, answer_mode)
+
+    prompt_formats = get_event_type_prompt_formats(few_shot_num, type_prompt_mode, answer_mode)
+    prompt_keys = ["prompt_fused"] if type_prompt_mode == "fused" else [f"prompt_{label}" for label in EVENT_TYPE_LABELS]
+    for prompt_key, format_event_prompt in zip(prompt_keys, prompt_formats):
+        i[prompt_key] = format_event_prompt(i["Event Description"], i["Actor 1"], i["Actor 2"])
+
+    return [
+        prompt_prefix + [{"role": "user", "content": dedent(format_user_prompt(i[prompt_key], prompt_layout, few_shot_format)).strip()}]
+        for prompt_prefix, prompt_key in zip(prompt_prefixes, prompt_keys)
+    ]
+
+
+def build_packed_event_type_prompts(events, few_shot_num=0, few_shot_examples=None, type_prompt_mode="per_label", prompt_layout="original"):
+    """
+    Builds the LLM prompts of a pack of events whose single-event prompts were built by `build_event_type_prompts`.
+
+    Returns:
+        list: One packed prompt per event type in "per_label" mode, a single packed prompt in "fused" mode.
+    """
+    answer_tags = [EVENT_TYPE_LABELS] if type_prompt_mode == "fused" else [["event_type"]] * len(EVENT_TYPE_LABELS)
+
+    def render_packed_examples():
+        few_shot_prompts = get_event_type_few_shot_prompts(few_shot_num, few_shot_examples, type_prompt_mode)
+        return [
+            generate_few_shot_packed(pos_examples, neg_examples, tags, prompt_layout) if few_shot_num > 0 else None
+            for (pos_examples, neg_examples), tags in zip(few_shot_prompts, answer_tags)
+        ]
+
+    # The packed few-shot examples are the same for all the packs
+    packed_examples = get_prompt_compiler().compile(
+        ("event_type_packed", few_shot_num, few_shot_key(few_shot_examples) if few_shot_num > 0 else None, type_prompt_mode, prompt_layout),
+        render_packed_examples,
+    )
+    if type_prompt_mode == "fused":
+        packed_prompt = format_prompt_packed([i["prompt_fused"] for i in events], EVENT_TYPE_LABELS, prompt_layout)
+        return [databricks_llm_prompt_packed(dedent(system_prompt_type_fused).strip(), dedent(packed_prompt).strip(), packed_examples[0])]
+
+    input_prompts = []
+    for label, packed_example in zip(EVENT_TYPE_LABELS, packed_examples):
+        packed_prompt = format_prompt_packed([i[f"prompt_{label}"] for i in events], ["event_type"], prompt_layout)
+        input_prompts.append(databricks_llm_prompt_packed(dedent(system_prompt_type).strip(), dedent(packed_prompt).strip(), packed_example))
+    return input_prompts
+
+
+def predict_event_type(args, df_train, df_test, return_scores=False):
+    """
+    Predicts the event type for given test data using a specified large language model (LLM).
+    
+    Args:
+        args (argparse.Namespace):
+            - llm_name (str, default="gpt4"): Name of the LLM backend to use: "mistral", "gpt4" or a backend of llm_backends.
+            - llm_backends (dict, default={}): LLM backends by name in addition to the built-in ones, e.g. self-hosted OpenAI compatible
+              servers or local models, see get_llm_backend.
+            - api_keys (dict, default={}): Api keys by secret name, for the backends authenticated with api_key_secret.
+            - max_tokens (int, default=512): Maximum number of tokens for LLM responses.
+            - temperature (float, default=0.0): Sampling temperature for LLM.
+            - top_p (float, default=None): Nucleus sampling parameter of the LLM, 0.001 if not provided.
+            - few_shot_num (int, default=0): Number of few-shot examples to include in the prompts.
+            - openai_api_key (str, default=None): API key for OpenAI (if using GPT models).
+            - mistralai_api_key (str, default=None): API key for Mistral.ai (if using mistral models).
+            - mistralai_rps (float, default=0): Request per second limit for Mistral.ai (if using mistral models). Used when rate_limit does not set requests_per_second.
+            - rate_limit (dict, default={}): Keyword arguments of the AdaptiveRateLimiter shared by all the callers of the LLM,
+              e.g. requests_per_second, tokens_per_minute, max_concurrency.
+            - llm_cache (dict, default=None): Keyword arguments of the on-disk LLM response cache (path, max_entries, read_only).
+              No cache is used if not provided.
+            - llm_cassette (dict, default=None): Keyword arguments of the LLM cassette (path, mode, replay_latency, latency_scale).
+              In "record" mode the LLM calls are recorded with their latency and usage, in "replay" mode they are answered from
+              the cassette without any LLM client or api key. The calls of the "batch" execution mode are then sent one by one.
+            - execution_mode (str, default="sequential"): "sequential", "async" or "batch". In "async" mode the four event type calls of all events are sent concurrently, in "batch" mode they are sent to the provider batch API.
+            - max_concurrency (int, default=8): Maximum number of concurrent LLM calls in "async" mode.
+            - batch_state_dir (str, default=None): Folder of the batch job state, required in "batch" mode.
+            - batch_poll_interval (float, default=60): Seconds between two status checks of the batch job in "batch" mode.
+            - request_timeout (float, default=180): Timeout of a LLM request in seconds.
+            - retry (dict, default={}): Keyword arguments of the RetryPolicy of the failed LLM requests
+              (max_retries, backoff_seconds, max_backoff_seconds, deadline).
+            - circuit_breaker (dict, default={}): Keyword arguments of the CircuitBreaker shared by all the callers of the LLM
+              (failure_threshold, reset_seconds).
+            - hedging (dict, default=None): Keyword arguments of the HedgedLLMCaller sending a duplicate request for the slow calls
+              (percentile, min_delay, alternate_llm_name, ...), see create_hedged_llm_caller. No hedging if not provided.
+            - http_pool (dict, default=None): Settings of the HTTP connection pool shared by all the callers of the LLM
+              (max_connections, max_keepalive_connections, keepalive_expiry, http2).
+            - type_prompt_mode (str, default="per_label"): "per_label" makes one LLM call per event type (tribal, religious, female, climate),
+              "fused" makes a single LLM call per event whose prompt carries the guidance of all four event types.
+            - pack_size (int, default=1): Maximum number of events classified per LLM request. 1 disables packing, 0 means no limit (pack_max_tokens must be set).
+              Events missing from a packed answer are asked again one by one.
+            - pack_max_tokens (int, default=0): Maximum number of prompt tokens of a packed LLM request, 0 means no limit.
+            - prompt_layout (str, default="original"): "original" or "prefix_cache". With "prefix_cache" the article comes last in the prompts,
+              so that all the prompts share their system prompt, guidelines and few-shot turns as a byte-identical prefix the provider can cache.
+            - max_description_tokens (int, default=0): Token budget of the event descriptions. Longer descriptions are cut to their leading
+              sentences that fit in the budget before prompting, 0 means no limit.
+            - few_shot_format (str, default="full"): "full" or "compact". "compact" writes the guidance, the question and the answer format
+              once in the system prompt and the few-shot and event turns only carry the article and its actors. Packed prompts are not affected.
+            - answer_mode (str, default="reason"): "reason", "answer_only" or "score". "answer_only" prompts do not ask for a reason, and their generation
+              is limited to answer_max_tokens and stops at the closing tag of the last answer tag. Packed requests do not ask for reasons in either mode.
+              "score" prompts ask for a single-word answer and a single token is generated with its logprobs: the probability of "Yes"
+              is the score of the event type, labeled if the score is at least its score_threshold. Providers without logprobs (Mistral)
+              score 1.0 or 0.0 from the answer. Only the "per_label" type_prompt_mode without packing is supported in "score" mode.
+            - answer_max_tokens (int, default=16): Maximum number of tokens of the LLM responses in "answer_only" mode, per answer tag
+              (four in "fused" mode).
+            - answer_audit_fraction (float, default=0): Share of the events still asked for a reason in "answer_only" and "score" modes, with max_tokens.
+              Their answers are logged to audit the answer-only labels.
+            - score_threshold (float or dict, default=0.5): Threshold of the scores in "score" mode, a single one or one per event type
+              (tribal, religious, female, climate). See tune_score_thresholds to tune them on the CEHA dev split.
+            - checkpoint_path (str, default=None): Path of the PredictionCheckpoint of the run. The answers of each event are appended to it
+              as soon as all the prompts of the event are answered, and the events already in it (with the same requests) are not sent
+              again when the run is resumed. No checkpoint is used if not provided.
+            - checkpoint_resume_paths (list, default=None): Other checkpoints of the run whose events are resumed too, e.g. those of the
+              other partitions of a Spark run, see PredictionCheckpoint.
+            - rules_path (str, default=None): Path of the YAML rules deciding event types from the structured fields of the events,
+              see rule_engine. The prompts of the decided event types are not sent to the LLM (in "fused" mode, the prompt of the events
+              whose four event types are decided). With packing the decided event types override the answers. No rules are used if not provided.
+
+        df_train (pd.DataFrame): 
+            A DataFrame containing training data with event descriptions and their event types. 
+            Used for generating few-shot examples if `few_shot_num > 0`.
+
+        df_test (pd.DataFrame): 
+            A DataFrame containing test data with event descriptions. 
+
+        return_scores (bool, default=False):
+            Also return the event type scores of each event.
+    
+    Returns:
+        tuple:
+            - all_gold_labels (list): A list of ground truth event type labels for the test dataset if provided. Otherwise, this list will be empty.
+            - all_sys_labels (list): A list of sets where each set contains the predicted event type labels for an event in the test dataset.
+            - all_scores (list): Only if `return_scores` is set. A dict per event with the probability of "Yes" of each event type
+              (tribal, religious, female, climate) in "score" mode, None otherwise.
+
+    Notes:
+        - This function uses different LLM backends based on the specified `llm_name`. Please refer to the instruction to set up correct access.
+    """
+    # Backend of the LLM: a built-in one ("gpt4", "mistral") or one of the llm_backends config
+    backend = get_llm_backend(args.llm_name, getattr(args, "llm_backends", None))
+
+    few_shot_examples = sample_event_type_few_shot_examples(df_train, args.few_shot_num)
+
+    # Rate limiter shared with the other stages using the same LLM. mistralai_rps is the requests per second limit of Mistral.ai
+    rate_limit_config = dict(getattr(args, "rate_limit", None) or {})
+    if backend["provider"] == "mistral" and args.mistralai_rps and not rate_limit_config.get("requests_per_second"):
+        rate_limit_config["requests_per_second"] = args.mistralai_rps
+    rate_limiter = get_rate_limiter(args.llm_name, **rate_limit_config)
+
+    # Retries of transient errors, bounded by the deadline of the run, and circuit breaker shared with the other stages using the same LLM
+    retry_policy = RetryPolicy(**(getattr(args, "retry", None) or {}))
+    circuit_breaker = get_circuit_breaker(args.llm_name, **(getattr(args, "circuit_breaker", None) or {}))
+    request_timeout = getattr(args, "request_timeout", 180)
+    # Token usage of the stage, including the prompt tokens served from the provider prefix cache
+    usage = get_llm_usage("event_type")
+    # Latency, tokens, retries and parse failures of the calls, reported at the end of the run
+    telemetry = get_llm_telemetry().stage("event_type", args.llm_name, backend["model_name"])
+
+    # Record the LLM calls to a cassette, or replay them offline without calling the LLM
+    cassette = get_llm_cassette(**args.llm_cassette) if getattr(args, "llm_cassette", None) else None
+
+    # Serve repeated prompts from the on-disk response cache. The hedged calls cache the LLM and its alternate separately
+    llm_cache = get_llm_cache(**args.llm_cache) if getattr(args, "llm_cache", None) else None
+
+    if cassette is not None and cassette.mode == "replay":
+        # No LLM client is created, no api key is needed
+        llm_caller = None
+    else:
         # Define LLM
-        llm_caller = OpenAILLMCaller(openai_api_key=args.openai_api_key, model_name=model_id_dic["gpt4"], timeout=180)
+        api_keys = {"openai_api_key": args.openai_api_key, "mistralai_api_key": args.mistralai_api_key, **(getattr(args, "api_keys", None) or {})}
+        llm_caller = create_llm_caller(backend, api_keys, timeout=request_timeout, rate_limiter=rate_limiter, retry_policy=retry_policy, circuit_breaker=circuit_breaker, http_pool=getattr(args, "http_pool", None), usage=usage, telemetry=telemetry)
+        # Hedge the slow calls, and fail over to the alternate LLM while the circuit of the LLM is open. Batch jobs are not hedged
+        if getattr(args, "hedging", None) and getattr(args, "execution_mode", "sequential") != "batch":
+            llm_caller = create_hedged_llm_caller(
+                llm_caller, args.hedging, get_hedge_stats("event_type"), getattr(args, "llm_backends", None), api_keys, getattr(args, "circuit_breaker", None),
+                usage=usage, llm_cache=llm_cache, timeout=request_timeout, retry_policy=retry_policy, http_pool=getattr(args, "http_pool", None), telemetry=telemetry,
+            )
 
+    if llm_cache is not None and llm_caller is not None and not isinstance(llm_caller, HedgedLLMCaller):
+        llm_caller = CachedLLMCaller(llm_caller, llm_cache)
+    if cassette is not None:
+        llm_caller = CassetteLLMCaller(cassette, llm_caller, backend["model_name"], usage, telemetry)
 
     # Define sampling parameters
     sampling_params = {
         "max_tokens": args.max_tokens,
         "temperature": args.temperature,
     }
+    if getattr(args, "top_p", None) is not None:
+        sampling_params["top_p"] = args.top_p
 
     # evaluation
     all_gold_labels = []
     all_sys_labels = []
+    all_scores = []
     evaluation_flag = True if "All Categories_DM" in df_test else False
-    for i in tqdm(df_test.to_dict("records")):
-
-        if args.few_shot_num > 0:
-            i["prompt_tribal"] = []
-            i["prompt_religious"] = []
-            i["prompt_female"] = []
-            i["prompt_climate"] = []
-
-            i["prompt_tribal"], pos_examples1, neg_examples1 = (
-                generate_few_shot_prompt_list_type(
-                    i["Event Description"],
-                    i["Actor 1"],
-                    i["Actor 2"],
-                    few_shot_examples["tribal"],
-                    "tribal",
-                )
-            )
-            i["prompt_religious"], pos_examples2, neg_examples2 = (
-                generate_few_shot_prompt_list_type(
-                    i["Event Description"],
-                    i["Actor 1"],
-                    i["Actor 2"],
-                    few_shot_examples["religious"],
-                    "religious",
-                )
-            )
-            i["prompt_female"], pos_examples3, neg_examples3 = (
-                generate_few_shot_prompt_list_type(
-                    i["Event Description"],
-                    i["Actor 1"],
-                    i["Actor 2"],
-                    few_shot_examples["female"],
-                    "female",
-                )
-            )
-            i["prompt_climate"], pos_examples4, neg_examples4 = (
-                generate_few_shot_prompt_list_type(
-                    i["Event Description"],
-                    i["Actor 1"],
-                    i["Actor 2"],
-                    few_shot_examples["climate"],
-                    "climate",
-                )
-            )
-
-            input_prompt1 = databricks_llm_prompt_chat(
-                dedent(system_prompt_type).strip(),
-                dedent(i["prompt_tribal"][0]).strip(),
-                pos_examples1,
-                neg_examples1,
-            )
-            input_prompt2 = databricks_llm_prompt_chat(
-                dedent(system_prompt_type).strip(),
-                dedent(i["prompt_religious"][0]).strip(),
-                pos_examples2,
-                neg_examples2,
-            )
-            input_prompt3 = databricks_llm_prompt_chat(
-                dedent(system_prompt_type).strip(),
-                dedent(i["prompt_female"][0]).strip(),
-                pos_examples3,
-                neg_examples3,
-            )
-            input_prompt4 = databricks_llm_prompt_chat(
-                dedent(system_prompt_type).strip(),
-                dedent(i["prompt_climate"][0]).strip(),
-                pos_examples4,
-                neg_examples4,
-            )
-        else:
-            pos_examples1, neg_examples1 = [], []
-            pos_examples2, neg_examples2 = [], []
-            pos_examples3, neg_examples3 = [], []
-            pos_examples4, neg_examples4 = [], []
-            i["prompt_tribal"] = format_prompt_zero_shot_tribal(
-                i["Event Description"], i["Actor 1"], i["Actor 2"]
-            )
-            i["prompt_religious"] = format_prompt_zero_shot_religious(
-                i["Event Description"], i["Actor 1"], i["Actor 2"]
-            )
-            i["prompt_female"] = format_prompt_zero_shot_female(
-                i["Event Description"], i["Actor 1"], i["Actor 2"]
-            )
-            i["prompt_climate"] = format_prompt_zero_shot_climate(
-                i["Event Description"], i["Actor 1"], i["Actor 2"]
-            )
-
-            input_prompt1 = databricks_llm_prompt(
-                dedent(system_prompt_type).strip(), dedent(i["prompt_tribal"]).strip()
-            )
-            input_prompt2 = databricks_llm_prompt(
-                dedent(system_prompt_type).strip(),
-                dedent(i["prompt_religious"]).strip(),
-            )
-            input_prompt3 = databricks_llm_prompt(
-                dedent(system_prompt_type).strip(), dedent(i["prompt_female"]).strip()
-            )
-            input_prompt4 = databricks_llm_prompt(
-                dedent(system_prompt_type).strip(), dedent(i["prompt_climate"]).strip()
-            )
-
-            i["prompts"] = {
-                "tribal": input_prompt1,
-                "religious": input_prompt2,
-                "female": input_prompt3,
-                "climate": input_prompt4,
-            }
-
-        # Wait for some time between requests for Mistral.ai to avoid rate limit
-        if args.llm_name == "mistral" and args.mistralai_rps:
-            time.sleep(1/args.mistralai_rps)
-        i["mystral_answer_tribal"] = llm_caller(input_prompt1, sampling_params)[
-            0
-        ].strip()
-        if args.llm_name == "mistral" and args.mistralai_rps:
-            time.sleep(1/args.mistralai_rps)
-        i["mystral_answer_religious"] = llm_caller(input_prompt2, sampling_params)[
-            0
-        ].strip()
-        if args.llm_name == "mistral" and args.mistralai_rps:
-            time.sleep(1/args.mistralai_rps)
-        i["mystral_answer_female"] = llm_caller(input_prompt3, sampling_params)[
-            0
-        ].strip()
-        if args.llm_name == "mistral" and args.mistralai_rps:
-            time.sleep(1/args.mistralai_rps)
-        i["mystral_answer_climate"] = llm_caller(input_prompt4, sampling_params)[
-            0
-        ].strip()
-
-        i["mystral_answer_parsed_event_type_tribal"] = (
-            extract_between_tags("event_type", i["mystral_answer_tribal"])[0]
-            if extract_between_tags("event_type", i["mystral_answer_tribal"])
-            else "No"
+    type_prompt_mode = getattr(args, "type_prompt_mode", "per_label")
+    if type_prompt_mode not in TYPE_PROMPT_MODES:
+        raise ValueError(f"Invalid type_prompt_mode {type_prompt_mode}. Please select from {TYPE_PROMPT_MODES}.")
+    prompt_layout = getattr(args, "prompt_layout", "original")
+    records = df_test.to_dict("records")
+    # Event types decided by the rules on the structured fields of the events
+    rules_path = getattr(args, "rules_path", None)
+    event_rule_decisions = get_rule_engine(rules_path).decisions(df_test, "event_type", EVENT_TYPE_LABELS) if rules_path else [{}] * len(records)
+    # Long descriptions are cut to the token budget of the stage, which bounds the size of the requests
+    max_description_tokens = getattr(args, "max_description_tokens", 0)
+    truncation_stats = get_truncation_stats("event_type")
+    if max_description_tokens:
+        truncate_event_descriptions(records, max_description_tokens, truncation_stats)
+    # The system prompt and the few-shot turns are the same for all the events, build them once
+    few_shot_format = getattr(args, "few_shot_format", "full")
+    answer_mode = getattr(args, "answer_mode", "reason")
+    if answer_mode == "score" and (type_prompt_mode != "per_label" or getattr(args, "pack_size", 1) != 1):
+        raise ValueError("score answer_mode needs one answer per LLM call: type_prompt_mode must be per_label and pack_size 1")
+    score_thresholds = getattr(args, "score_threshold", 0.5)
+    if not isinstance(score_thresholds, dict):
+        score_thresholds = {label: score_thresholds for label in EVENT_TYPE_LABELS}
+    prompt_prefixes = build_event_type_prompt_prefixes(args.few_shot_num, few_shot_examples, type_prompt_mode, prompt_layout, few_shot_format, answer_mode)
+    input_prompts = []
+    for i in records:
+        # The prompts of an event are kept next to each other
+        input_prompts.extend(
+            build_event_type_prompts(i, args.few_shot_num, few_shot_examples, type_prompt_mode, prompt_prefixes, prompt_layout, few_shot_format, answer_mode)
         )
-
-        i["mystral_answer_parsed_event_type_religious"] = (
-            extract_between_tags("event_type", i["mystral_answer_religious"])[0]
-            if extract_between_tags("event_type", i["mystral_answer_religious"])
-            else "No"
+    prompts_per_event = 1 if type_prompt_mode == "fused" else 4
+    # The calls are labeled by event type in the telemetry, e.g. "event_type:tribal"
+    call_labels = ["fused"] * len(records) if type_prompt_mode == "fused" else [label for _ in records for label in EVENT_TYPE_LABELS]
+    # Events answered before an interruption of the run are read from the checkpoint, only the others are sent to the LLM
+    checkpoint = get_prediction_checkpoint(args.checkpoint_path, getattr(args, "checkpoint_resume_paths", None) or ()) if getattr(args, "checkpoint_path", None) else None
+    event_checkpoint = EventCheckpoint(
+        checkpoint, "event_type", records, input_prompts, prompts_per_event, backend["model_name"],
+        {**sampling_params, "answer_mode": answer_mode, "answer_max_tokens": getattr(args, "answer_max_tokens", 16), "pack_size": getattr(args, "pack_size", 1)},
+    )
+    pending_records = event_checkpoint.pending_events(records)
+    input_prompts = event_checkpoint.pending_prompts(input_prompts)
+    call_labels = event_checkpoint.pending_prompts(call_labels)
+    # The prompts decided by the rules are not sent to the LLM: the prompts of the decided event types, or the fused prompt of the
+    # events whose four event types are decided. Packed requests are built per event, the rules only override their answers
+    pending_rule_decisions = event_checkpoint.pending_events(event_rule_decisions)
+    decided_answers = {}
+    if getattr(args, "pack_size", 1) == 1:
+        for position in range(len(input_prompts)):
+            decisions = pending_rule_decisions[position // prompts_per_event]
+            if type_prompt_mode == "fused":
+                if len(decisions) == len(EVENT_TYPE_LABELS):
+                    decided_answers[position] = "".join(rule_answer(decisions[label]["answer"], decisions[label]["score"], label) for label in EVENT_TYPE_LABELS)
+            elif EVENT_TYPE_LABELS[position % prompts_per_event] in decisions:
+                decision = decisions[EVENT_TYPE_LABELS[position % prompts_per_event]]
+                decided_answers[position] = rule_answer(decision["answer"], decision["score"], "event_type")
+    decided_prompts = DecidedPrompts(decided_answers, len(input_prompts))
+    input_prompts = decided_prompts.pending(input_prompts)
+    call_labels = decided_prompts.pending(call_labels)
+    pending_sources = []
+
+    dispatch_options = {
+        "execution_mode": getattr(args, "execution_mode", "sequential"),
+        "max_concurrency": getattr(args, "max_concurrency", 8),
+        "batch_state_path": os.path.join(args.batch_state_dir, "event_type_batch_state.json") if getattr(args, "batch_state_dir", None) else None,
+        "batch_poll_interval": getattr(args, "batch_poll_interval", 60),
+        "on_answer": decided_prompts.on_answer(event_checkpoint.on_answer),
+        "answer_sources": pending_sources,
+    }
+    pack_size = getattr(args, "pack_size", 1)
+    if pack_size != 1:
+        # Several events per request, with the same answer tags as the single-event prompts
+        answer_tags = [EVENT_TYPE_LABELS] if type_prompt_mode == "fused" else [["event_type"]] * 4
+        llm_answers = dispatch_packed_llm_calls(
+            llm_caller,
+            input_prompts,
+            lambda event_indices: build_packed_event_type_prompts(
+                [pending_records[idx] for idx in event_indices], args.few_shot_num, few_shot_examples, type_prompt_mode, prompt_layout
+            ),
+            answer_tags,
+            sampling_params,
+            pack_size=pack_size,
+            pack_max_tokens=getattr(args, "pack_max_tokens", 0),
+            **dispatch_options,
         )
-
-        i["mystral_answer_parsed_event_type_female"] = (
-            extract_between_tags("event_type", i["mystral_answer_female"])[0]
-            if extract_between_tags("event_type", i["mystral_answer_female"])
-            else "No"
+    elif answer_mode in ["answer_only", "score"]:
+        if answer_mode == "answer_only":
+            # Only the answers are generated: few output tokens, and the generation stops at the closing tag of the last answer tag
+            format_event_prompt = get_event_type_prompt_formats(args.few_shot_num, type_prompt_mode)[0]
+            answer_sampling_params = {
+                **sampling_params,
+                "max_tokens": getattr(args, "answer_max_tokens", 16) * (len(EVENT_TYPE_LABELS) if type_prompt_mode == "fused" else 1),
+                "stop": [answer_stop_sequence(format_event_prompt("", "", ""))],
+            }
+        else:
+            # A single token is generated, the probability of "Yes" is read from the logprobs of the first token
+            answer_sampling_params = {**sampling_params, "max_tokens": 1, "logprobs": True, "top_logprobs": 5}
+        # The events sampled for audit are still asked for a reason
+        event_audit_flags = sample_audit_events(
+            len(pending_records), getattr(args, "answer_audit_fraction", 0), keys=[event_key(i) for i in pending_records]
         )
-
-        i["mystral_answer_parsed_event_type_climate"] = (
-            extract_between_tags("event_type", i["mystral_answer_climate"])[0]
-            if extract_between_tags("event_type", i["mystral_answer_climate"])
-            else "No"
+        audit_prompts = []
+        for i, audited in zip(pending_records, event_audit_flags):
+            if audited:
+                audit_prompts.extend(build_event_type_prompts(dict(i), args.few_shot_num, few_shot_examples, type_prompt_mode, None, prompt_layout, few_shot_format))
+            else:
+                audit_prompts.extend([None] * prompts_per_event)
+        audit_flags = [audited for audited in event_audit_flags for _ in range(prompts_per_event)]
+        llm_answers = dispatch_audited_llm_calls(
+            llm_caller, input_prompts, decided_prompts.pending(audit_prompts), decided_prompts.pending(audit_flags), answer_sampling_params, sampling_params, labels=call_labels, **dispatch_options
         )
+        llm_answers = decided_prompts.merge_answers(llm_answers)
+        for event_idx, (i, audited) in enumerate(zip(pending_records, event_audit_flags)):
+            if audited:
+                event_answers = llm_answers[prompts_per_event * event_idx: prompts_per_event * (event_idx + 1)]
+                logger.info(f"Audited LLM answers for {i['ACLED/GDELT']}, {i['Index']}: {event_answers}")
+    else:
+        llm_answers = decided_prompts.merge_answers(dispatch_llm_calls(llm_caller, input_prompts, sampling_params, labels=call_labels, **dispatch_options))
+    llm_answers = event_checkpoint.merge_answers(llm_answers)
+    # One source per prompt of the events: the prompts decided by the rules are not sent, see DecidedPrompts
+    answer_sources = event_checkpoint.merge_sources(decided_prompts.merge_sources(pending_sources))
+    # The ledger of the predictions reports the LLM calls its reused predictions save, see ledger_run_report
+    get_answer_sources("event_type").record(
+        [event_key(i) for i in records],
+        [answer_sources[prompts_per_event * event_idx: prompts_per_event * (event_idx + 1)] for event_idx in range(len(records))],
+    )
+    if checkpoint is not None:
+        logger.info(f"Checkpoint stats: {checkpoint.stats()}")
+    if llm_cache is not None:
+        logger.info(f"LLM cache stats: {llm_cache.stats()}")
+    if cassette is not None:
+        logger.info(f"LLM cassette stats: {cassette.stats()}")
+    logger.info(f"LLM retry stats: {retry_policy.stats()}, circuit breaker: {circuit_breaker.state}")
+    logger.info(f"LLM usage: {usage.stats()}")
+    if max_description_tokens:
+        logger.info(f"Event description truncation: {truncation_stats.stats()}")
+
+    for event_idx, i in enumerate(records):
+        event_answers = llm_answers[prompts_per_event * event_idx: prompts_per_event * (event_idx + 1)]
+        if type_prompt_mode == "fused":
+            # The fused answer carries one tag per event type
+            event_answers = event_answers * 4
+            answer_tags = EVENT_TYPE_LABELS
+        else:
+            answer_tags = ["event_type"] * 4
+
+        for label, answer_tag, llm_answer in zip(EVENT_TYPE_LABELS, answer_tags, event_answers):
+            i[f"mystral_answer_{label}"] = llm_answer
+            decision = event_rule_decisions[event_idx].get(label)
+            if decision is not None:
+                # The event types decided by the rules override the answers of the LLM, e.g. of a packed request
+                i[f"mystral_score_event_type_{label}"] = decision["score"] if answer_mode == "score" else None
+                i[f"mystral_answer_parsed_event_type_{label}"] = decision["answer"]
+                continue
+            if not extract_between_tags(answer_tag, llm_answer):
+                telemetry.record_parse_failures(call_label="fused" if type_prompt_mode == "fused" else label)
+            if answer_mode == "score":
+                i[f"mystral_score_event_type_{label}"] = extract_answer_score(llm_answer, answer_tag)
+                i[f"mystral_answer_parsed_event_type_{label}"] = "Yes" if i[f"mystral_score_event_type_{label}"] >= score_thresholds[label] else "No"
+            else:
+                i[f"mystral_score_event_type_{label}"] = None
+                parsed_answer = extract_between_tags(answer_tag, llm_answer)
+                i[f"mystral_answer_parsed_event_type_{label}"] = parsed_answer[0] if parsed_answer else "No"
+
         if evaluation_flag:
             label_set = set()
             gold_label = clean_label(i["All Categories_DM"])
@@ -334,7 +615,12 @@ def predict_event_type(args, df_train, df_test):
             sys_set.add("Other")
         
         all_sys_labels.append(sys_set)
+        all_scores.append(
+            {label: i[f"mystral_score_event_type_{label}"] for label in EVENT_TYPE_LABELS} if answer_mode == "score" else None
+        )
 
+    if return_scores:
+        return all_gold_labels, all_sys_labels, all_scores
     return all_gold_labels, all_sys_labels
 
 def main():
@@ -346,19 +632,78 @@ def main():
     parser.add_argument(
         "--temperature", type=float, default=0.0, help="temperature of llm"
     )
+    parser.add_argument(
+        "--top_p", type=float, default=None, help="top_p of llm"
+    )
     parser.add_argument(
         "--few_shot_num", type=int, default=0, help="number of few shot examples"
     )
     parser.add_argument(
         "--openai_api_key", type=str, default=None, help="openai api key"
     )
-    parser.add_augment(
+    parser.add_argument(
         "--mistralai_api_key", type=str, default=None, help="mistral.ai api key"
     )
-    parser.add_augment(
+    parser.add_argument(
         "--mistralai_rps", type=float, default=0, help="mistral.ai request per second limit"
     )
+    parser.add_argument(
+        "--execution_mode", type=str, default="sequential", choices=EXECUTION_MODES, help="how LLM calls are executed"
+    )
+    parser.add_argument(
+        "--max_concurrency", type=int, default=8, help="max number of concurrent LLM calls in async mode"
+    )
+    parser.add_argument(
+        "--batch_state_dir", type=str, default=None, help="folder of the batch job state in batch mode"
+    )
+    parser.add_argument(
+        "--request_timeout", type=float, default=180, help="timeout of a llm request in seconds"
+    )
+    parser.add_argument(
+        "--type_prompt_mode", type=str, default="per_label", choices=TYPE_PROMPT_MODES, help="one LLM call per event type or one fused call per event"
+    )
+    parser.add_argument(
+        "--pack_size", type=int, default=1, help="max number of events per LLM request, 1 disables packing"
+    )
+    parser.add_argument(
+        "--pack_max_tokens", type=int, default=0, help="max number of prompt tokens per packed LLM request"
+    )
+    parser.add_argument(
+        "--prompt_layout", type=str, default="original", choices=PROMPT_LAYOUTS, help="prompt layout, prefix_cache puts the article last"
+    )
+    parser.add_argument(
+        "--max_description_tokens", type=int, default=0, help="token budget of the event descriptions, 0 means no limit"
+    )
+    parser.add_argument(
+        "--few_shot_format", type=str, default="full", choices=FEW_SHOT_FORMATS, help="few-shot format, compact writes the guidance once"
+    )
+    parser.add_argument(
+        "--answer_mode", type=str, default="reason", choices=ANSWER_MODES, help="answer mode, answer_only does not ask for reasons, score reads the probability of Yes from the logprobs"
+    )
+    parser.add_argument(
+        "--answer_max_tokens", type=int, default=16, help="max tokens for llm per answer tag in answer_only mode"
+    )
+    parser.add_argument(
+        "--answer_audit_fraction", type=float, default=0, help="share of the events still asked for a reason in answer_only mode"
+    )
+    parser.add_argument(
+        "--cassette_path", type=str, default=None, help="path of the LLM cassette to record or replay"
+    )
+    parser.add_argument(
+        "--cassette_mode", type=str, default="replay", choices=CASSETTE_MODES, help="record the LLM calls or replay them offline"
+    )
+    parser.add_argument(
+        "--score_threshold", type=float, default=0.5, help="threshold of the event type scores in score mode"
+    )
+    parser.add_argument(
+        "--checkpoint_path", type=str, default=None, help="path of the checkpoint of the answered events, to resume an interrupted run"
+    )
+    parser.add_argument(
+        "--rules_path", type=str, default=None, help="path of the YAML rules deciding labels from the structured fields of the events"
+    )
     args = parser.parse_args()
+    if args.cassette_path:
+        args.llm_cassette = {"path": args.cassette_path, "mode": args.cassette_mode}
 
     # Load Data
     df_train, df_dev, df_test = load_data("../../data/data.csv")
@@ -0,0 +1,205 @@
+"""
+Declarative rules on the structured fields of the events, run before the LLM.
+
+The rules are read from a YAML file. Each rule decides the relevance of the events, or one of their event types,
+when all its conditions hold, e.g. the female event type of the events with a "Women (...)" associated actor or
+the relevance of the ACLED "Sexual violence" events. The decided labels are not asked to the LLM. Example:
+
+    rules:
+      - name: women_actor_female
+        stage: event_type               # "event_relevance" or "event_type"
+        label: female                   # event_type only: tribal, religious, female or climate
+        answer: "Yes"                   # "Yes" or "No"
+        score: 0.95                     # Optional. Score of the answer in "score" answer_mode. Default as 1.0 for "Yes", 0.0 for "No"
+        when:                           # All the conditions must hold
+          - field: [Actor 1, Actor 2]   # A field or a list of fields, the condition holds if any of them matches
+            contains: "\\bWomen \\("     # Case-insensitive regular expression
+          - field: ACLED/GDELT
+            equals: ACLED
+
+Conditions: `equals`, `in` (list), `not_in` (list), `contains` (regex), `not_contains` (regex) and `is_null` (bool).
+`not_in` and `not_contains` hold if none of the fields matches, null fields included. Missing fields (e.g. the ACLED
+fields of the GDELT events) are null. When several rules decide the same label of an event, the first rule of the file
+wins. The conditions are evaluated over whole DataFrames, not event by event.
+"""
+import threading
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from ..db_utils import configure_default_logger
+
+# Configure logging
+logger = configure_default_logger()
+
+RULE_STAGES = ["event_relevance", "event_type"]
+RULE_ANSWERS = ["Yes", "No"]
+RULE_CONDITIONS = ["equals", "in", "not_in", "contains", "not_contains", "is_null"]
+# Conditions holding if the condition they negate holds for none of the fields
+_NEGATED_CONDITIONS = {"not_in": "in", "not_contains": "contains"}
+
+
+def _field_mask(values, operator, operand):
+    if operator == "equals":
+        return values == operand
+    if operator == "in":
+        return values.isin(operand)
+    if operator == "contains":
+        return values.astype("string").str.contains(operand, case=False, regex=True, na=False).astype(bool)
+    return values.isna() if operand else values.notna()
+
+
+class RuleEngine:
+    """
+    Rules deciding labels of the events from their structured fields, see the module docstring.
+    """
+
+    def __init__(self, rules):
+        """
+        :param list rules: Rules, each a dict with name, stage, label (event_type only), answer, score and when
+        """
+        for position, rule in enumerate(rules):
+            name = rule.get("name", f"rule_{position}")
+            if rule.get("stage") not in RULE_STAGES:
+                raise ValueError(f"Invalid stage {rule.get('stage')} of the rule {name}. Please select from {RULE_STAGES}.")
+            if rule.get("answer") not in RULE_ANSWERS:
+                raise ValueError(f"Invalid answer {rule.get('answer')} of the rule {name}. Please select from {RULE_ANSWERS}.")
+            if rule["stage"] == "event_type" and not rule.get("label"):
+                raise ValueError(f"label of the event_type rule {name} is required")
+            if not rule.get("when"):
+                raise ValueError(f"when of the rule {name} is required")
+            for condition in rule["when"]:
+                operators = [operator for operator in RULE_CONDITIONS if operator in condition]
+                if "field" not in condition or len(operators) != 1:
+                    raise ValueError(f"Invalid condition {condition} of the rule {name}: a field and one of {RULE_CONDITIONS} are required")
+        self.rules = [{"name": rule.get("name", f"rule_{position}"), **rule} for position, rule in enumerate(rules)]
+
+    @staticmethod
+    def from_yaml(path):
+        with open(path, "r") as f:
+            return RuleEngine((yaml.safe_load(f) or {}).get("rules", []) or [])
+
+    def match(self, df):
+        """
+        Whether each rule holds for each event.
+
+        :return pd.DataFrame: One boolean column per rule, indexed as `df`
+        """
+        matches = {}
+        for rule in self.rules:
+            mask = pd.Series(True, index=df.index)
+            for condition in rule["when"]:
+                operator = next(operator for operator in RULE_CONDITIONS if operator in condition)
+                fields = condition["field"] if isinstance(condition["field"], list) else [condition["field"]]
+                condition_mask = pd.Series(False, index=df.index)
+                for field in fields:
+                    values = df[field] if field in df.columns else pd.Series(None, index=df.index, dtype=object)
+                    condition_mask |= _field_mask(values, _NEGATED_CONDITIONS.get(operator, operator), condition[operator])
+                mask &= ~condition_mask if operator in _NEGATED_CONDITIONS else condition_mask
+            matches[rule["name"]] = mask
+        return pd.DataFrame(matches, index=df.index, columns=[rule["name"] for rule in self.rules])
+
+    def decisions(self, df, stage, labels=None):
+        """
+        Labels of the events decided by the rules of `stage`.
+
+        :param pd.DataFrame df: Events
+        :param str stage: "event_relevance" or "event_type"
+        :param list labels: Labels of the stage, e.g. the event types. The event_relevance rules decide the label "relevance"
+        :return list: A dict per event, the decided labels to their answer, score and rule, e.g.
+            {"female": {"answer": "Yes", "score": 1.0, "rule": "women_actor_female"}}
+        """
+        labels = labels or ["relevance"]
+        stage_rules = [rule for rule in self.rules if rule["stage"] == stage]
+        for rule in stage_rules:
+            if rule.get("label", "relevance") not in labels:
+                raise ValueError(f"Invalid label {rule.get('label')} of the rule {rule['name']}. Please select from {labels}.")
+        matches = self.match(df)
+        # Rule deciding each label of each event, -1 if none. The first matching rule wins
+        deciding_rules = {label: np.full(len(df), -1) for label in labels}
+        for position in reversed(range(len(stage_rules))):
+            rule = stage_rules[position]
+            deciding_rules[rule.get("label", "relevance")][matches[rule["name"]].to_numpy()] = position
+        decisions = [{} for _ in range(len(df))]
+        for label, rule_positions in deciding_rules.items():
+            for event_idx in np.flatnonzero(rule_positions >= 0):
+                rule = stage_rules[rule_positions[event_idx]]
+                score = rule.get("score", 1.0 if rule["answer"] == "Yes" else 0.0)
+                decisions[event_idx][label] = {"answer": rule["answer"], "score": score, "rule": rule["name"]}
+        logger.info(f"{stage} labels decided by the rules: { {label: int((rule_positions >= 0).sum()) for label, rule_positions in deciding_rules.items()} }")
+        return decisions
+
+    def fired(self, df):
+        """
+        Names of the rules holding for each event, separated by "; ", e.g. for a "rules_fired" column.
+        """
+        matches = self.match(df)
+        return pd.Series(["; ".join(matches.columns[row]) for row in matches.to_numpy()], index=df.index, dtype=object)
+
+
+_RULE_ENGINES = {}
+_RULE_ENGINES_LOCK = threading.Lock()
+
+
+def get_rule_engine(rules_path):
+    """
+    Get the rules of the YAML file at `rules_path`. They are loaded on first use and shared afterwards.
+    """
+    with _RULE_ENGINES_LOCK:
+        if rules_path not in _RULE_ENGINES:
+            _RULE_ENGINES[rules_path] = RuleEngine.from_yaml(rules_path)
+            logger.info(f"Loaded {len(_RULE_ENGINES[rules_path].rules)} rules from {rules_path}")
+        return _RULE_ENGINES[rules_path]
+
+
+def rule_answer(answer, score, tag="answer"):
+    """
+    LLM answer text equivalent to a decision of the rules, parsed as the answers of the LLM.
+    """
+    return f"<{tag}>{answer}</{tag}><score>{score}</score>"
+
+
+class DecidedPrompts:
+    """
+    Prompts answered by the rules among the prompts of a stage. Only the other prompts are dispatched to the LLM, see
+    `pending`, and the answers of both are merged back in the order of the prompts, see `merge_answers`.
+    """
+
+    def __init__(self, decided_answers, num_prompts):
+        """
+        :param dict decided_answers: Answer of the decided prompts by position, see rule_answer
+        :param int num_prompts: Number of prompts
+        """
+        self.decided_answers = decided_answers
+        self.positions = [position for position in range(num_prompts) if position not in decided_answers]
+
+    def pending(self, items):
+        """
+        The items of `items` (prompts, or any list aligned with the prompts) of the prompts sent to the LLM.
+        """
+        return [items[position] for position in self.positions]
+
+    def on_answer(self, callback):
+        """
+        Answer callback of the dispatch of the pending prompts, calling `callback` with the position of the prompt
+        among all the prompts. The decided answers are passed to `callback` first.
+        """
+        for position, answer in self.decided_answers.items():
+            callback(position, answer)
+        return lambda position, answer: callback(self.positions[position], answer)
+
+    def merge_answers(self, pending_answers):
+        answers = [self.decided_answers.get(position) for position in range(len(self.positions) + len(self.decided_answers))]
+        for position, answer in zip(self.positions, pending_answers):
+            answers[position] = answer
+        return answers
+
+    def merge_sources(self, pending_sources):
+        """
+        Sources of the answers of all the prompts: "rule" for the decided prompts, `pending_sources` for the others.
+        """
+        sources = ["rule"] * (len(self.positions) + len(self.decided_answers))
+        for position, source in zip(self.positions, pending_sources):
+            sources[position] = source
+        return sources
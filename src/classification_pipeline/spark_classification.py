@@ -0,0 +1,186 @@
+"""
+Classification of the events on a Spark cluster.
+
+The events are partitioned across the executors and each partition runs the event relevance classification, then
+the event type classification of its relevant events, inside `mapInPandas`. Each partition calls the LLM with a slice
+of the rate limits of the run, see stage_config_slice, and the predictions are gathered in the order of the events,
+with the LLM usage and telemetry of the partitions.
+Runs on a Databricks cluster, or locally with the "local[*]" master.
+"""
+import glob
+import json
+import math
+import os
+import pickle
+import tempfile
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from ..db_utils import configure_default_logger
+from ..utils.checkpoint import close_prediction_checkpoint
+from ..utils.llm_metrics import clear_llm_metrics, get_llm_metrics_state, merge_llm_metrics_state
+from ..utils.llm_telemetry import get_llm_telemetry
+from ..utils.prediction_ledger import event_predictions, merge_predictions
+
+try:
+    from pyspark import TaskContext
+    from pyspark.sql import SparkSession
+except ImportError:
+    # pyspark is optional, it is only needed in Spark mode. It is part of the Databricks runtime
+    SparkSession = None
+
+# Configure logging
+logger = configure_default_logger()
+
+# Settings of the rate limits divided between the partitions running at the same time
+RATE_LIMIT_SLICED_KEYS = ["requests_per_second", "tokens_per_minute", "max_concurrency"]
+
+
+def get_spark_session(master=None):
+    """
+    Get the active Spark session (e.g. of the Databricks cluster), or create one with `master`, e.g. "local[*]" to run
+    on the driver without a cluster. The src package is shipped to the executors.
+    """
+    if SparkSession is None:
+        raise ImportError("Spark mode requires pyspark: pip install pyspark")
+    builder = SparkSession.builder.appName("ceha_classification")
+    if master:
+        builder = builder.master(master)
+    spark = builder.getOrCreate()
+    src_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    src_zip_path = os.path.join(tempfile.mkdtemp(), "src.zip")
+    with zipfile.ZipFile(src_zip_path, "w") as src_zip:
+        for folder, _, files in os.walk(src_folder):
+            for file in files:
+                if file.endswith(".py"):
+                    path = os.path.join(folder, file)
+                    src_zip.write(path, os.path.relpath(path, os.path.dirname(src_folder)))
+    spark.sparkContext.addPyFile(src_zip_path)
+    return spark
+
+
+def spark_task_slots(spark, num_partitions):
+    """
+    Number of partitions classified at the same time: the partitions, up to the cores of the cluster.
+    """
+    return max(1, min(num_partitions, spark.sparkContext.defaultParallelism))
+
+
+def rate_limit_slice(rate_limit, num_slices):
+    """
+    Slice of the rate limits (requests_per_second, tokens_per_minute, max_concurrency) of a partition, when
+    `num_slices` partitions call the LLM at the same time.
+    """
+    rate_limit = dict(rate_limit or {})
+    for key in RATE_LIMIT_SLICED_KEYS:
+        if rate_limit.get(key):
+            rate_limit[key] = max(1, math.floor(rate_limit[key] / num_slices)) if key == "max_concurrency" else rate_limit[key] / num_slices
+    return rate_limit
+
+
+def stage_config_slice(stage_config, num_slices):
+    """
+    Settings of a classification stage (see load_stage_config of db_model_pipeline) for a partition, when `num_slices`
+    partitions call the LLM at the same time: its rate limits, those of its hedging, mistralai_rps and max_concurrency
+    are divided between the partitions.
+    """
+    hedging = stage_config.get("hedging")
+    return {
+        **stage_config,
+        "mistralai_rps": stage_config.get("mistralai_rps", 0) / num_slices,
+        "max_concurrency": max(1, stage_config.get("max_concurrency", 8) // num_slices),
+        "rate_limit": rate_limit_slice(stage_config.get("rate_limit"), num_slices),
+        "hedging": {**hedging, "rate_limit": rate_limit_slice(hedging.get("rate_limit"), num_slices)} if hedging else None,
+    }
+
+
+def partition_checkpoint_path(checkpoint_path, partition_id):
+    """
+    Checkpoint of a partition: the partitions of a run are checkpointed to separate files next to `checkpoint_path`.
+    """
+    root, extension = os.path.splitext(checkpoint_path)
+    return f"{root}_part{partition_id}{extension}"
+
+
+def partition_checkpoint_paths(checkpoint_path):
+    """
+    Existing checkpoints of the partitions of `checkpoint_path`, of any number of partitions.
+    """
+    root, extension = os.path.splitext(checkpoint_path)
+    return sorted(glob.glob(f"{glob.escape(root)}_part[0-9]*{extension}"))
+
+
+def classify_partition(batches, run_event_relevance, run_event_type, run_config):
+    """
+    mapInPandas function classifying the events of a partition, see run_spark_classification.
+
+    :param batches: Iterator of DataFrames with the position of the events ("_row_position") and the pickled events ("event")
+    :return: Iterator of DataFrames with the position of the events and their predictions as JSON, see event_predictions,
+        then a last row with the LLM usage and telemetry of the partition as JSON ("metrics")
+    """
+    # The Python workers are reused by the next tasks, the metrics of the partition start from zero
+    clear_llm_metrics()
+    get_llm_telemetry().clear()
+    if run_config.get("checkpoint_path"):
+        run_config = {**run_config, "checkpoint_path": partition_checkpoint_path(run_config["checkpoint_path"], TaskContext.get().partitionId())}
+    try:
+        for batch in batches:
+            events = pd.DataFrame([pickle.loads(event) for event in batch["event"]], index=batch["_row_position"].to_numpy())
+            if len(events) == 0:
+                continue
+            event_relevance_prediction, event_relevance_scores = run_event_relevance(events, run_config=run_config)
+            relevant_events = events[np.array(event_relevance_prediction) == "Yes"]
+            event_type_prediction, event_type_scores = run_event_type(relevant_events, run_config=run_config)
+            predictions = event_predictions(events.index, event_relevance_prediction, event_relevance_scores, relevant_events.index, event_type_prediction, event_type_scores)
+            yield pd.DataFrame({"_row_position": events.index, "predictions": [json.dumps(prediction) for prediction in predictions], "metrics": None})
+        metrics = {"llm_metrics": get_llm_metrics_state(), "llm_telemetry": get_llm_telemetry().state()}
+        yield pd.DataFrame({"_row_position": pd.array([None], dtype="Int64"), "predictions": None, "metrics": [json.dumps(metrics)]})
+    finally:
+        if run_config.get("checkpoint_path"):
+            # The Python workers are reused by the next tasks, e.g. those of the next run on the same cluster, which
+            # load the checkpoints of the run again
+            close_prediction_checkpoint(run_config["checkpoint_path"])
+
+
+def run_spark_classification(df_test, run_event_relevance, run_event_type, spark, num_partitions, run_config):
+    """
+    Classify the events of `df_test` on Spark: both stages run on each partition of the events.
+
+    :param pd.DataFrame df_test: Events
+    :param callable run_event_relevance: Runs the event relevance classification of a DataFrame of events and a run
+        config, with the settings of a partition, see run_event_relevance_classification and stage_config_slice
+    :param callable run_event_type: Runs the event type classification of a DataFrame of relevant events and a run config
+    :param SparkSession spark: Spark session, see get_spark_session
+    :param int num_partitions: Number of partitions of the events
+    :param dict run_config: Settings shared by the stages of the run, see stage_args. Its checkpoint is split in one
+        file per partition, see classify_partition
+    :return tuple: As run_streaming_classification, the relevance predictions and scores of the events of `df_test`, the
+        index of the relevant events and their type predictions and scores
+    """
+    if len(df_test) == 0:
+        return [], [], df_test.index[:0], [], []
+    # The events are pickled, their fields keep their types (e.g. NaN) and the prompts are the same as on the driver
+    events = pd.DataFrame({"_row_position": np.arange(len(df_test)), "event": [pickle.dumps(event) for event in df_test.to_dict("records")]})
+    spark_events = spark.createDataFrame(events, schema="_row_position long, event binary").repartition(num_partitions)
+    if run_config.get("checkpoint_path"):
+        # Each partition appends to its own file and resumes the events of all the checkpoints of the run: the events
+        # are looked up by source and Index, they are not assigned to the same partition when num_partitions changes
+        run_config = {**run_config, "checkpoint_resume_paths": [run_config["checkpoint_path"], *partition_checkpoint_paths(run_config["checkpoint_path"])]}
+    logger.info(f"Classifying {len(df_test)} events on Spark in {num_partitions} partitions")
+    results = spark_events.mapInPandas(
+        lambda batches: classify_partition(batches, run_event_relevance, run_event_type, run_config),
+        schema="_row_position long, predictions string, metrics string",
+    ).toPandas()
+    # The LLM calls are made on the executors, their usage and telemetry are added to those of the driver
+    for metrics in results["metrics"].dropna():
+        metrics = json.loads(metrics)
+        merge_llm_metrics_state(metrics["llm_metrics"])
+        get_llm_telemetry().merge(metrics["llm_telemetry"])
+    results = results[results["metrics"].isna()]
+    # The partitions complete in any order, the predictions are put back in the order of the events
+    results = results.sort_values("_row_position")
+    if len(results) != len(df_test):
+        raise RuntimeError(f"Spark classification returned {len(results)} predictions for {len(df_test)} events")
+    return merge_predictions(df_test.index, [json.loads(prediction) for prediction in results["predictions"]])
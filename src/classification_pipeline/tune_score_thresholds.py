@@ -0,0 +1,143 @@
+"""
+Tune the thresholds of the "score" answer mode on the CEHA dev split and report them on the test split.
+
+In "score" mode the LLM answers with a single token and the probability of "Yes" is read from its logprobs. The LLM
+scores every event of a split once; each threshold of the grid then labels the events offline, so the whole grid
+costs a single LLM run per split. The threshold with the best dev F1 is selected for the relevance and for each
+event type (on the relevant events), and its test F1 is reported next to the one of the default threshold.
+
+Usage (from the repository root):
+    python -m src.classification_pipeline.tune_score_thresholds --llm_name gpt4 --openai_api_key <key>
+"""
+import argparse
+
+from .event_relevance_classification import predict_event_relevance
+from .event_type_classification import EVENT_TYPE_LABELS, predict_event_type
+from ..utils.evaluation import event_type_scorer
+from ..utils.llm_dispatch import EXECUTION_MODES
+from ..utils.utils import load_data
+
+THRESHOLDS = [round(0.05 * step, 2) for step in range(1, 20)]
+DEFAULT_THRESHOLD = 0.5
+# Gold label of each event type, as written by clean_label
+EVENT_TYPE_NAMES = {
+    "tribal": "Tribal/communal/ethnic conflict",
+    "religious": "Religious conflict",
+    "female": "Socio-political violence against women",
+    "climate": "Climate-related security risk",
+}
+
+
+def threshold_f1(scores, gold_labels, threshold):
+    """
+    F1 (in percent) of the "Yes" labels of the events scored at least `threshold`.
+    """
+    system_labels = ["Yes" if score >= threshold else "No" for score in scores]
+    return float(event_type_scorer(system_labels, gold_labels)["f1"][:-1])
+
+
+def tune_threshold(scores, gold_labels, thresholds=THRESHOLDS):
+    """
+    Returns the threshold of `thresholds` with the best F1, the one closest to DEFAULT_THRESHOLD on ties.
+    """
+    return max(thresholds, key=lambda threshold: (threshold_f1(scores, gold_labels, threshold), -abs(threshold - DEFAULT_THRESHOLD)))
+
+
+def score_split(args, df_train, df_eval):
+    """
+    Scores the events of `df_eval` in "score" mode.
+
+    Returns:
+        dict: "relevance" and each event type -> (scores, gold_labels). The event types are scored on the relevant events only.
+    """
+    score_args = argparse.Namespace(**{**vars(args), "answer_mode": "score", "type_prompt_mode": "per_label", "pack_size": 1})
+    gold_labels, _, scores = predict_event_relevance(score_args, df_train, df_eval, return_scores=True)
+    results = {"relevance": (scores, gold_labels)}
+
+    df_train_relevant = df_train[df_train["Is the event relevant?_DM"] == "Yes"]
+    df_eval_relevant = df_eval[df_eval["Is the event relevant?_DM"] == "Yes"]
+    gold_label_sets, _, type_scores = predict_event_type(score_args, df_train_relevant, df_eval_relevant, return_scores=True)
+    for label in EVENT_TYPE_LABELS:
+        results[label] = (
+            [event_scores[label] for event_scores in type_scores],
+            ["Yes" if EVENT_TYPE_NAMES[label] in label_set else "No" for label_set in gold_label_sets],
+        )
+    return results
+
+
+def tune_score_thresholds(args, df_train, df_dev, df_test, thresholds=THRESHOLDS):
+    """
+    Returns:
+        list: One dict per stage ("relevance" and each event type) with the threshold tuned on `df_dev`
+        and the dev / test F1 of the default and tuned thresholds.
+    """
+    dev_results = score_split(args, df_train, df_dev)
+    test_results = score_split(args, df_train, df_test)
+    results = []
+    for stage, (dev_scores, dev_gold_labels) in dev_results.items():
+        test_scores, test_gold_labels = test_results[stage]
+        threshold = tune_threshold(dev_scores, dev_gold_labels, thresholds)
+        results.append(
+            {
+                "stage": stage,
+                "threshold": threshold,
+                "dev_f1_default": threshold_f1(dev_scores, dev_gold_labels, DEFAULT_THRESHOLD),
+                "dev_f1": threshold_f1(dev_scores, dev_gold_labels, threshold),
+                "test_f1_default": threshold_f1(test_scores, test_gold_labels, DEFAULT_THRESHOLD),
+                "test_f1": threshold_f1(test_scores, test_gold_labels, threshold),
+            }
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune the score thresholds on the CEHA dev split")
+    parser.add_argument("--data_path", type=str, default="data/CEHA_dataset.csv", help="path of the CEHA dataset")
+    parser.add_argument("--llm_name", type=str, default="gpt4", help="llm name, needs logprobs support")
+    parser.add_argument(
+        "--max_tokens", type=int, default=512, help="max tokens for llm"
+    )
+    parser.add_argument(
+        "--temperature", type=float, default=0.0, help="temperature of llm"
+    )
+    parser.add_argument(
+        "--few_shot_num", type=int, default=0, help="number of few shot examples"
+    )
+    parser.add_argument(
+        "--openai_api_key", type=str, default=None, help="openai api key"
+    )
+    parser.add_argument(
+        "--mistralai_api_key", type=str, default=None, help="mistral.ai api key"
+    )
+    parser.add_argument(
+        "--mistralai_rps", type=float, default=0, help="mistral.ai request per second limit"
+    )
+    parser.add_argument(
+        "--execution_mode", type=str, default="async", choices=[mode for mode in EXECUTION_MODES if mode != "batch"], help="how LLM calls are executed"
+    )
+    parser.add_argument(
+        "--max_concurrency", type=int, default=8, help="max number of concurrent LLM calls in async mode"
+    )
+    parser.add_argument(
+        "--llm_cache_path", type=str, default=None, help="path of the LLM response cache, to rerun the report without new LLM calls"
+    )
+    args = parser.parse_args()
+    if args.llm_cache_path:
+        args.llm_cache = {"path": args.llm_cache_path}
+
+    # Load Data
+    df_train, df_dev, df_test = load_data(args.data_path)
+
+    results = tune_score_thresholds(args, df_train, df_dev, df_test)
+
+    print(f"llm: {args.llm_name}, few_shot_num: {args.few_shot_num}, default threshold: {DEFAULT_THRESHOLD}")
+    for result in results:
+        print(
+            f"{result['stage']}: threshold: {result['threshold']}; dev f1: {result['dev_f1']:.2f} ({result['dev_f1_default']:.2f} at default); "
+            f"test f1: {result['test_f1']:.2f} ({result['test_f1_default']:.2f} at default)"
+        )
+    print("score_threshold of event_type_classification: " + str({result["stage"]: result["threshold"] for result in results if result["stage"] != "relevance"}))
+
+
+if __name__ == "__main__":
+    main()
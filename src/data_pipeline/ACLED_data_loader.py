@@ -59,8 +59,8 @@ class ACLED_data_loader():
         os.makedirs(final_data_folder, exist_ok=True)
         final_output_filepath = os.path.join(final_data_folder, f'acled_{start_date}_{end_date}.csv')
 
-        # output columns
-        cols = ["ACLED/GDELT", "Index", "Time", "Country", "Actor 1", "Actor 2", "Event Description"]
+        # output columns. The structured ACLED fields are kept for the rules of the model pipeline
+        cols = ["ACLED/GDELT", "Index", "Time", "Country", "Actor 1", "Actor 2", "Event Description", "Event Type", "Sub Event Type", "Civilian Targeting", "Actor 1 Type", "Actor 2 Type"]
 
         # get events
         print("==" * 30)
@@ -87,7 +87,12 @@ class ACLED_data_loader():
                 "actor1_merged": "Actor 1",
                 "actor2_merged": "Actor 2",
                 # "url": "Article URL",
-                "notes": "Event Description"
+                "notes": "Event Description",
+                "event_type": "Event Type",
+                "sub_event_type": "Sub Event Type",
+                "civilian_targeting": "Civilian Targeting",
+                "inter1": "Actor 1 Type",
+                "inter2": "Actor 2 Type",
             })
         else:
             print("No data found for this time range.")
@@ -7,6 +7,7 @@ import time
 from datetime import datetime, timedelta
 from newspaper import Article
 from multiprocessing import Pool
+from .near_duplicates import near_duplicate_clusters
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -145,7 +146,7 @@ class GDELT_data_loader():
         
 
     
-    def get_gdelt_relevant_events_with_scraped_text(self, start_date, end_date, data_folder, store_intermediate_data=False):
+    def get_gdelt_relevant_events_with_scraped_text(self, start_date, end_date, data_folder, store_intermediate_data=False, near_duplicates=None):
         """
         Get GDELT Data from online database, apply related filters and merge with scraped text
 
@@ -154,6 +155,10 @@ class GDELT_data_loader():
             end_date: String. Format as "YYYY-MM-dd", e.g. 2024-01-04 (Inclusive)
             data_folder: String, base data folder to save data
             store_intermediate_data: Boolean. Whether to store intermediate data or not.
+            near_duplicates: Dict. Optional. Cluster the near-duplicate articles (e.g. syndicated copies of a wire story under different urls) into a "cluster_id" column, the Index of the first article of the cluster. Only one article per cluster is classified by the model pipeline. Keys:
+                - threshold (float, default=0.8): Estimated Jaccard similarity of the texts above which two articles are near-duplicates
+                - num_perm (int, default=128): Number of MinHash permutations
+                - shingle_size (int, default=5): Number of consecutive words per shingle
         """
         intermediate_data_folder = os.path.join(data_folder, "intermediate_data", "gdelt")
         final_data_folder = os.path.join(data_folder, "final_data_for_classification")
@@ -208,6 +213,17 @@ class GDELT_data_loader():
             "text": "Event Description"
         })
         cols = ["ACLED/GDELT", "Index", "Time", "Country", "Actor 1", "Actor 2", "Article URL", "Event Description"]
+        if near_duplicates:
+            s_time = time.time()
+            representatives = near_duplicate_clusters(
+                gdelt["Event Description"],
+                threshold=near_duplicates.get("threshold", 0.8),
+                num_perm=near_duplicates.get("num_perm", 128),
+                shingle_size=near_duplicates.get("shingle_size", 5),
+            )
+            gdelt["cluster_id"] = gdelt["Index"].values[representatives]
+            cols.append("cluster_id")
+            print(f"Near-duplicate clustering Completed: {gdelt['cluster_id'].nunique()} clusters of {len(gdelt)} articles. It takes {int(time.time() - s_time)} seconds.")
         gdelt[cols].to_csv(final_output_filepath, index=False)
         print(f"Finally, we got {len(gdelt)} GDELT data for classifications")
         print(f"Data is saved to {final_output_filepath}")
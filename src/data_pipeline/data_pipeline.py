@@ -10,7 +10,7 @@ def get_last_friday():
     previous_friday = last_friday - timedelta(days=7)
     return previous_friday, last_friday
 
-def run_data_pipeline(data_source, start_date, end_date, data_folder, store_intermediate_data, acled_email, acled_key):
+def run_data_pipeline(data_source, start_date, end_date, data_folder, store_intermediate_data, acled_email, acled_key, near_duplicates=None):
     acled_data = pd.DataFrame()
     gdelt_data = pd.DataFrame()
     for source in set(data_source):
@@ -19,7 +19,7 @@ def run_data_pipeline(data_source, start_date, end_date, data_folder, store_inte
             acled_data = acled_data_loader.get_acled_relevant_events(start_date, end_date, data_folder, store_intermediate_data)
         if source == "GDELT":
             gdelt_data_loader = GDELT_data_loader()
-            gdelt_data = gdelt_data_loader.get_gdelt_relevant_events_with_scraped_text(start_date, end_date, data_folder, store_intermediate_data)
+            gdelt_data = gdelt_data_loader.get_gdelt_relevant_events_with_scraped_text(start_date, end_date, data_folder, store_intermediate_data, near_duplicates)
 
     final_data = pd.concat([acled_data, gdelt_data], ignore_index=True)
 
@@ -50,6 +50,7 @@ if __name__ == "__main__":
     parser.add_argument("--acled_email", type=str, default=None, help="ACLED login info: Email")
     parser.add_argument("--acled_key", type=str, default=None, help="ACLED login info: Key")
     parser.add_argument("--store_intermediate_data", action="store_true", help="Store intermediate data")
+    parser.add_argument("--near_duplicate_threshold", type=float, default=0, help="Cluster the near-duplicate GDELT articles above this estimated Jaccard similarity, e.g. 0.8. Default as 0, no clustering")
 
     args, unknown_args = parser.parse_known_args()
     start_date = args.start_date
@@ -59,6 +60,7 @@ if __name__ == "__main__":
     store_intermediate_data = args.store_intermediate_data
     acled_email = args.acled_email
     acled_key = args.acled_key
+    near_duplicates = {"threshold": args.near_duplicate_threshold} if args.near_duplicate_threshold else None
 
     # Default the start date as previous Saturday and end date as last Friday when it is not provided
     if start_date is None or end_date is None:
@@ -71,7 +73,7 @@ if __name__ == "__main__":
     verify_args(start_date, end_date, data_source, acled_email, acled_key)
 
     # Data loader
-    run_data_pipeline(data_source, start_date, end_date, data_folder, store_intermediate_data, acled_email, acled_key)
+    run_data_pipeline(data_source, start_date, end_date, data_folder, store_intermediate_data, acled_email, acled_key, near_duplicates)
     
 
 
@@ -0,0 +1,127 @@
+import re
+import zlib
+import numpy as np
+
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_WORD_PATTERN = re.compile(r"\w+")
+# Number of candidate pairs compared at once
+_COMPARE_CHUNK_SIZE = 50000
+
+
+def lsh_parameters(threshold, num_perm, recall=0.95):
+    """
+    Number of bands and of rows per band of the LSH index: the most rows per band (the fewest candidate pairs) with
+    which two texts of similarity `threshold` share a bucket with probability `recall`. The candidate pairs below the
+    threshold are dropped when their signatures are compared.
+
+    Args:
+        threshold: Float. Estimated Jaccard similarity above which two texts are near-duplicates
+        num_perm: Int. Number of MinHash permutations, the length of the signatures
+        recall: Float. Probability that two texts of similarity `threshold` are compared
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        if 1 - (1 - threshold ** rows) ** bands >= recall:
+            best = (bands, rows)
+    return best
+
+
+def _shingle_hashes(text, shingle_size):
+    """
+    32-bit hashes of the word shingles of a text: the hashes of its lower-cased words combined `shingle_size` at a time.
+    """
+    words = _WORD_PATTERN.findall(text.lower())
+    if not words:
+        return None
+    hashes = np.fromiter(map(zlib.crc32, map(str.encode, words)), dtype=np.uint64, count=len(words))
+    # Texts shorter than a shingle are a single shingle
+    size = min(shingle_size, len(hashes))
+    count = len(hashes) - size + 1
+    shingles = hashes[:count].copy()
+    for offset in range(1, size):
+        shingles = (shingles * np.uint64(1000003) + hashes[offset: offset + count]) & _MAX_HASH
+    return np.unique(shingles)
+
+
+def minhash_signatures(texts, num_perm=128, shingle_size=5, seed=1):
+    """
+    MinHash signatures of texts, one row of `num_perm` 32-bit values per text, in a single uint32 matrix
+    (num_perm * 4 bytes per text). Texts without words get an empty signature, see `has_signature`.
+
+    Args:
+        texts: Iterable of strings
+        num_perm: Int. Number of MinHash permutations
+        shingle_size: Int. Number of consecutive words per shingle
+        seed: Int. Seed of the permutations, the same signatures are computed across runs
+
+    Returns:
+        - signatures (np.ndarray): uint32 matrix of shape (len(texts), num_perm)
+        - has_signature (np.ndarray): bool array, False for the texts without words
+    """
+    texts = list(texts)
+    # Permutations as multiply-add-shift hash functions: the high 32 bits of (a * x + b) mod 2^64, with a odd
+    rng = np.random.default_rng(seed)
+    a = (rng.integers(0, 1 << 64, size=num_perm, dtype=np.uint64) | np.uint64(1))[:, None]
+    b = rng.integers(0, 1 << 64, size=num_perm, dtype=np.uint64)[:, None]
+    signatures = np.zeros((len(texts), num_perm), dtype=np.uint32)
+    has_signature = np.zeros(len(texts), dtype=bool)
+    for i, text in enumerate(texts):
+        if not isinstance(text, str):
+            continue
+        shingles = _shingle_hashes(text, shingle_size)
+        if shingles is None:
+            continue
+        signatures[i] = ((a * shingles[None, :] + b) >> np.uint64(32)).min(axis=1)
+        has_signature[i] = True
+    return signatures, has_signature
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def near_duplicate_clusters(texts, threshold=0.8, num_perm=128, shingle_size=5, seed=1):
+    """
+    Cluster the near-duplicate texts, e.g. the syndicated copies of a wire story. The MinHash signatures of the texts
+    are bucketed by band (LSH), and the texts sharing a bucket whose estimated Jaccard similarity is above `threshold`
+    are merged in the same cluster.
+
+    Args:
+        texts: Iterable of strings
+        threshold: Float. Estimated Jaccard similarity of the shingles above which two texts are near-duplicates
+        num_perm: Int. Number of MinHash permutations, more are more accurate and take more memory
+        shingle_size: Int. Number of consecutive words per shingle
+        seed: Int. Seed of the MinHash permutations
+
+    Returns:
+        np.ndarray. Position of the representative of the cluster of each text: the first text of the cluster
+    """
+    signatures, has_signature = minhash_signatures(texts, num_perm=num_perm, shingle_size=shingle_size, seed=seed)
+    parent = np.arange(len(signatures))
+    candidates = np.flatnonzero(has_signature)
+    bands, rows = lsh_parameters(threshold, num_perm)
+    for band in range(bands):
+        band_values = np.ascontiguousarray(signatures[candidates, band * rows: (band + 1) * rows])
+        # Rows of the band as bytes, texts with the same bytes share the bucket
+        band_keys = band_values.view(np.dtype((np.void, band_values.dtype.itemsize * rows))).ravel()
+        _, first, inverse = np.unique(band_keys, return_index=True, return_inverse=True)
+        bucket_first = candidates[first[inverse.ravel()]]
+        in_bucket = np.flatnonzero(bucket_first != candidates)
+        if len(in_bucket) == 0:
+            continue
+        # Each text is compared with the first text of its bucket, the estimated similarity drops the false candidates.
+        # The comparisons are chunked to bound the memory of large backfills
+        for start in range(0, len(in_bucket), _COMPARE_CHUNK_SIZE):
+            members = candidates[in_bucket[start: start + _COMPARE_CHUNK_SIZE]]
+            firsts = bucket_first[in_bucket[start: start + _COMPARE_CHUNK_SIZE]]
+            similar = (signatures[members] == signatures[firsts]).mean(axis=1) >= threshold
+            for member, first_member in zip(members[similar], firsts[similar]):
+                root_member, root_first = _find(parent, member), _find(parent, first_member)
+                if root_member != root_first:
+                    # The root of a cluster is its first text
+                    parent[max(root_member, root_first)] = min(root_member, root_first)
+    return np.array([_find(parent, i) for i in range(len(parent))], dtype=np.int64)
@@ -0,0 +1,216 @@
+import json
+import logging
+import os
+import threading
+
+from .llm_cache import make_cache_key
+
+logger = logging.getLogger(__name__)
+
+
+def event_key(event):
+    """
+    Key of an event in the checkpoint: its source and its Index in that source.
+    """
+    return event["ACLED/GDELT"], str(event["Index"])
+
+
+def _ends_with_newline(path):
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+class PredictionCheckpoint:
+    """
+    Append-only checkpoint of the LLM answers of the events of a run, to resume an interrupted run without paying
+    for the answered events again.
+
+    The checkpoint is a JSON lines file with one line per completed event: the stage, the source and Index of the
+    event, a fingerprint of its LLM requests and its answers. Each line is flushed and synced to disk when the event
+    is completed. An answer is only reused if the event is asked the same requests, see EventCheckpoint.
+    """
+
+    def __init__(self, path, resume_paths=()):
+        """
+        :param str path: Path of the checkpoint file, e.g. checkpoints/run.jsonl. Created if missing, resumed otherwise
+        :param list resume_paths: Other checkpoint files of the run whose completed events are resumed too, e.g. those
+            of the other partitions of a Spark run. They are only read, the completed events are appended to `path`
+        """
+        self.path = path
+        self.resumed = 0
+        self.added = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+
+        for resume_path in resume_paths:
+            if resume_path != path and os.path.exists(resume_path):
+                self._load(resume_path)
+        if os.path.exists(path):
+            self._load(path)
+        elif os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self._entries:
+            logger.info(f"Loaded {len(self._entries)} completed events from the checkpoint {path}")
+        self._file = open(path, "a", encoding="utf-8")
+        if self._file.tell() and not _ends_with_newline(path):
+            # Terminate the incomplete last line, the next events are appended on their own lines
+            self._file.write("\n")
+
+    def _load(self, path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line of a checkpoint interrupted while writing is incomplete, its event is asked again
+                    logger.warning(f"Skipping an incomplete line of the checkpoint {path}")
+                    continue
+                self._entries[(entry["stage"], entry["source"], entry["index"])] = entry
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, stage, key, fingerprint):
+        """
+        Returns the checkpointed answers of an event of `stage`, or None if the event was not completed with the same
+        requests (`fingerprint`).
+        """
+        with self._lock:
+            entry = self._entries.get((stage, *key))
+        if entry is None or entry["fingerprint"] != fingerprint:
+            return None
+        with self._lock:
+            self.resumed += 1
+        return entry["answers"]
+
+    def add(self, stage, key, fingerprint, answers):
+        source, index = key
+        entry = {"stage": stage, "source": source, "index": index, "fingerprint": fingerprint, "answers": answers}
+        with self._lock:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._entries[(stage, source, index)] = entry
+            self.added += 1
+
+    def stats(self):
+        return {"path": self.path, "events": len(self), "resumed": self.resumed, "added": self.added}
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def remove(self):
+        """
+        Close and delete the checkpoint, once the results of the run are finalized.
+        """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# Checkpoints are shared by all the stages using the same file
+_PREDICTION_CHECKPOINTS = {}
+_PREDICTION_CHECKPOINTS_LOCK = threading.Lock()
+
+
+def get_prediction_checkpoint(path, resume_paths=()):
+    """
+    Get the checkpoint stored at `path`. It is opened on first use, resuming the events of `resume_paths` too, and
+    shared afterwards.
+    """
+    with _PREDICTION_CHECKPOINTS_LOCK:
+        if path not in _PREDICTION_CHECKPOINTS or _PREDICTION_CHECKPOINTS[path]._file is None:
+            _PREDICTION_CHECKPOINTS[path] = PredictionCheckpoint(path, resume_paths)
+        return _PREDICTION_CHECKPOINTS[path]
+
+
+def close_prediction_checkpoint(path):
+    """
+    Close the checkpoint stored at `path`, if open. The next get_prediction_checkpoint loads it again.
+    """
+    with _PREDICTION_CHECKPOINTS_LOCK:
+        checkpoint = _PREDICTION_CHECKPOINTS.pop(path, None)
+    if checkpoint is not None:
+        checkpoint.close()
+
+
+class EventCheckpoint:
+    """
+    Checkpointed LLM answers of the events of a stage. The events already in `checkpoint` are not sent again: only
+    the pending events and their prompts are dispatched, with `on_answer` as the answer callback, and each event is
+    added to the checkpoint as soon as all its prompts are answered. Without checkpoint all the events are pending.
+    """
+
+    def __init__(self, checkpoint, stage, events, prompts, prompts_per_event, model_name, request_params):
+        """
+        :param PredictionCheckpoint checkpoint: Checkpoint of the run, None to disable checkpointing
+        :param str stage: Stage of the events, e.g. "event_relevance"
+        :param list events: Events of the stage, with their source and Index, see event_key
+        :param list prompts: Prompts of the events, event-major: `prompts_per_event` consecutive prompts per event
+        :param str model_name: Model of the requests, part of the fingerprint of the events
+        :param dict request_params: Sampling parameters and answer settings of the requests, part of the fingerprint
+        """
+        self.checkpoint = checkpoint
+        self.stage = stage
+        self.prompts_per_event = prompts_per_event
+        self.keys = [event_key(event) for event in events]
+        self.answers = [None] * len(prompts)
+        self.fingerprints = [None] * len(events)
+        self.pending = list(range(len(events)))
+        if checkpoint is None:
+            return
+
+        for event_idx in range(len(events)):
+            event_prompts = prompts[prompts_per_event * event_idx: prompts_per_event * (event_idx + 1)]
+            self.fingerprints[event_idx] = make_cache_key(model_name, event_prompts, request_params)
+            answers = checkpoint.get(stage, self.keys[event_idx], self.fingerprints[event_idx])
+            if answers is not None and len(answers) == prompts_per_event:
+                self.answers[prompts_per_event * event_idx: prompts_per_event * (event_idx + 1)] = answers
+        self.pending = [event_idx for event_idx in range(len(events)) if self.answers[prompts_per_event * event_idx] is None]
+        logger.info(f"{len(events) - len(self.pending)} {stage} events resumed from the checkpoint, {len(self.pending)} pending")
+
+    def pending_events(self, events):
+        return [events[event_idx] for event_idx in self.pending]
+
+    def pending_prompts(self, prompts):
+        """
+        The items of `prompts` (or of any list aligned with the prompts, e.g. the call labels) of the pending events.
+        """
+        return [prompts[self.prompts_per_event * event_idx + slot] for event_idx in self.pending for slot in range(self.prompts_per_event)]
+
+    def on_answer(self, position, answer):
+        """
+        Answer callback of the dispatch of the pending prompts: `position` is the index of the prompt among them.
+        """
+        event_idx = self.pending[position // self.prompts_per_event]
+        start = self.prompts_per_event * event_idx
+        self.answers[start + position % self.prompts_per_event] = answer
+        event_answers = self.answers[start: start + self.prompts_per_event]
+        if self.checkpoint is not None and all(answer is not None for answer in event_answers):
+            self.checkpoint.add(self.stage, self.keys[event_idx], self.fingerprints[event_idx], event_answers)
+
+    def merge_answers(self, pending_answers):
+        """
+        Returns the answers of all the events, from the checkpoint and from `pending_answers`, the answers of the
+        dispatched prompts.
+        """
+        for position, answer in enumerate(pending_answers):
+            event_idx = self.pending[position // self.prompts_per_event]
+            self.answers[self.prompts_per_event * event_idx + position % self.prompts_per_event] = answer
+        return list(self.answers)
+
+    def merge_sources(self, pending_sources):
+        """
+        Returns the sources of the answers of all the events (see ANSWER_SOURCES): "checkpoint" for the resumed events,
+        `pending_sources` for the dispatched prompts.
+        """
+        sources = ["checkpoint"] * len(self.answers)
+        for position, source in enumerate(pending_sources):
+            event_idx = self.pending[position // self.prompts_per_event]
+            sources[self.prompts_per_event * event_idx + position % self.prompts_per_event] = source
+        return sources
@@ -0,0 +1,388 @@
+"""
+Local stand-in for the OpenAI / Mistral.ai APIs, used to test the pipeline offline.
+
+It serves:
+- POST /v1/chat/completions with a server-side token bucket that rejects requests over the configured rate with
+  429s (with Retry-After and x-ratelimit-* headers), and optionally random 429s, 503s and hung requests.
+  The usage of the answers reports the prompt tokens of the prompt prefixes already seen as cached_tokens.
+- The files and batch endpoints of both providers (POST /v1/files, GET /v1/files/{id}/content,
+  POST /v1/batches, GET /v1/batches/{id}, POST /v1/batch/jobs, GET /v1/batch/jobs/{id}).
+  Batch jobs are processed in a background thread after `batch_delay` seconds.
+
+Usage:
+    python -m src.utils.fake_llm_server --port 8000 --rps 5 --rate_limit_error_rate 0.05
+
+Then point the LLM callers to it with base_url="http://127.0.0.1:8000/v1" (OpenAI)
+or base_url="http://127.0.0.1:8000" (Mistral.ai).
+"""
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeLLMState:
+    def __init__(self, rps=0, rate_limit_error_rate=0, latency=0.05, latency_jitter=0.05, batch_delay=1, server_error_rate=0, hang_rate=0, hang_seconds=30):
+        self.rps = rps
+        self.rate_limit_error_rate = rate_limit_error_rate
+        self.server_error_rate = server_error_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.batch_delay = batch_delay
+        self.lock = threading.Lock()
+        self.bucket = max(1.0, rps)
+        self.last_refill = time.monotonic()
+        self.request_count = 0
+        self.rate_limited_count = 0
+        self.server_error_count = 0
+        self.files = {}
+        self.batches = {}
+        self.prompt_prefixes = set()
+
+    def take(self):
+        """
+        Take a request from the bucket. Returns 0 if the request is accepted, otherwise the seconds until a request is available.
+        """
+        with self.lock:
+            self.request_count += 1
+            if self.rate_limit_error_rate and random.random() < self.rate_limit_error_rate:
+                self.rate_limited_count += 1
+                return 1.0
+            if not self.rps:
+                return 0
+            now = time.monotonic()
+            self.bucket = min(max(1.0, self.rps), self.bucket + (now - self.last_refill) * self.rps)
+            self.last_refill = now
+            if self.bucket < 1:
+                self.rate_limited_count += 1
+                return (1 - self.bucket) / self.rps
+            self.bucket -= 1
+            return 0
+
+    def cached_prompt_tokens(self, messages, chunk_tokens=128, min_tokens=1024):
+        """
+        Simulates the provider prompt prefix cache: returns the number of prompt tokens of the longest prefix already
+        seen, in `chunk_tokens` increments and only for prompts of at least `min_tokens` tokens (4 characters per token).
+        """
+        text = "".join(f"{m.get('role')}\n{m.get('content', '')}\n" for m in messages)
+        chunk = chunk_tokens * 4
+        if len(text) < min_tokens * 4:
+            return 0
+        prefixes = [hash(text[:end]) for end in range(chunk, len(text) + 1, chunk)]
+        with self.lock:
+            cached = 0
+            for idx, prefix in enumerate(prefixes):
+                if prefix not in self.prompt_prefixes:
+                    break
+                cached = (idx + 1) * chunk_tokens
+            self.prompt_prefixes.update(prefixes)
+        return cached if cached >= min_tokens else 0
+
+    def add_file(self, filename, content, purpose):
+        file_id = f"file-{uuid.uuid4().hex[:12]}"
+        with self.lock:
+            self.files[file_id] = {
+                "id": file_id,
+                "object": "file",
+                "bytes": len(content),
+                "created_at": int(time.time()),
+                "filename": filename,
+                "purpose": purpose,
+                "status": "processed",
+                "sample_type": "batch_request" if purpose == "batch" else "instruct",
+                "source": "upload",
+                "content": content,
+            }
+        return self.files[file_id]
+
+
+def _yes_no(text):
+    return "Yes" if re.search(r"\b(killed|attack|attacked|clash|clashes|fighting)\b", text, re.IGNORECASE) else "No"
+
+
+def fake_answer(messages):
+    """
+    Build a deterministic answer in the XML format expected by the prompts.
+    """
+    content = messages[-1]["content"] if messages else ""
+    packed_tags = re.findall(r'<(\w+) id="(\w+)">Answer</\1>', content)
+    if packed_tags:
+        # Packed prompt: one answer per article id
+        articles = dict(re.findall(r'<article id="(\w+)">(.*?)</article>', content, re.DOTALL))
+        return "<response>\n" + "".join(
+            f'<{tag} id="{event_id}">{_yes_no(articles.get(event_id, ""))}</{tag}>\n' for tag, event_id in packed_tags
+        ) + "</response>"
+    # Judge the article only, the guidance mentions attacks too
+    answer = _yes_no(content.partition("News Article:")[2])
+    # The answer format is in the system prompt of compact few-shot prompts
+    answer_format = content + (messages[0]["content"] if messages[0]["role"] == "system" else "")
+    if "<response>" not in answer_format:
+        # Single-word answer of the "score" answer mode
+        return answer
+    if "<tribal>" in answer_format:
+        tags = ["tribal", "religious", "female", "climate"]
+    elif "<event_type>" in answer_format:
+        tags = ["event_type"]
+    else:
+        tags = ["answer"]
+    # Reasons are only given when the answer format asks for one
+    reason = "<reason>The article describes a single event matching the guidance.</reason>\n" if "<reason>" in answer_format else ""
+    return "<response>\n" + "".join(f"<{tag}>{answer}</{tag}>\n" for tag in tags) + reason + "</response>"
+
+
+def fake_completion(request, state=None):
+    content = fake_answer(request.get("messages", []))
+    # Honor the stop sequences (not returned, as the providers do) and max_tokens
+    finish_reason = "stop"
+    stop = request.get("stop") or []
+    for stop_sequence in [stop] if isinstance(stop, str) else stop:
+        if stop_sequence in content:
+            content = content[:content.index(stop_sequence)]
+    if request.get("max_tokens") and len(content) // 4 > request["max_tokens"]:
+        content = content[:4 * request["max_tokens"]]
+        finish_reason = "length"
+    logprobs = None
+    if request.get("logprobs"):
+        # The probability of the answer grows with the number of violence keywords of the last message
+        matches = len(re.findall(r"\b(killed|attack|attacked|clash|clashes|fighting)\b", request["messages"][-1]["content"].partition("News Article:")[2], re.IGNORECASE))
+        yes_probability = 0.05 + 0.9 * matches / (matches + 1)
+        top_logprobs = [{"token": "Yes", "logprob": math.log(yes_probability)}, {"token": "No", "logprob": math.log(1 - yes_probability)}]
+        logprobs = {"content": [{"token": content, "logprob": 0.0, "top_logprobs": top_logprobs[:request.get("top_logprobs") or 0]}]}
+    prompt_tokens = sum(len(m.get("content", "")) // 4 for m in request.get("messages", []))
+    cached_tokens = min(prompt_tokens, state.cached_prompt_tokens(request.get("messages", []))) if state is not None else 0
+    completion_tokens = len(content) // 4
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "fake"),
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "logprobs": logprobs,
+                "finish_reason": finish_reason,
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        },
+    }
+
+
+def _public_file(file):
+    return {key: value for key, value in file.items() if key != "content"}
+
+
+def _run_batch(state, batch_id):
+    time.sleep(state.batch_delay)
+    batch = state.batches[batch_id]
+    batch["status"] = batch["running_status"]
+    output_lines = []
+    for input_file_id in batch["input_files"]:
+        for line in state.files[input_file_id]["content"].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            body = dict(request.get("body", {}))
+            body.setdefault("model", batch["model"])
+            output_lines.append(
+                json.dumps(
+                    {
+                        "id": f"batch_req_{uuid.uuid4().hex[:12]}",
+                        "custom_id": request["custom_id"],
+                        "response": {"status_code": 200, "body": fake_completion(body, state)},
+                        "error": None,
+                    }
+                )
+            )
+    output_file = state.add_file(f"{batch_id}_output.jsonl", ("\n".join(output_lines) + "\n").encode("utf-8"), "batch")
+    batch["output_file_id"] = batch["output_file"] = output_file["id"]
+    batch["total_requests"] = batch["completed_requests"] = batch["succeeded_requests"] = len(output_lines)
+    batch["request_counts"] = {"total": len(output_lines), "completed": len(output_lines), "failed": 0}
+    batch["completed_at"] = int(time.time())
+    batch["status"] = batch["success_status"]
+
+
+def _create_batch(state, input_files, endpoint, model, openai_format):
+    batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+    batch = {
+        "id": batch_id,
+        "object": "batch",
+        "endpoint": endpoint,
+        "created_at": int(time.time()),
+        "input_files": input_files,
+        "model": model,
+        "errors": None if openai_format else [],
+        "status": "validating" if openai_format else "QUEUED",
+        "running_status": "in_progress" if openai_format else "RUNNING",
+        "success_status": "completed" if openai_format else "SUCCESS",
+        "completed_requests": 0,
+        "succeeded_requests": 0,
+        "failed_requests": 0,
+        "total_requests": 0,
+    }
+    if openai_format:
+        batch["input_file_id"] = input_files[0]
+        batch["completion_window"] = "24h"
+    state.batches[batch_id] = batch
+    threading.Thread(target=_run_batch, args=(state, batch_id), daemon=True).start()
+    return batch
+
+
+def make_handler(state):
+    class FakeLLMHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, payload, headers=None):
+            self._send(status, json.dumps(payload).encode("utf-8"), "application/json", headers)
+
+        def _send(self, status, body, content_type, headers=None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client gave up on a hung request
+                pass
+
+        def _read_body(self):
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def _upload_file(self, body):
+            # multipart/form-data upload with a "file" and a "purpose" field
+            message = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8") + body
+            )
+            filename, content, purpose = "upload.jsonl", b"", "batch"
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                if name == "file":
+                    filename = part.get_filename() or filename
+                    content = part.get_payload(decode=True)
+                elif name == "purpose":
+                    purpose = part.get_payload(decode=True).decode("utf-8")
+            return _public_file(state.add_file(filename, content, purpose))
+
+        def do_GET(self):
+            path = self.path.split("?")[0].rstrip("/")
+            match = re.fullmatch(r"/v1/files/([^/]+)/content", path)
+            if match and match.group(1) in state.files:
+                self._send(200, state.files[match.group(1)]["content"], "application/octet-stream")
+                return
+            match = re.fullmatch(r"/v1/(?:batches|batch/jobs)/([^/]+)", path)
+            if match and match.group(1) in state.batches:
+                batch = state.batches[match.group(1)]
+                self._send_json(200, {key: value for key, value in batch.items() if not key.endswith("_status")})
+                return
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+        def do_POST(self):
+            body = self._read_body()
+            path = self.path.split("?")[0].rstrip("/")
+            if path == "/v1/files":
+                self._send_json(200, self._upload_file(body))
+                return
+            if path in ["/v1/batches", "/v1/batch/jobs"]:
+                request = json.loads(body or b"{}")
+                openai_format = path == "/v1/batches"
+                input_files = [request["input_file_id"]] if openai_format else request["input_files"]
+                batch = _create_batch(state, input_files, request["endpoint"], request.get("model", "fake"), openai_format)
+                self._send_json(200, {key: value for key, value in batch.items() if not key.endswith("_status")})
+                return
+            if not path.endswith("/chat/completions"):
+                self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+                return
+
+            request = json.loads(body or b"{}")
+            wait = state.take()
+            if wait:
+                self._send_json(
+                    429,
+                    {"error": {"message": "Rate limit exceeded", "type": "rate_limit_error"}},
+                    headers={
+                        "Retry-After": f"{wait:.3f}",
+                        "x-ratelimit-remaining-requests": "0",
+                        "x-ratelimit-reset-requests": f"{wait:.3f}s",
+                    },
+                )
+                return
+
+            if state.server_error_rate and random.random() < state.server_error_rate:
+                state.server_error_count += 1
+                self._send_json(503, {"error": {"message": "Service unavailable", "type": "server_error"}})
+                return
+            if state.hang_rate and random.random() < state.hang_rate:
+                time.sleep(state.hang_seconds)
+
+            time.sleep(max(0, state.latency + random.uniform(-state.latency_jitter, state.latency_jitter)))
+            self._send_json(200, fake_completion(request, state))
+
+    return FakeLLMHandler
+
+
+def serve_in_background(port=0, **state_kwargs):
+    """
+    Start the fake server in a daemon thread. Returns (server, state); the port is server.server_address[1].
+    """
+    state = FakeLLMState(**state_kwargs)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI / Mistral.ai API server")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    parser.add_argument("--rps", type=float, default=0, help="requests per second accepted before returning 429s, 0 means no limit")
+    parser.add_argument("--rate_limit_error_rate", type=float, default=0, help="fraction of requests randomly rejected with a 429")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean latency of a response in seconds")
+    parser.add_argument("--batch_delay", type=float, default=1, help="seconds before a batch job is processed")
+    parser.add_argument("--server_error_rate", type=float, default=0, help="fraction of requests randomly rejected with a 503")
+    parser.add_argument("--hang_rate", type=float, default=0, help="fraction of requests hanging for hang_seconds before being answered")
+    parser.add_argument("--hang_seconds", type=float, default=30, help="seconds a hung request waits before being answered")
+    args = parser.parse_args()
+
+    state = FakeLLMState(
+        rps=args.rps,
+        rate_limit_error_rate=args.rate_limit_error_rate,
+        latency=args.latency,
+        batch_delay=args.batch_delay,
+        server_error_rate=args.server_error_rate,
+        hang_rate=args.hang_rate,
+        hang_seconds=args.hang_seconds,
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(state))
+    print(f"Fake LLM server listening on http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(
+            f"Served {state.request_count} chat completion requests, {state.rate_limited_count} rate limited, "
+            f"{state.server_error_count} server errors"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,560 @@
 from typing import List, Optional, Any, Dict
 from abc import abstractmethod
-import requests
-import json
-from textwrap import dedent
-from openai import OpenAI
+import asyncio
+import atexit
+import contextvars
+import logging
+import math
+import random
+import re
+import threading
+import time
+import httpx
+from openai import OpenAI, AsyncOpenAI, RateLimitError, APIConnectionError, APITimeoutError, APIStatusError
 from mistralai import Mistral
+from mistralai.models import SDKError
+
+from .utils import count_prompt_tokens
+
+try:
+    import h2  # noqa: F401
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    # HTTP/2 needs the optional h2 package (pip install httpx[http2]), HTTP/1.1 keep-alive is used otherwise
+    _HTTP2_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveRateLimiter:
+    """
+    Rate limiter shared by all the LLM callers of a provider.
+
+    It combines two token buckets (requests per second and tokens per minute) with an AIMD
+    (additive increase, multiplicative decrease) control of the number of in-flight requests and
+    of the request rate: both are cut by `decrease_factor` on each 429 / exhausted rate-limit
+    header, and slowly ramp up again while responses are healthy.
+    It can be used from threads with `acquire` and from asyncio tasks with `acquire_async`.
+    """
+
+    def __init__(
+        self,
+        requests_per_second=0,
+        tokens_per_minute=0,
+        max_concurrency=8,
+        min_concurrency=1,
+        decrease_factor=0.5,
+        min_rate_scale=0.1,
+        backoff_seconds=1,
+        max_backoff_seconds=60,
+    ):
+        """
+        :param float requests_per_second: Max number of requests per second. 0 means no limit
+        :param int tokens_per_minute: Max number of prompt + completion tokens per minute. 0 means no limit
+        :param int max_concurrency: Max number of in-flight requests
+        :param int min_concurrency: Number of in-flight requests allowed after repeated 429s
+        :param float decrease_factor: Multiplicative decrease applied to the concurrency and rate on a 429
+        :param float min_rate_scale: Lower bound for the fraction of `requests_per_second` / `tokens_per_minute` in use
+        :param float backoff_seconds: Pause after a 429 without Retry-After header, doubled for consecutive 429s
+        :param float max_backoff_seconds: Upper bound of the pause after a 429
+        """
+        self.requests_per_second = requests_per_second or 0
+        self.tokens_per_minute = tokens_per_minute or 0
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.decrease_factor = decrease_factor
+        self.min_rate_scale = min_rate_scale
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+
+        self._lock = threading.Lock()
+        now = time.monotonic()
+        self._request_bucket = max(1.0, self.requests_per_second)
+        self._token_bucket = float(self.tokens_per_minute)
+        self._last_refill = now
+        self._pause_until = now
+        self._concurrency_limit = float(self.max_concurrency)
+        self._rate_scale = 1.0
+        self._in_flight = 0
+        self._consecutive_rate_limits = 0
+        self.rate_limited_count = 0
+        self.request_count = 0
+
+    @property
+    def concurrency_limit(self):
+        return max(self.min_concurrency, int(self._concurrency_limit))
+
+    @property
+    def rate_scale(self):
+        return self._rate_scale
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        if self.requests_per_second:
+            capacity = max(1.0, self.requests_per_second * self._rate_scale)
+            self._request_bucket = min(capacity, self._request_bucket + elapsed * self.requests_per_second * self._rate_scale)
+        if self.tokens_per_minute:
+            capacity = self.tokens_per_minute * self._rate_scale
+            self._token_bucket = min(capacity, self._token_bucket + elapsed * self.tokens_per_minute * self._rate_scale / 60)
+
+    def _try_acquire(self, tokens):
+        """
+        Take a slot for a request of `tokens` tokens. Returns 0 on success, otherwise the number of seconds to wait before retrying.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._pause_until:
+                return self._pause_until - now
+            if self._in_flight >= self.concurrency_limit:
+                # Poll until a slot is released, polling keeps the implementation usable from threads and asyncio alike
+                return 0.05
+            if self.requests_per_second and self._request_bucket < 1:
+                return (1 - self._request_bucket) / (self.requests_per_second * self._rate_scale)
+            if self.tokens_per_minute:
+                # A request larger than the bucket is let through once the bucket is full
+                tokens = min(tokens, self.tokens_per_minute * self._rate_scale)
+                if self._token_bucket < tokens:
+                    return (tokens - self._token_bucket) * 60 / (self.tokens_per_minute * self._rate_scale)
+                self._token_bucket -= tokens
+            if self.requests_per_second:
+                self._request_bucket -= 1
+            self._in_flight += 1
+            self.request_count += 1
+            return 0
+
+    def acquire(self, tokens=0):
+        while True:
+            wait = self._try_acquire(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=0):
+        while True:
+            wait = self._try_acquire(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def release(self, rate_limited=False, headers=None, cancelled=False):
+        """
+        Release the slot of a finished request and adapt the limits.
+
+        :param bool rate_limited: Whether the request was rejected with a 429
+        :param headers: Response headers, used to read Retry-After and x-ratelimit-* headers
+        :param bool cancelled: Whether the request was cancelled before its response, the limits are then left unchanged
+        """
+        retry_after = parse_rate_limit_headers(headers) if headers is not None else None
+        with self._lock:
+            self._in_flight = max(0, self._in_flight - 1)
+            if cancelled:
+                return
+            now = time.monotonic()
+            if rate_limited:
+                self.rate_limited_count += 1
+                self._consecutive_rate_limits += 1
+                self._concurrency_limit = max(self.min_concurrency, self._concurrency_limit * self.decrease_factor)
+                self._rate_scale = max(self.min_rate_scale, self._rate_scale * self.decrease_factor)
+                if retry_after is None:
+                    retry_after = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** (self._consecutive_rate_limits - 1))
+                logger.warning(
+                    f"Rate limited. Pausing for {retry_after:.2f}s, concurrency limit {self.concurrency_limit}, rate scale {self._rate_scale:.2f}"
+                )
+            else:
+                self._consecutive_rate_limits = 0
+                # Additive increase: one extra slot per window of successful requests
+                self._concurrency_limit = min(self.max_concurrency, self._concurrency_limit + 1 / self._concurrency_limit)
+                self._rate_scale = min(1.0, self._rate_scale + 0.01)
+            if retry_after:
+                self._pause_until = max(self._pause_until, now + retry_after)
+
+
+def _parse_duration(value):
+    """
+    Parse durations used by rate-limit headers, e.g. "20", "1.5s", "250ms", "6m0s".
+    """
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total = 0.0
+    matches = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    if not matches:
+        return None
+    for number, unit in matches:
+        total += float(number) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total
+
+
+def parse_rate_limit_headers(headers):
+    """
+    Return how many seconds to pause according to the rate-limit headers of a response, or None.
+    Supports Retry-After / retry-after-ms and the x-ratelimit-remaining-* / x-ratelimit-reset-* headers.
+    """
+    if not headers:
+        return None
+    headers = {key.lower(): value for key, value in headers.items()}
+    if "retry-after-ms" in headers:
+        duration = _parse_duration(headers["retry-after-ms"])
+        if duration is not None:
+            return duration / 1000
+    if "retry-after" in headers:
+        duration = _parse_duration(headers["retry-after"])
+        if duration is not None:
+            return duration
+    pause = None
+    for kind in ["requests", "tokens"]:
+        remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+        reset = headers.get(f"x-ratelimit-reset-{kind}")
+        if remaining is not None and reset is not None and _parse_duration(remaining) == 0:
+            duration = _parse_duration(reset)
+            if duration is not None:
+                pause = max(pause or 0, duration)
+    return pause
+
+
+# Rate limiters are shared by all the callers of a provider, e.g. the relevance and type stages
+_RATE_LIMITERS = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def get_rate_limiter(provider, **rate_limit_config):
+    """
+    Get the rate limiter of a provider. It is created from `rate_limit_config` on first use and shared afterwards.
+
+    :param str provider: Name of the provider, e.g. "mistral", "gpt4"
+    :param rate_limit_config: Keyword arguments of AdaptiveRateLimiter
+    """
+    with _RATE_LIMITERS_LOCK:
+        if provider not in _RATE_LIMITERS:
+            _RATE_LIMITERS[provider] = AdaptiveRateLimiter(**rate_limit_config)
+        return _RATE_LIMITERS[provider]
+
+
+class LLMDeadlineExceeded(Exception):
+    """
+    Raised when a LLM request can not be completed before the deadline of the run.
+    """
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised without calling the provider while its circuit breaker is open.
+    """
+
+
+class RetryPolicy:
+    """
+    Retries of failed LLM requests with jittered exponential backoff, bounded by the deadline of the run.
+    Every retry is logged and counted.
+    """
+
+    def __init__(self, max_retries=5, backoff_seconds=1, max_backoff_seconds=60, deadline=None):
+        """
+        :param int max_retries: Max number of retries of a request
+        :param float backoff_seconds: Delay before the first retry, doubled for each following retry
+        :param float max_backoff_seconds: Upper bound of the delay between two retries
+        :param float deadline: Unix time after which no request is sent or retried. None means no deadline
+        """
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.deadline = deadline
+        self._lock = threading.Lock()
+        self.retry_count = 0
+        self.retry_delay_seconds = 0.0
+        self.retries_by_reason = {}
+
+    def check_deadline(self):
+        if self.deadline and time.time() >= self.deadline:
+            raise LLMDeadlineExceeded("The deadline of the run is exceeded")
+
+    def retry_delay(self, attempt, reason, error, headers=None, wait=True):
+        """
+        Count a retry and return the seconds to wait before it.
+
+        :param int attempt: Number of the failed attempt, starting at 0
+        :param str reason: Reason of the retry, e.g. "rate_limit", "timeout", "connection", "server"
+        :param Exception error: Error of the failed attempt
+        :param headers: Response headers, their Retry-After is used instead of the backoff when present
+        :param bool wait: Whether the caller waits before retrying. The rate limiter already pauses after a 429
+        """
+        delay = 0.0
+        if wait:
+            retry_after = parse_rate_limit_headers(headers)
+            if retry_after is not None:
+                delay = retry_after
+            else:
+                # "Equal jitter": half of the exponential delay plus a random share of the other half
+                delay = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** attempt)
+                delay = delay / 2 + random.uniform(0, delay / 2)
+        if self.deadline and time.time() + delay >= self.deadline:
+            raise LLMDeadlineExceeded(f"No time left before the deadline of the run to retry after: {error!r}") from error
+        with self._lock:
+            self.retry_count += 1
+            self.retry_delay_seconds += delay
+            self.retries_by_reason[reason] = self.retries_by_reason.get(reason, 0) + 1
+        logger.warning(f"LLM request failed ({reason}: {error!r}), retry {attempt + 1}/{self.max_retries} in {delay:.2f}s")
+        return delay
+
+    def stats(self):
+        return {
+            "retries": self.retry_count,
+            "retry_delay_seconds": round(self.retry_delay_seconds, 2),
+            "retries_by_reason": dict(self.retries_by_reason),
+        }
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker shared by all the LLM callers of a provider.
+
+    After `failure_threshold` consecutive failures (timeouts, connection errors, 5xx) the circuit opens
+    and requests fail fast with CircuitOpenError for `reset_seconds`. Then requests are let through again;
+    the circuit closes on the first success and opens again on the next failure.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=60):
+        """
+        :param int failure_threshold: Number of consecutive failures opening the circuit
+        :param float reset_seconds: Seconds the circuit stays open before requests are tried again
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._open_until = None
+        self.open_count = 0
+
+    @property
+    def state(self):
+        if self._open_until is None:
+            return "closed"
+        return "open" if time.monotonic() < self._open_until else "half_open"
+
+    def check(self):
+        with self._lock:
+            if self._open_until is not None and time.monotonic() < self._open_until:
+                raise CircuitOpenError(
+                    f"Circuit breaker open after {self._consecutive_failures} consecutive failures, "
+                    f"retrying the provider in {self._open_until - time.monotonic():.0f}s"
+                )
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._open_until = None
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            half_open = self._open_until is not None
+            if half_open or self._consecutive_failures >= self.failure_threshold:
+                self._open_until = time.monotonic() + self.reset_seconds
+                self.open_count += 1
+                logger.error(f"Circuit breaker opened after {self._consecutive_failures} consecutive failures for {self.reset_seconds}s")
+
+
+# Circuit breakers are shared by all the callers of a provider, like the rate limiters
+_CIRCUIT_BREAKERS = {}
+
+
+def get_circuit_breaker(provider, **circuit_breaker_config):
+    """
+    Get the circuit breaker of a provider. It is created from `circuit_breaker_config` on first use and shared afterwards.
+
+    :param str provider: Name of the provider, e.g. "mistral", "gpt4"
+    :param circuit_breaker_config: Keyword arguments of CircuitBreaker
+    """
+    with _RATE_LIMITERS_LOCK:
+        if provider not in _CIRCUIT_BREAKERS:
+            _CIRCUIT_BREAKERS[provider] = CircuitBreaker(**circuit_breaker_config)
+        return _CIRCUIT_BREAKERS[provider]
+
+
+# Long-lived HTTP clients shared by all the callers of a provider, api key and base url, so that the
+# connection pool (and its TLS sessions) is reused across calls and across the pipeline stages
+_LLM_CLIENTS = {}
+# Async clients are bound to an event loop, they are shared within the event loop and closed with it
+_ASYNC_LLM_CLIENTS = {}
+_LLM_CLIENTS_LOCK = threading.RLock()
+
+
+def _http_client_kwargs(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30, http2=True):
+    """
+    Keyword arguments of the pooled httpx clients.
+
+    :param int max_connections: Max number of connections of the pool
+    :param int max_keepalive_connections: Max number of idle connections kept alive
+    :param float keepalive_expiry: Seconds an idle connection is kept alive
+    :param bool http2: Whether to use HTTP/2 when the h2 package is installed
+    """
+    return {
+        "limits": httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        ),
+        "http2": http2 and _HTTP2_AVAILABLE,
+        # Timeouts are set per request by the callers
+        "timeout": None,
+        "follow_redirects": True,
+    }
+
+
+def _create_llm_client(provider, api_key, base_url, http_client, async_http_client=None):
+    if provider == "openai":
+        if async_http_client is not None:
+            return AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0, http_client=async_http_client)
+        return OpenAI(api_key=api_key, base_url=base_url, max_retries=0, http_client=http_client)
+    if provider == "mistral":
+        return Mistral(api_key=api_key, server_url=base_url, client=http_client, async_client=async_http_client, retry_config=None)
+    raise ValueError(f"Unknown provider {provider}")
+
+
+def get_llm_client(provider, api_key, base_url=None, http_pool=None):
+    """
+    Get the client of a provider ("openai" or "mistral") for an api key and a base url.
+    It is created with a pooled keep-alive HTTP client on first use and shared afterwards.
+    Retries are left to the callers (max_retries=0).
+
+    :param dict http_pool: Keyword arguments of the HTTP connection pool (max_connections, max_keepalive_connections,
+        keepalive_expiry, http2), used when the client is created
+    """
+    key = (provider, api_key, base_url)
+    with _LLM_CLIENTS_LOCK:
+        if key not in _LLM_CLIENTS:
+            http_client = httpx.Client(**_http_client_kwargs(**(http_pool or {})))
+            _LLM_CLIENTS[key] = (_create_llm_client(provider, api_key, base_url, http_client), http_client)
+        return _LLM_CLIENTS[key][0]
+
+
+def get_async_llm_client(provider, api_key, base_url=None, http_pool=None):
+    """
+    Async version of get_llm_client, shared within the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    key = (provider, api_key, base_url, loop)
+    with _LLM_CLIENTS_LOCK:
+        if key not in _ASYNC_LLM_CLIENTS:
+            http_client = None
+            if provider == "mistral":
+                # The Mistral client needs a sync HTTP client as well, use the shared one
+                get_llm_client(provider, api_key, base_url, http_pool)
+                http_client = _LLM_CLIENTS[(provider, api_key, base_url)][1]
+            async_http_client = httpx.AsyncClient(**_http_client_kwargs(**(http_pool or {})))
+            _ASYNC_LLM_CLIENTS[key] = (
+                _create_llm_client(provider, api_key, base_url, http_client, async_http_client),
+                async_http_client,
+            )
+        return _ASYNC_LLM_CLIENTS[key][0]
+
+
+async def close_async_llm_clients():
+    """
+    Close the async clients of the running event loop. Called before the event loop is closed.
+    """
+    loop = asyncio.get_running_loop()
+    with _LLM_CLIENTS_LOCK:
+        keys = [key for key in _ASYNC_LLM_CLIENTS if key[3] is loop]
+        async_http_clients = [_ASYNC_LLM_CLIENTS.pop(key)[1] for key in keys]
+    for async_http_client in async_http_clients:
+        await async_http_client.aclose()
+
+
+def close_llm_clients():
+    """
+    Close the shared clients and their connections. Registered to run at process exit.
+    """
+    with _LLM_CLIENTS_LOCK:
+        http_clients = [http_client for _, http_client in _LLM_CLIENTS.values()]
+        _LLM_CLIENTS.clear()
+    for http_client in http_clients:
+        http_client.close()
+
+
+atexit.register(close_llm_clients)
+
+
+# Used for the sampling parameters not set by the caller of the OpenAI API, as the OpenAI caller always sent them.
+# The Mistral caller never sent sampling parameters, its unset parameters are left to the provider defaults
+DEFAULT_SAMPLING_PARAMS = {"temperature": 0.001, "top_p": 0.001}
+SAMPLING_PARAM_KEYS = ["max_tokens", "temperature", "top_p", "stop", "seed", "logprobs", "top_logprobs"]
+
+
+def _sampling_kwargs(sampling_params, defaults):
+    sampling_params = {**defaults, **{key: value for key, value in (sampling_params or {}).items() if value is not None}}
+    return {key: sampling_params[key] for key in SAMPLING_PARAM_KEYS if key in sampling_params}
+
+
+def openai_sampling_kwargs(sampling_params):
+    """
+    Request arguments of the OpenAI chat completions API for the sampling parameters of a call
+    (max_tokens, temperature, top_p, stop, seed, logprobs, top_logprobs). Unset parameters default to DEFAULT_SAMPLING_PARAMS.
+    """
+    return _sampling_kwargs(sampling_params, DEFAULT_SAMPLING_PARAMS)
+
+
+def mistral_sampling_kwargs(sampling_params):
+    """
+    Request arguments of the Mistral chat completion API for the sampling parameters of a call, see openai_sampling_kwargs.
+    Unset parameters are not sent. The API does not return logprobs, the answers of the "score" answer mode are then
+    scored from their text.
+    """
+    kwargs = _sampling_kwargs(sampling_params, {})
+    kwargs.pop("logprobs", None)
+    kwargs.pop("top_logprobs", None)
+    if "seed" in kwargs:
+        kwargs["random_seed"] = kwargs.pop("seed")
+    return kwargs
+
+
+def restore_stop_sequence(answer, finish_reason, sampling_params):
+    """
+    The providers do not return the stop sequence ending a generation. Adds the first stop sequence of
+    `sampling_params`, a closing tag e.g. </answer>, back to an answer stopped by it, so that the answer stays valid XML.
+    finish_reason is also "stop" at the natural end of a generation: the closing tag is only added to an answer ending
+    in its open tag, e.g. "<answer>Yes".
+    """
+    stop = (sampling_params or {}).get("stop")
+    if not stop or finish_reason != "stop":
+        return answer
+    stop = stop if isinstance(stop, str) else stop[0]
+    if not (stop.startswith("</") and stop.endswith(">")):
+        return answer
+    open_tag = f"<{stop[2:]}"
+    return answer + stop if answer.rfind(open_tag) > answer.rfind(stop) else answer
+
+
+def format_logprob_answer(answer, top_logprobs):
+    """
+    Answer of a single-token call made with logprobs, as <answer>{answer}</answer><score>{P(Yes)}</score>.
+    P(Yes) is the probability of the "Yes" tokens among the "Yes" and "No" tokens of `top_logprobs`, the
+    (token, logprob) pairs of the most likely first tokens.
+    """
+    probabilities = {"yes": 0.0, "no": 0.0}
+    for token, logprob in top_logprobs:
+        token = token.strip().lower()
+        if token in probabilities:
+            probabilities[token] += math.exp(logprob)
+    total = probabilities["yes"] + probabilities["no"]
+    score = probabilities["yes"] / total if total > 0 else float(answer.strip().lower().startswith("yes"))
+    return f"<answer>{answer}</answer><score>{score:.6f}</score>"
+
+
+# Usage fields of the responses of the current call, collected while a wrapper records the call (see llm_cassette)
+CALL_USAGE = contextvars.ContextVar("llm_call_usage", default=None)
+# Label of the current call within its stage, e.g. the event type of a per-label prompt, set by the dispatch (see llm_telemetry)
+CALL_LABEL = contextvars.ContextVar("llm_call_label", default=None)
 
 
 class LLMCaller:
+    usage = None
+    telemetry = None
+
     @abstractmethod
     def __call__(
         self,
@@ -17,43 +564,279 @@ class LLMCaller:
     ) -> List[str]:
         pass
 
+    async def acall(self, prompt, sampling_params={}) -> List[str]:
+        """
+        Asynchronous version of __call__. By default the blocking call is run in a worker thread.
+        """
+        return await asyncio.to_thread(self.__call__, prompt, sampling_params)
+
+    async def aclose(self):
+        """
+        Close the resources bound to the running event loop. Called before the event loop of `acall` is closed.
+        """
+        pass
+
+    def record_usage(self, usage, batch=False):
+        """
+        Add the `usage` field of a response to the usage counters and the telemetry of the caller, if any, and to the
+        usage of the call being recorded, if any.
+
+        :param bool batch: Whether the response is a result of a batch job
+        """
+        if self.usage is not None:
+            self.usage.record(usage)
+        if self.telemetry is not None and usage is not None:
+            self.telemetry.record_usage(usage, batch)
+        call_usage = CALL_USAGE.get()
+        if call_usage is not None and usage is not None:
+            call_usage.append(usage)
 
-class OpenAILLMCaller(LLMCaller):
-    def __init__(self, openai_api_key, model_name, header=None, timeout=60):
+    def record_call(self, latency, retries=0, error=False):
+        """
+        Add a call to the telemetry of the caller, if any.
+
+        :param float latency: Seconds from the call to its answer or error, retries included
+        """
+        if self.telemetry is not None:
+            self.telemetry.record_call(latency, retries, error)
+
+
+class RemoteLLMCaller(LLMCaller):
+    """
+    Base class of the LLM callers of hosted APIs. Subclasses implement `_complete`/`_acomplete`,
+    which return the answer and the response headers, and `_retryable_error`.
+    Requests go through the shared rate limiter and circuit breaker if given, and retryable errors
+    (429s, timeouts, connection errors, 5xx) are retried according to the retry policy.
+    """
+    rate_limiter = None
+    circuit_breaker = None
+    retry_policy = None
+
+    def _estimate_tokens(self, prompt, sampling_params):
+        return count_prompt_tokens(prompt) + (sampling_params or {}).get("max_tokens", 0)
+
+    @abstractmethod
+    def _complete(self, prompt, sampling_params):
+        pass
+
+    @abstractmethod
+    async def _acomplete(self, prompt, sampling_params):
+        pass
+
+    def _retryable_error(self, error):
+        """
+        Return (reason, response headers) for an exception raised by the client. reason is None for errors which are not retried,
+        otherwise one of "rate_limit", "timeout", "connection", "server".
+        """
+        return None, None
+
+    def _before_attempt(self):
+        self.retry_policy.check_deadline()
+        if self.circuit_breaker:
+            self.circuit_breaker.check()
+
+    def _after_failure(self, attempt, error):
+        """
+        Record a failed attempt. Returns the seconds to wait before retrying, raises if the request is not retried.
+        """
+        reason, headers = self._retryable_error(error)
+        if self.rate_limiter:
+            self.rate_limiter.release(rate_limited=reason == "rate_limit", headers=headers)
+        if self.circuit_breaker and reason in ["timeout", "connection", "server"]:
+            self.circuit_breaker.record_failure()
+        if reason is None or attempt >= self.retry_policy.max_retries:
+            raise error
+        # The rate limiter pauses all the callers after a 429, there is no need to wait here as well
+        return self.retry_policy.retry_delay(attempt, reason, error, headers, wait=not (reason == "rate_limit" and self.rate_limiter))
+
+    async def aclose(self):
+        # The async clients are shared within the event loop, which is closed after the dispatch of the prompts
+        await close_async_llm_clients()
+
+    def _after_success(self, headers):
+        if self.rate_limiter:
+            self.rate_limiter.release(headers=headers)
+        if self.circuit_breaker:
+            self.circuit_breaker.record_success()
+
+    def __call__(self, prompt, sampling_params={}) -> List[str]:
+        tokens = self._estimate_tokens(prompt, sampling_params) if self.rate_limiter else 0
+        attempt = 0
+        start = time.perf_counter()
+        try:
+            while True:
+                self._before_attempt()
+                if self.rate_limiter:
+                    self.rate_limiter.acquire(tokens)
+                try:
+                    answer, headers = self._complete(prompt, sampling_params)
+                except Exception as e:
+                    time.sleep(self._after_failure(attempt, e))
+                    attempt += 1
+                    continue
+                self._after_success(headers)
+                self.record_call(time.perf_counter() - start, attempt)
+                return [answer]
+        except Exception:
+            self.record_call(time.perf_counter() - start, attempt, error=True)
+            raise
+
+    async def acall(self, prompt, sampling_params={}) -> List[str]:
+        tokens = self._estimate_tokens(prompt, sampling_params) if self.rate_limiter else 0
+        attempt = 0
+        start = time.perf_counter()
+        try:
+            while True:
+                self._before_attempt()
+                if self.rate_limiter:
+                    await self.rate_limiter.acquire_async(tokens)
+                try:
+                    answer, headers = await self._acomplete(prompt, sampling_params)
+                except asyncio.CancelledError:
+                    # e.g. the losing request of a hedged call, see HedgedLLMCaller
+                    if self.rate_limiter:
+                        self.rate_limiter.release(cancelled=True)
+                    raise
+                except Exception as e:
+                    await asyncio.sleep(self._after_failure(attempt, e))
+                    attempt += 1
+                    continue
+                self._after_success(headers)
+                self.record_call(time.perf_counter() - start, attempt)
+                return [answer]
+        except Exception:
+            self.record_call(time.perf_counter() - start, attempt, error=True)
+            raise
+
+
+class OpenAILLMCaller(RemoteLLMCaller):
+    def __init__(self, openai_api_key, model_name, header=None, timeout=60, rate_limiter=None, base_url=None, retry_policy=None, circuit_breaker=None, http_pool=None, usage=None, telemetry=None):
         """
         Initialise a LLM
         :param dic header: header for the request
-        :param int timeout: Timeout for the request to LLM service
+        :param int timeout: Timeout for the request to LLM service, in seconds
+        :param AdaptiveRateLimiter rate_limiter: Rate limiter shared with the other callers of the provider
+        :param str base_url: Base url of an OpenAI compatible API. Default as the OpenAI API
+        :param RetryPolicy retry_policy: Retries of the failed requests. Default as RetryPolicy()
+        :param CircuitBreaker circuit_breaker: Circuit breaker shared with the other callers of the provider
+        :param dict http_pool: Settings of the HTTP connection pool shared with the other callers using the same key, see get_llm_client
+        :param LLMUsage usage: Token usage counters the responses are added to
+        :param StageTelemetry telemetry: Telemetry the calls and responses are added to, see llm_telemetry
         """
-        self.client = OpenAI(api_key=openai_api_key)
+        self.client = get_llm_client("openai", openai_api_key, base_url, http_pool)
+        self.openai_api_key = openai_api_key
+        self.base_url = base_url
+        self.http_pool = http_pool
         self.timeout = timeout
         self.model_name = model_name
-    
-    def __call__(self, prompt, sampling_params={}) -> List[str]:
-        response =  self.client.chat.completions.create(
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker
+        self.usage = usage
+        self.telemetry = telemetry
+
+    def _complete(self, prompt, sampling_params):
+        raw_response = self.client.chat.completions.with_raw_response.create(
+                model=self.model_name,
+            messages=prompt,
+            timeout=self.timeout,
+            **openai_sampling_kwargs(sampling_params),
+        )
+        response = raw_response.parse()
+        self.record_usage(response.usage)
+        choice = response.choices[0]
+        answer = restore_stop_sequence(choice.message.content.strip(), choice.finish_reason, sampling_params)
+        if (sampling_params or {}).get("logprobs") and choice.logprobs and choice.logprobs.content:
+            answer = format_logprob_answer(answer, [(top.token, top.logprob) for top in choice.logprobs.content[0].top_logprobs])
+        return answer, raw_response.headers
+
+    async def _acomplete(self, prompt, sampling_params):
+        async_client = get_async_llm_client("openai", self.openai_api_key, self.base_url, self.http_pool)
+        raw_response = await async_client.chat.completions.with_raw_response.create(
                 model=self.model_name,
-                temperature=0.001,
-                top_p=0.001,
-            messages=prompt
+            messages=prompt,
+            timeout=self.timeout,
+            **openai_sampling_kwargs(sampling_params),
         )
-        return [response.choices[0].message.content.strip()]
-    
-    
-class MistralAiLLMCaller(LLMCaller):
-    def __init__(self, mistralai_api_key, model_name, header=None, timeout=60):
+        response = raw_response.parse()
+        self.record_usage(response.usage)
+        choice = response.choices[0]
+        answer = restore_stop_sequence(choice.message.content.strip(), choice.finish_reason, sampling_params)
+        if (sampling_params or {}).get("logprobs") and choice.logprobs and choice.logprobs.content:
+            answer = format_logprob_answer(answer, [(top.token, top.logprob) for top in choice.logprobs.content[0].top_logprobs])
+        return answer, raw_response.headers
+
+    def _retryable_error(self, error):
+        if isinstance(error, RateLimitError):
+            return "rate_limit", error.response.headers
+        if isinstance(error, APITimeoutError):
+            return "timeout", None
+        if isinstance(error, APIConnectionError):
+            return "connection", None
+        if isinstance(error, APIStatusError) and (error.status_code >= 500 or error.status_code in [408, 409]):
+            return "server", error.response.headers
+        return None, None
+
+
+class MistralAiLLMCaller(RemoteLLMCaller):
+    def __init__(self, mistralai_api_key, model_name, header=None, timeout=60, rate_limiter=None, base_url=None, retry_policy=None, circuit_breaker=None, http_pool=None, usage=None, telemetry=None):
         """
         Initialise a LLM
         :param str model_route: model_route of the desired model
         :param dic header: header for the request
-        :param int timeout: Timeout for the request to LLM service
+        :param int timeout: Timeout for the request to LLM service, in seconds
+        :param AdaptiveRateLimiter rate_limiter: Rate limiter shared with the other callers of the provider
+        :param str base_url: Server url of the Mistral API. Default as the Mistral.ai API
+        :param RetryPolicy retry_policy: Retries of the failed requests. Default as RetryPolicy()
+        :param CircuitBreaker circuit_breaker: Circuit breaker shared with the other callers of the provider
+        :param dict http_pool: Settings of the HTTP connection pool shared with the other callers using the same key, see get_llm_client
+        :param LLMUsage usage: Token usage counters the responses are added to
+        :param StageTelemetry telemetry: Telemetry the calls and responses are added to, see llm_telemetry
         """
-        self.client = Mistral(api_key=mistralai_api_key)
+        self.client = get_llm_client("mistral", mistralai_api_key, base_url, http_pool)
+        self.mistralai_api_key = mistralai_api_key
+        self.base_url = base_url
+        self.http_pool = http_pool
         self.timeout = timeout
         self.model_name = model_name
-    
-    def __call__(self, prompt, sampling_params={}) -> List[str]:
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker
+        self.usage = usage
+        self.telemetry = telemetry
+
+    def _complete(self, prompt, sampling_params):
         response =  self.client.chat.complete(
                 model=self.model_name,
-                messages=prompt
+                messages=prompt,
+                timeout_ms=int(self.timeout * 1000),
+                **mistral_sampling_kwargs(sampling_params),
         )
-        return [response.choices[0].message.content.strip()] 
+        self.record_usage(response.usage)
+        choice = response.choices[0]
+        return restore_stop_sequence(choice.message.content.strip(), choice.finish_reason, sampling_params), None
+
+    async def _acomplete(self, prompt, sampling_params):
+        async_client = get_async_llm_client("mistral", self.mistralai_api_key, self.base_url, self.http_pool)
+        response = await async_client.chat.complete_async(
+                model=self.model_name,
+                messages=prompt,
+                timeout_ms=int(self.timeout * 1000),
+                **mistral_sampling_kwargs(sampling_params),
+        )
+        self.record_usage(response.usage)
+        choice = response.choices[0]
+        return restore_stop_sequence(choice.message.content.strip(), choice.finish_reason, sampling_params), None
+
+    def _retryable_error(self, error):
+        if isinstance(error, SDKError):
+            headers = error.raw_response.headers if error.raw_response is not None else None
+            if error.status_code == 429:
+                return "rate_limit", headers
+            if error.status_code >= 500 or error.status_code == 408:
+                return "server", headers
+        if isinstance(error, httpx.TimeoutException):
+            return "timeout", None
+        if isinstance(error, httpx.TransportError):
+            return "connection", None
+        return None, None
@@ -0,0 +1,82 @@
+import os
+
+from .llm_backbone import MistralAiLLMCaller, OpenAILLMCaller
+from .llm_local import LocalLLMCaller
+
+BACKEND_PROVIDERS = ["openai", "mistral", "openai_compatible", "local"]
+
+# Backends selectable by llm_name without any configuration. More are defined in the llm_backends config
+DEFAULT_LLM_BACKENDS = {
+    "gpt4": {"provider": "openai", "model_name": "gpt-4o"},
+    "mistral": {"provider": "mistral", "model_name": "mistral-large-latest"},
+}
+
+# Secret holding the api key of the built-in providers, see backend_api_key
+DEFAULT_API_KEY_SECRETS = {"openai": "openai_api_key", "mistral": "mistralai_api_key"}
+
+
+class OpenAICompatibleLLMCaller(OpenAILLMCaller):
+    """
+    OpenAILLMCaller of a self-hosted server with an OpenAI compatible chat completions API (vLLM, TGI, llama.cpp,
+    Ollama...). These servers have no batch API, the calls of the "batch" execution mode are made one by one.
+    """
+    supports_batch = False
+
+
+def get_llm_backend(llm_name, llm_backends=None):
+    """
+    Get the configuration of the backend `llm_name`: one of DEFAULT_LLM_BACKENDS or of `llm_backends`.
+
+    :param dict llm_backends: Backends by name, each a dict with
+        - provider (str, default="openai_compatible"): One of BACKEND_PROVIDERS
+        - model_name (str): Model of the requests, or the Hugging Face model id / path of a "local" model
+        - base_url (str): Base url of the API. Required for "openai_compatible", default as the provider API otherwise
+        - api_key, api_key_env, api_key_secret (str): Authentication, see backend_api_key
+        - device, num_threads: Settings of a "local" model, see LocalLLMCaller
+    :return dict: The configuration, with its provider set
+    """
+    backends = {**DEFAULT_LLM_BACKENDS, **(llm_backends or {})}
+    if llm_name not in backends:
+        raise ValueError(f"Unknown llm_name {llm_name}. Please select from {sorted(backends)} or define it in llm_backends.")
+    backend = {"provider": "openai_compatible", **backends[llm_name]}
+    if backend["provider"] not in BACKEND_PROVIDERS:
+        raise ValueError(f"Invalid provider {backend['provider']} of the LLM backend {llm_name}. Please select from {BACKEND_PROVIDERS}.")
+    if not backend.get("model_name"):
+        raise ValueError(f"model_name of the LLM backend {llm_name} is required")
+    if backend["provider"] == "openai_compatible" and not backend.get("base_url"):
+        raise ValueError(f"base_url of the openai_compatible LLM backend {llm_name} is required")
+    return backend
+
+
+def backend_api_key(backend, api_keys=None):
+    """
+    Api key of a backend: its `api_key`, else the environment variable named by its `api_key_env`, else the secret
+    named by its `api_key_secret` in `api_keys` (e.g. the secrets loaded from Databricks). The built-in providers
+    default to the "openai_api_key" / "mistralai_api_key" secrets. Self-hosted servers are usually not secured, "EMPTY"
+    is sent if no key is set.
+    """
+    if backend.get("api_key"):
+        return backend["api_key"]
+    if backend.get("api_key_env") and os.environ.get(backend["api_key_env"]):
+        return os.environ[backend["api_key_env"]]
+    api_key = (api_keys or {}).get(backend.get("api_key_secret", DEFAULT_API_KEY_SECRETS.get(backend["provider"])))
+    if api_key:
+        return api_key
+    return "EMPTY" if backend["provider"] == "openai_compatible" else None
+
+
+def create_llm_caller(backend, api_keys=None, usage=None, **caller_kwargs):
+    """
+    Create the LLMCaller of a backend configuration, see get_llm_backend.
+
+    :param dict api_keys: Api keys by secret name, see backend_api_key
+    :param LLMUsage usage: Token usage counters the responses are added to
+    :param caller_kwargs: Arguments of the remote callers (timeout, rate_limiter, retry_policy, circuit_breaker,
+        http_pool, telemetry), only telemetry is used by the "local" backend
+    """
+    if backend["provider"] == "local":
+        return LocalLLMCaller(
+            backend["model_name"], device=backend.get("device", "cpu"), num_threads=backend.get("num_threads"), usage=usage, telemetry=caller_kwargs.get("telemetry")
+        )
+    caller_class = {"openai": OpenAILLMCaller, "mistral": MistralAiLLMCaller, "openai_compatible": OpenAICompatibleLLMCaller}[backend["provider"]]
+    return caller_class(backend_api_key(backend, api_keys), backend["model_name"], base_url=backend.get("base_url"), usage=usage, **caller_kwargs)
@@ -0,0 +1,251 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from .llm_backbone import CALL_LABEL, MistralAiLLMCaller, OpenAILLMCaller, format_logprob_answer, mistral_sampling_kwargs, openai_sampling_kwargs, restore_stop_sequence
+
+logger = logging.getLogger(__name__)
+
+
+class LLMBatchRunner:
+    """
+    Run a list of chat prompts through a provider batch API.
+
+    The prompts are written as a batch JSONL file, uploaded and submitted as one batch job which is then polled
+    until it finishes. The job state is saved to `state_path` after every step, so a run interrupted while the
+    job is in progress resumes polling the same job instead of submitting the prompts again.
+    Subclasses implement the provider specific calls.
+    """
+    terminal_statuses = []
+    success_statuses = []
+
+    def __init__(self, llm_caller, state_path, poll_interval=60, max_wait_hours=24):
+        """
+        :param LLMCaller llm_caller: Caller of the provider, used for its client and model name
+        :param str state_path: Path of the JSON file storing the job state. Batch input/output files are stored next to it
+        :param float poll_interval: Seconds between two status checks
+        :param float max_wait_hours: Max number of hours to wait for the job to finish
+        """
+        self.llm_caller = llm_caller
+        self.client = llm_caller.client
+        self.model_name = llm_caller.model_name
+        self.state_path = state_path
+        self.poll_interval = poll_interval
+        self.max_wait_hours = max_wait_hours
+
+    def _load_state(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                return json.load(f)
+        return {}
+
+    def _save_state(self, state):
+        # Write to a temporary file first so that the state is never left half written
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def build_request(self, custom_id, prompt, sampling_params):
+        """
+        Returns the line of the batch file for one prompt.
+        """
+        raise NotImplementedError
+
+    def submit(self, input_path):
+        """
+        Upload the batch file and create the job. Returns (input_file_id, job_id).
+        """
+        raise NotImplementedError
+
+    def get_status(self, job_id):
+        """
+        Returns (status, output_file_id) of a job.
+        """
+        raise NotImplementedError
+
+    def download(self, file_id):
+        """
+        Returns the content of a file as text.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def parse_result_line(line, sampling_params=None):
+        """
+        Returns (custom_id, answer, usage) of a line of the batch output file. answer is None for failed requests.
+        The stop sequence of `sampling_params` ending an answer is added back, see restore_stop_sequence, and the answers
+        of calls made with logprobs carry their score, see format_logprob_answer.
+        """
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if response.get("status_code", 200) != 200 or result.get("error"):
+            return result.get("custom_id"), None, None
+        body = response.get("body", response)
+        try:
+            choice = body["choices"][0]
+            answer = restore_stop_sequence(choice["message"]["content"].strip(), choice.get("finish_reason"), sampling_params)
+            if (sampling_params or {}).get("logprobs") and (choice.get("logprobs") or {}).get("content"):
+                top_logprobs = choice["logprobs"]["content"][0]["top_logprobs"]
+                answer = format_logprob_answer(answer, [(top["token"], top["logprob"]) for top in top_logprobs])
+            return result.get("custom_id"), answer, body.get("usage")
+        except (KeyError, IndexError, TypeError, AttributeError):
+            return result.get("custom_id"), None, None
+
+    def run(self, prompts, sampling_params, labels=None):
+        """
+        Run the prompts as one batch job.
+
+        Args:
+            labels (list, optional): Telemetry label of each prompt, see CALL_LABEL.
+
+        Returns:
+            dict: custom_id (index of the prompt as a string) -> answer, for the requests that succeeded.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+        lines = [
+            json.dumps(self.build_request(str(idx), prompt, sampling_params), ensure_ascii=False)
+            for idx, prompt in enumerate(prompts)
+        ]
+        input_hash = hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest()
+
+        state = self._load_state()
+        if state.get("input_hash") != input_hash:
+            if state:
+                logger.info(f"Batch state {self.state_path} belongs to different prompts, submitting a new batch job")
+            input_path = f"{os.path.splitext(self.state_path)[0]}_input.jsonl"
+            with open(input_path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            input_file_id, job_id = self.submit(input_path)
+            state = {
+                "provider": type(self).__name__,
+                "model": self.model_name,
+                "input_hash": input_hash,
+                "num_requests": len(lines),
+                "input_file_id": input_file_id,
+                "job_id": job_id,
+                "status": "submitted",
+                "submitted_at": time.time(),
+            }
+            self._save_state(state)
+            logger.info(f"Submitted batch job {job_id} with {len(lines)} requests")
+        else:
+            logger.info(f"Resuming batch job {state['job_id']} from {self.state_path}")
+
+        output_path = f"{os.path.splitext(self.state_path)[0]}_output.jsonl"
+        if state["status"] not in self.success_statuses or not os.path.exists(output_path):
+            deadline = time.time() + self.max_wait_hours * 3600
+            while True:
+                status, output_file_id = self.get_status(state["job_id"])
+                if status != state["status"]:
+                    logger.info(f"Batch job {state['job_id']} status: {status}")
+                    state["status"] = status
+                    self._save_state(state)
+                if status in self.terminal_statuses:
+                    break
+                if time.time() > deadline:
+                    raise TimeoutError(f"Batch job {state['job_id']} did not finish within {self.max_wait_hours} hours")
+                time.sleep(self.poll_interval)
+
+            if status not in self.success_statuses or not output_file_id:
+                raise RuntimeError(f"Batch job {state['job_id']} finished with status {status}")
+            with open(output_path, "w") as f:
+                f.write(self.download(output_file_id))
+            state["output_file_id"] = output_file_id
+            self._save_state(state)
+
+        answers = {}
+        with open(output_path) as f:
+            for line in f:
+                if line.strip():
+                    custom_id, answer, usage = self.parse_result_line(line, sampling_params)
+                    if answer is not None:
+                        answers[custom_id] = answer
+                        token = CALL_LABEL.set(labels[int(custom_id)] if labels else None)
+                        try:
+                            self.llm_caller.record_usage(usage, batch=True)
+                        finally:
+                            CALL_LABEL.reset(token)
+        return answers
+
+
+class OpenAIBatchRunner(LLMBatchRunner):
+    terminal_statuses = ["completed", "failed", "expired", "cancelled"]
+    success_statuses = ["completed"]
+
+    def build_request(self, custom_id, prompt, sampling_params):
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": self.model_name,
+                "messages": prompt,
+                **openai_sampling_kwargs(sampling_params),
+            },
+        }
+
+    def submit(self, input_path):
+        with open(input_path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        job = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        return input_file.id, job.id
+
+    def get_status(self, job_id):
+        job = self.client.batches.retrieve(job_id)
+        return job.status, job.output_file_id
+
+    def download(self, file_id):
+        return self.client.files.content(file_id).text
+
+
+class MistralBatchRunner(LLMBatchRunner):
+    terminal_statuses = ["SUCCESS", "FAILED", "TIMEOUT_EXCEEDED", "CANCELLED"]
+    success_statuses = ["SUCCESS"]
+
+    def build_request(self, custom_id, prompt, sampling_params):
+        return {
+            "custom_id": custom_id,
+            "body": {
+                "messages": prompt,
+                **mistral_sampling_kwargs(sampling_params),
+            },
+        }
+
+    def submit(self, input_path):
+        with open(input_path, "rb") as f:
+            input_file = self.client.files.upload(
+                file={"file_name": os.path.basename(input_path), "content": f.read()},
+                purpose="batch",
+            )
+        job = self.client.batch.jobs.create(
+            input_files=[input_file.id],
+            model=self.model_name,
+            endpoint="/v1/chat/completions",
+            timeout_hours=int(self.max_wait_hours),
+        )
+        return input_file.id, job.id
+
+    def get_status(self, job_id):
+        job = self.client.batch.jobs.get(job_id=job_id)
+        return job.status, job.output_file
+
+    def download(self, file_id):
+        return self.client.files.download(file_id=file_id).read().decode("utf-8")
+
+
+def create_batch_runner(llm_caller, state_path, poll_interval=60, max_wait_hours=24):
+    """
+    Create the batch runner matching the provider of `llm_caller`.
+    """
+    if isinstance(llm_caller, OpenAILLMCaller):
+        return OpenAIBatchRunner(llm_caller, state_path, poll_interval=poll_interval, max_wait_hours=max_wait_hours)
+    if isinstance(llm_caller, MistralAiLLMCaller):
+        return MistralBatchRunner(llm_caller, state_path, poll_interval=poll_interval, max_wait_hours=max_wait_hours)
+    raise ValueError(f"Batch execution is not supported for {type(llm_caller).__name__}")
@@ -0,0 +1,187 @@
+import contextvars
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import List
+
+from .llm_backbone import LLMCaller
+
+# Set when a call is answered from the response cache, see dispatch_llm_calls
+RESPONSE_CACHE_HIT = contextvars.ContextVar("llm_response_cache_hit", default=False)
+
+
+def make_cache_key(model_name, prompt, sampling_params):
+    """
+    Content address of a LLM request: hash of the model name, the full list of messages and the sampling parameters.
+    """
+    payload = json.dumps(
+        {"model": model_name, "messages": prompt, "sampling_params": sampling_params or {}},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    On-disk (SQLite) cache of LLM responses with LRU eviction.
+
+    In read-only mode the cache is never modified: hits are served but misses are not stored
+    and the access times are not updated, which keeps evaluation reruns from altering it.
+    """
+
+    def __init__(self, path, max_entries=1000000, read_only=False):
+        """
+        :param str path: Path of the SQLite file
+        :param int max_entries: Max number of responses kept. The least recently used are evicted first
+        :param bool read_only: Whether to serve hits only, without writing to the cache
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if read_only:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"LLM cache {path} does not exist, it can not be opened in read-only mode")
+            self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, response TEXT, created_at REAL, last_access REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            self._conn.commit()
+        self._size = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def __len__(self):
+        return self._size
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+            return row[0]
+
+    def put(self, key, model_name, response):
+        if self.read_only:
+            return
+        with self._lock:
+            now = time.time()
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO responses (key, model, response, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, model_name, response, now, now),
+            )
+            self._size += cursor.rowcount
+            if self._size > self.max_entries:
+                self._evict(self._size - self.max_entries)
+            self._conn.commit()
+
+    def _evict(self, count):
+        cursor = self._conn.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access LIMIT ?)", (count,)
+        )
+        self._size -= cursor.rowcount
+        self.evictions += cursor.rowcount
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "entries": self._size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Caches are shared by all the stages using the same file
+_LLM_CACHES = {}
+_LLM_CACHES_LOCK = threading.Lock()
+
+
+def get_llm_cache(path, max_entries=1000000, read_only=False):
+    """
+    Get the response cache stored at `path`. It is opened on first use and shared afterwards.
+    """
+    with _LLM_CACHES_LOCK:
+        if path not in _LLM_CACHES:
+            _LLM_CACHES[path] = LLMResponseCache(path, max_entries=max_entries, read_only=read_only)
+        return _LLM_CACHES[path]
+
+
+class CachedLLMCaller(LLMCaller):
+    """
+    Wrap a LLMCaller with a LLMResponseCache. Cache hits are answered locally without calling the LLM.
+    """
+
+    def __init__(self, llm_caller, cache):
+        """
+        :param LLMCaller llm_caller: LLM called on cache misses
+        :param LLMResponseCache cache: Response cache
+        """
+        self.llm_caller = llm_caller
+        self.cache = cache
+        self.model_name = getattr(llm_caller, "model_name", type(llm_caller).__name__)
+
+    @property
+    def supports_batch(self):
+        return getattr(self.llm_caller, "supports_batch", True)
+
+    @property
+    def circuit_breaker(self):
+        return getattr(self.llm_caller, "circuit_breaker", None)
+
+    def lookup(self, prompt, sampling_params={}):
+        """
+        Returns the cached response of a prompt, or None.
+        """
+        response = self.cache.get(make_cache_key(self.model_name, prompt, sampling_params))
+        if response is not None:
+            RESPONSE_CACHE_HIT.set(True)
+        return response
+
+    def store(self, prompt, sampling_params, response):
+        self.cache.put(make_cache_key(self.model_name, prompt, sampling_params), self.model_name, response)
+
+    def __call__(self, prompt, sampling_params={}) -> List[str]:
+        key = make_cache_key(self.model_name, prompt, sampling_params)
+        response = self.cache.get(key)
+        if response is not None:
+            RESPONSE_CACHE_HIT.set(True)
+            return [response]
+        response = self.llm_caller(prompt, sampling_params)[0]
+        self.cache.put(key, self.model_name, response)
+        return [response]
+
+    async def acall(self, prompt, sampling_params={}) -> List[str]:
+        key = make_cache_key(self.model_name, prompt, sampling_params)
+        response = self.cache.get(key)
+        if response is not None:
+            RESPONSE_CACHE_HIT.set(True)
+            return [response]
+        response = (await self.llm_caller.acall(prompt, sampling_params))[0]
+        self.cache.put(key, self.model_name, response)
+        return [response]
+
+    async def aclose(self):
+        await self.llm_caller.aclose()
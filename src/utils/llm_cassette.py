@@ -0,0 +1,209 @@
+import asyncio
+import atexit
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from typing import List
+
+from .llm_backbone import CALL_USAGE, LLMCaller
+from .llm_cache import make_cache_key
+from .llm_metrics import usage_to_dict
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_MODES = ["record", "replay"]
+
+
+class CassetteMissError(Exception):
+    """
+    Raised in replay mode for a LLM request which is not in the cassette.
+    """
+
+
+class LLMCassette:
+    """
+    Recording of the LLM calls of a run, to replay them offline.
+
+    The cassette is a gzipped JSON lines file with one line per call: the content address of the request
+    (see make_cache_key), the model, the answer, the latency in seconds and the token usage. In "record" mode
+    the calls are appended to a new cassette. In "replay" mode the answers are served from the cassette, in the
+    recorded order when the same request was recorded several times, optionally after the recorded latency.
+    """
+
+    def __init__(self, path, mode="replay", replay_latency=False, latency_scale=1.0):
+        """
+        :param str path: Path of the cassette file, e.g. cassettes/run.jsonl.gz
+        :param str mode: "record" or "replay"
+        :param bool replay_latency: In replay mode, wait for the recorded latency of each call before answering
+        :param float latency_scale: Factor applied to the recorded latencies, e.g. 0.1 to replay 10 times faster
+        """
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"Invalid cassette mode {mode}. Please select from {CASSETTE_MODES}.")
+        self.path = path
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self.latency_scale = latency_scale
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._replay_positions = {}
+        self._file = None
+
+        if mode == "record":
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._file = gzip.open(path, "wt", encoding="utf-8")
+        else:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"LLM cassette {path} does not exist, record it first")
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries.setdefault(entry["key"], []).append(entry)
+
+    def __len__(self):
+        with self._lock:
+            return self.recorded if self.mode == "record" else sum(len(entries) for entries in self._entries.values())
+
+    def record(self, key, model_name, answer, latency, usage=None):
+        entry = {"key": key, "model": model_name, "answer": answer, "latency": round(latency, 4), "usage": usage}
+        with self._lock:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.recorded += 1
+
+    def replay(self, key):
+        """
+        Returns the next recorded entry of a request. Raises CassetteMissError if the request was not recorded.
+        """
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                self.misses += 1
+                raise CassetteMissError(
+                    f"LLM request {key[:12]} is not in the cassette {self.path}, record it again after changing the prompts or sampling parameters"
+                )
+            position = self._replay_positions.get(key, 0)
+            # Requests recorded several times are replayed in the recorded order, the last answer is repeated afterwards
+            self._replay_positions[key] = min(position + 1, len(entries) - 1)
+            self.replayed += 1
+            return entries[position]
+
+    def replay_delay(self, entry):
+        return entry.get("latency", 0) * self.latency_scale if self.replay_latency else 0
+
+    def stats(self):
+        return {"mode": self.mode, "entries": len(self), "recorded": self.recorded, "replayed": self.replayed, "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# Cassettes are shared by all the stages using the same file
+_LLM_CASSETTES = {}
+_LLM_CASSETTES_LOCK = threading.Lock()
+
+
+def get_llm_cassette(path, mode="replay", replay_latency=False, latency_scale=1.0):
+    """
+    Get the cassette stored at `path`. It is opened on first use (a recorded cassette is started anew once per run)
+    and shared afterwards.
+    """
+    with _LLM_CASSETTES_LOCK:
+        if path not in _LLM_CASSETTES:
+            _LLM_CASSETTES[path] = LLMCassette(path, mode=mode, replay_latency=replay_latency, latency_scale=latency_scale)
+        return _LLM_CASSETTES[path]
+
+
+def close_llm_cassettes():
+    """
+    Close the recorded cassettes, which writes the end of their gzip stream.
+    """
+    with _LLM_CASSETTES_LOCK:
+        for cassette in _LLM_CASSETTES.values():
+            cassette.close()
+
+
+atexit.register(close_llm_cassettes)
+
+
+class CassetteLLMCaller(LLMCaller):
+    """
+    Wrap a LLMCaller with a LLMCassette. In "record" mode the calls are sent to `llm_caller` and recorded with their
+    latency and usage. In "replay" mode no LLM is called (`llm_caller` can be None) and the usage and latency of the
+    replayed calls are added to `usage` and `telemetry`, so that the usage and performance reports of a replayed run
+    match the recorded run.
+    Batch jobs are not recorded: the calls of the "batch" execution mode are sent one by one, see dispatch_llm_calls.
+    """
+    supports_batch = False
+
+    def __init__(self, cassette, llm_caller=None, model_name=None, usage=None, telemetry=None):
+        """
+        :param LLMCassette cassette: Cassette the calls are recorded to or replayed from
+        :param LLMCaller llm_caller: LLM called in record mode
+        :param str model_name: Model of the requests, part of their content address. Default as the model of `llm_caller`
+        :param LLMUsage usage: Token usage counters the replayed calls are added to
+        :param StageTelemetry telemetry: Telemetry the replayed calls are added to, with their recorded latency
+        """
+        if cassette.mode == "record" and llm_caller is None:
+            raise ValueError("llm_caller is required to record a cassette")
+        self.cassette = cassette
+        self.llm_caller = llm_caller
+        self.model_name = model_name or getattr(llm_caller, "model_name", type(llm_caller).__name__)
+        self.usage = usage
+        self.telemetry = telemetry
+
+    def _replayed_answer(self, entry):
+        if entry.get("usage"):
+            self.record_usage(entry["usage"])
+        self.record_call(entry.get("latency", 0))
+        return [entry["answer"]]
+
+    def _record(self, key, answer, start, call_usage):
+        # A call retried after an error only has the usage of its successful response
+        usage = usage_to_dict(call_usage[-1]) if call_usage else None
+        self.cassette.record(key, self.model_name, answer, time.perf_counter() - start, usage)
+
+    def __call__(self, prompt, sampling_params={}) -> List[str]:
+        key = make_cache_key(self.model_name, prompt, sampling_params)
+        if self.cassette.mode == "replay":
+            entry = self.cassette.replay(key)
+            time.sleep(self.cassette.replay_delay(entry))
+            return self._replayed_answer(entry)
+        call_usage = []
+        token = CALL_USAGE.set(call_usage)
+        try:
+            start = time.perf_counter()
+            answer = self.llm_caller(prompt, sampling_params)[0]
+        finally:
+            CALL_USAGE.reset(token)
+        self._record(key, answer, start, call_usage)
+        return [answer]
+
+    async def acall(self, prompt, sampling_params={}) -> List[str]:
+        key = make_cache_key(self.model_name, prompt, sampling_params)
+        if self.cassette.mode == "replay":
+            entry = self.cassette.replay(key)
+            await asyncio.sleep(self.cassette.replay_delay(entry))
+            return self._replayed_answer(entry)
+        call_usage = []
+        token = CALL_USAGE.set(call_usage)
+        try:
+            start = time.perf_counter()
+            answer = (await self.llm_caller.acall(prompt, sampling_params))[0]
+        finally:
+            CALL_USAGE.reset(token)
+        self._record(key, answer, start, call_usage)
+        return [answer]
+
+    async def aclose(self):
+        if self.llm_caller is not None:
+            await self.llm_caller.aclose()
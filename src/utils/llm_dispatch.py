@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import os
+import random
+
+from tqdm import tqdm
+
+from .llm_backbone import CALL_LABEL
+from .llm_batch import create_batch_runner
+from .llm_cache import RESPONSE_CACHE_HIT, CachedLLMCaller
+
+logger = logging.getLogger(__name__)
+
+EXECUTION_MODES = ["sequential", "async", "batch"]
+# Sources of the answers of a stage: the LLM, its response cache, the rules, the cascade classifier or the checkpoint
+# of an interrupted run
+ANSWER_SOURCES = ["llm", "cache", "rule", "cascade", "checkpoint"]
+
+
+def dispatch_llm_calls(llm_caller, prompts, sampling_params, execution_mode="sequential", max_concurrency=8, batch_state_path=None, batch_poll_interval=60, labels=None, on_answer=None, answer_sources=None):
+    """
+    Send a list of prompts to a LLM and return the answers in the same order as the prompts.
+
+    Args:
+        llm_caller (LLMCaller): LLM used to answer the prompts.
+        prompts (list): List of chat prompts, as built by `databricks_llm_prompt`/`databricks_llm_prompt_chat`.
+        sampling_params (dict): Sampling parameters passed to the LLM.
+        execution_mode (str, default="sequential"): "sequential" calls the LLM one prompt at a time,
+            "async" sends up to `max_concurrency` prompts concurrently, "batch" sends all the prompts as one
+            job of the provider batch API and waits for it to finish.
+        max_concurrency (int, default=8): Maximum number of in-flight requests in "async" mode.
+            Rate limits are enforced by the rate limiter of `llm_caller`.
+        batch_state_path (str, default=None): Path of the batch job state file. Required in "batch" mode.
+            An unfinished job with the same prompts is resumed from this file.
+        batch_poll_interval (float, default=60): Seconds between two status checks of the batch job.
+        labels (list, default=None): Telemetry label of each prompt within its stage, e.g. the event type of a per-label
+            prompt, see CALL_LABEL.
+        on_answer (callable, default=None): Called with the index of a prompt and its stripped answer as soon as the answer
+            is received, e.g. to checkpoint the completed events. The answers of a batch job are received when it finishes.
+        answer_sources (list, default=None): Filled with the source of each answer, aligned with `prompts`: "cache" for
+            the answers of the LLM response cache, "llm" for the others. See ANSWER_SOURCES.
+
+    Returns:
+        list: Stripped LLM answers, aligned with `prompts`.
+    """
+    if execution_mode not in EXECUTION_MODES:
+        raise ValueError(f"Invalid execution_mode {execution_mode}. Please select from {EXECUTION_MODES}.")
+
+    labels = labels or [None] * len(prompts)
+    sources = [None] * len(prompts)
+    answers = _dispatch(llm_caller, prompts, sampling_params, execution_mode, max_concurrency, batch_state_path, batch_poll_interval, labels, on_answer, sources)
+    if answer_sources is not None:
+        answer_sources[:] = sources
+    return answers
+
+
+def _dispatch(llm_caller, prompts, sampling_params, execution_mode, max_concurrency, batch_state_path, batch_poll_interval, labels, on_answer, sources):
+    if execution_mode == "async":
+        return asyncio.run(_dispatch_async(llm_caller, prompts, sampling_params, max_concurrency, labels, on_answer, sources))
+
+    if execution_mode == "batch" and not getattr(llm_caller, "supports_batch", True):
+        # e.g. a cassette recording the calls one by one, or replaying them without any provider
+        logger.info(f"{type(llm_caller).__name__} does not support batch jobs, calling the LLM one prompt at a time")
+        execution_mode = "sequential"
+
+    if execution_mode == "batch":
+        if not batch_state_path:
+            raise ValueError("batch_state_path must be provided in batch execution mode")
+        return _dispatch_batch(llm_caller, prompts, sampling_params, batch_state_path, batch_poll_interval, labels, on_answer, sources)
+
+    answers = []
+    for idx, (prompt, label) in enumerate(tqdm(zip(prompts, labels), total=len(prompts))):
+        token = CALL_LABEL.set(label)
+        cache_hit_token = RESPONSE_CACHE_HIT.set(False)
+        try:
+            answers.append(llm_caller(prompt, sampling_params)[0].strip())
+            sources[idx] = "cache" if RESPONSE_CACHE_HIT.get() else "llm"
+        finally:
+            RESPONSE_CACHE_HIT.reset(cache_hit_token)
+            CALL_LABEL.reset(token)
+        if on_answer is not None:
+            on_answer(idx, answers[-1])
+    return answers
+
+
+def sample_audit_events(num_events, audit_fraction, seed=42, keys=None):
+    """
+    Returns a flag per event, True for the events sampled for audit (about `audit_fraction` of them).
+    The sample is seeded so that reruns audit the same events and their answers are served from the LLM cache.
+    With `keys` (e.g. the source and Index of the events), the flag of an event only depends on its key: the sample
+    is the same whether the events are classified at once or in chunks.
+    """
+    if keys is not None:
+        return [random.Random(f"{seed}:{key}").random() < audit_fraction for key in keys]
+    rng = random.Random(seed)
+    return [rng.random() < audit_fraction for _ in range(num_events)]
+
+
+def dispatch_audited_llm_calls(llm_caller, prompts, audit_prompts, audit_flags, sampling_params, audit_sampling_params, batch_state_path=None, labels=None, on_answer=None, answer_sources=None, **dispatch_kwargs):
+    """
+    Send `prompts` with `sampling_params`, except the prompts flagged in `audit_flags` which are replaced by their
+    `audit_prompts` counterpart and sent with `audit_sampling_params`, e.g. answer-only prompts with a small
+    max_tokens and a stop sequence, and the prompts asking for a reason for a sample of the events.
+
+    The two groups of prompts are dispatched one after the other with `dispatch_llm_calls` and `dispatch_kwargs`.
+    In "batch" mode the audited prompts are a separate batch job, whose state is stored next to `batch_state_path`.
+    `on_answer` is called with the index of the prompt in `prompts`, and `answer_sources` is aligned with `prompts`, see
+    dispatch_llm_calls.
+
+    Returns:
+        list: Stripped LLM answers, aligned with `prompts`.
+    """
+    answers = [None] * len(prompts)
+    sources = [None] * len(prompts)
+    audit_batch_state_path = f"{os.path.splitext(batch_state_path)[0]}_audit.json" if batch_state_path else None
+    for audited, group_prompts, group_sampling_params, group_batch_state_path in [
+        (False, prompts, sampling_params, batch_state_path),
+        (True, audit_prompts, audit_sampling_params, audit_batch_state_path),
+    ]:
+        indices = [idx for idx, flag in enumerate(audit_flags) if flag == audited]
+        if not indices:
+            continue
+        group_sources = []
+        group_answers = dispatch_llm_calls(
+            llm_caller,
+            [group_prompts[idx] for idx in indices],
+            group_sampling_params,
+            batch_state_path=group_batch_state_path,
+            labels=[labels[idx] for idx in indices] if labels else None,
+            on_answer=(lambda position, answer, indices=indices: on_answer(indices[position], answer)) if on_answer else None,
+            answer_sources=group_sources,
+            **dispatch_kwargs,
+        )
+        for idx, answer, source in zip(indices, group_answers, group_sources):
+            answers[idx] = answer
+            sources[idx] = source
+    if answer_sources is not None:
+        answer_sources[:] = sources
+    return answers
+
+
+async def _dispatch_async(llm_caller, prompts, sampling_params, max_concurrency, labels, on_answer, sources):
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    progress = tqdm(total=len(prompts))
+
+    async def _call(idx, prompt, label):
+        # Each call runs in its own task, with its own copy of the context
+        CALL_LABEL.set(label)
+        RESPONSE_CACHE_HIT.set(False)
+        async with semaphore:
+            answer = await llm_caller.acall(prompt, sampling_params)
+        sources[idx] = "cache" if RESPONSE_CACHE_HIT.get() else "llm"
+        progress.update(1)
+        if on_answer is not None:
+            on_answer(idx, answer[0].strip())
+        return answer[0].strip()
+
+    try:
+        # gather keeps the order of the prompts regardless of completion order
+        return await asyncio.gather(*[_call(idx, prompt, label) for idx, (prompt, label) in enumerate(zip(prompts, labels))])
+    finally:
+        progress.close()
+        await llm_caller.aclose()
+
+
+def _dispatch_batch(llm_caller, prompts, sampling_params, batch_state_path, batch_poll_interval, labels, on_answer, sources):
+    answers = [None] * len(prompts)
+    pending = list(range(len(prompts)))
+
+    # Prompts already in the response cache are not sent to the batch API
+    remote_caller = llm_caller
+    if isinstance(llm_caller, CachedLLMCaller):
+        remote_caller = llm_caller.llm_caller
+        for idx in range(len(prompts)):
+            answers[idx] = llm_caller.lookup(prompts[idx], sampling_params)
+        pending = [idx for idx in range(len(prompts)) if answers[idx] is None]
+        for idx in range(len(prompts)):
+            sources[idx] = "llm" if answers[idx] is None else "cache"
+        logger.info(f"{len(prompts) - len(pending)} prompts answered from the LLM cache, {len(pending)} sent to the batch API")
+
+    if pending:
+        batch_runner = create_batch_runner(remote_caller, batch_state_path, poll_interval=batch_poll_interval)
+        batch_answers = batch_runner.run([prompts[idx] for idx in pending], sampling_params, [labels[idx] for idx in pending])
+        for position, idx in enumerate(pending):
+            answers[idx] = batch_answers.get(str(position))
+            sources[idx] = "llm"
+            if answers[idx] is not None and isinstance(llm_caller, CachedLLMCaller):
+                llm_caller.store(prompts[idx], sampling_params, answers[idx])
+    if on_answer is not None:
+        for idx, answer in enumerate(answers):
+            if answer is not None:
+                on_answer(idx, answer.strip())
+
+    # Requests that failed in the batch job are sent again one by one
+    failed = [idx for idx in range(len(prompts)) if answers[idx] is None]
+    if failed:
+        logger.warning(f"{len(failed)} batch requests failed, calling the LLM directly for them")
+        for idx in tqdm(failed):
+            token = CALL_LABEL.set(labels[idx])
+            cache_hit_token = RESPONSE_CACHE_HIT.set(False)
+            try:
+                answers[idx] = llm_caller(prompts[idx], sampling_params)[0]
+                sources[idx] = "cache" if RESPONSE_CACHE_HIT.get() else "llm"
+            finally:
+                RESPONSE_CACHE_HIT.reset(cache_hit_token)
+                CALL_LABEL.reset(token)
+            if on_answer is not None:
+                on_answer(idx, answers[idx].strip())
+    return [answer.strip() for answer in answers]
@@ -0,0 +1,243 @@
+import asyncio
+import collections
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import List
+
+from .llm_backbone import CircuitOpenError, LLMCaller, get_circuit_breaker, get_rate_limiter
+from .llm_backends import create_llm_caller, get_llm_backend
+from .llm_cache import CachedLLMCaller
+from .llm_metrics import HedgeStats, percentile
+
+logger = logging.getLogger(__name__)
+
+# Threads of the hedged calls of the sequential execution mode. A thread can not be interrupted: the losing call
+# of a hedge finishes in the background and its answer is dropped
+_HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm_hedge")
+
+
+def _valid_answer(future):
+    """
+    Whether a finished call (a concurrent future or an asyncio task) returned a non-empty answer.
+    """
+    return not future.cancelled() and future.exception() is None and bool(future.result()[0][0].strip())
+
+
+class HedgedLLMCaller(LLMCaller):
+    """
+    Wrap a LLMCaller with hedged requests and failover.
+
+    A call still running after the `percentile` latency of the recent calls (at least `min_delay` seconds) is hedged:
+    a duplicate request is sent to `alternate_caller`, or to `llm_caller` again if there is none. The first non-empty
+    answer is returned and the other request is cancelled. While the circuit breaker of `llm_caller` is open, the calls
+    fail over to `alternate_caller` directly.
+
+    The latency saved by a hedge is measured when the losing call finishes in the background (sequential calls), and
+    estimated from the recent latencies when it is cancelled (async calls), see expected_excess_latency.
+    """
+
+    def __init__(self, llm_caller, alternate_caller=None, percentile=95, min_delay=1.0, initial_delay=10.0, warmup_calls=20, window=500, stats=None):
+        """
+        :param LLMCaller llm_caller: LLM called first
+        :param LLMCaller alternate_caller: LLM of the hedged requests and of the failovers, e.g. GPT-4o for Mistral.
+            Default as none: the hedged requests are sent to `llm_caller` and there is no failover
+        :param float percentile: Latency percentile of the recent calls of `llm_caller` after which a call is hedged
+        :param float min_delay: Minimum seconds before a call is hedged
+        :param float initial_delay: Seconds before a call is hedged until `warmup_calls` latencies are known
+        :param int warmup_calls: Number of latencies needed to use the percentile
+        :param int window: Number of recent latencies of `llm_caller` the percentile is computed on
+        :param HedgeStats stats: Hedging stats the calls are added to
+        """
+        self.llm_caller = llm_caller
+        self.alternate_caller = alternate_caller
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.initial_delay = initial_delay
+        self.warmup_calls = warmup_calls
+        self.stats = stats or HedgeStats()
+        self.model_name = getattr(llm_caller, "model_name", type(llm_caller).__name__)
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=window)
+
+    @property
+    def hedge_caller(self):
+        return self.alternate_caller or self.llm_caller
+
+    def hedge_delay(self):
+        """
+        Seconds after which a call is hedged.
+        """
+        with self._lock:
+            latencies = list(self._latencies)
+        if len(latencies) < self.warmup_calls:
+            return max(self.min_delay, self.initial_delay)
+        return max(self.min_delay, percentile(latencies, self.percentile))
+
+    def expected_excess_latency(self, elapsed):
+        """
+        Expected remaining latency of a call of `llm_caller` still running after `elapsed` seconds, estimated from the
+        recent latencies above `elapsed`. It is the latency saved when the hedged request answers at `elapsed`.
+        """
+        with self._lock:
+            excess = [latency - elapsed for latency in self._latencies if latency > elapsed]
+        return sum(excess) / len(excess) if excess else 0.0
+
+    def _record_latency(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def _cached_answer(self, prompt, sampling_params):
+        """
+        Cached answer of `llm_caller` if it is a CachedLLMCaller, see create_hedged_llm_caller. Cache hits are neither
+        hedged nor added to the latencies.
+        """
+        lookup = getattr(self.llm_caller, "lookup", None)
+        return lookup(prompt, sampling_params) if lookup is not None else None
+
+    def _fails_over(self, error):
+        """
+        Whether a failed call of `llm_caller` is sent to `alternate_caller`: when the circuit of `llm_caller` is open.
+        """
+        if self.alternate_caller is None:
+            return False
+        circuit_breaker = getattr(self.llm_caller, "circuit_breaker", None)
+        return isinstance(error, CircuitOpenError) or (circuit_breaker is not None and circuit_breaker.state == "open")
+
+    def _call_with_failover(self, prompt, sampling_params):
+        """
+        Returns the answer of `llm_caller` and whether the call failed over to `alternate_caller`.
+        """
+        start = time.perf_counter()
+        try:
+            answer = self.llm_caller(prompt, sampling_params)
+        except Exception as e:
+            if not self._fails_over(e):
+                raise
+            return self.alternate_caller(prompt, sampling_params), True
+        self._record_latency(time.perf_counter() - start)
+        return answer, False
+
+    async def _acall_with_failover(self, prompt, sampling_params):
+        start = time.perf_counter()
+        try:
+            answer = await self.llm_caller.acall(prompt, sampling_params)
+        except Exception as e:
+            if not self._fails_over(e):
+                raise
+            return await self.alternate_caller.acall(prompt, sampling_params), True
+        self._record_latency(time.perf_counter() - start)
+        return answer, False
+
+    def _call_hedge(self, prompt, sampling_params):
+        return self.hedge_caller(prompt, sampling_params), False
+
+    async def _acall_hedge(self, prompt, sampling_params):
+        return await self.hedge_caller.acall(prompt, sampling_params), False
+
+    def _hedged_answer(self, start, primary, hedge, valid, latency_saved=0.0):
+        """
+        Answer of a hedged call: the primary answer if valid, else the hedge answer if valid, else the primary
+        answer or error.
+        """
+        hedge_won = primary not in valid and hedge in valid
+        winner = hedge if hedge_won else primary
+        answer, failover = winner.result()
+        self.stats.record(time.perf_counter() - start, hedged=True, hedge_won=hedge_won, failover=failover, latency_saved=latency_saved if hedge_won else 0.0)
+        return answer
+
+    def __call__(self, prompt, sampling_params={}) -> List[str]:
+        cached_answer = self._cached_answer(prompt, sampling_params)
+        if cached_answer is not None:
+            return [cached_answer]
+        start = time.perf_counter()
+        # The calls run in threads with a copy of the context of the caller, e.g. the usage of a call being recorded
+        primary = _HEDGE_EXECUTOR.submit(contextvars.copy_context().run, self._call_with_failover, prompt, sampling_params)
+        done, _ = wait([primary], timeout=self.hedge_delay())
+        if done:
+            answer, failover = primary.result()
+            self.stats.record(time.perf_counter() - start, failover=failover)
+            return answer
+
+        hedge = _HEDGE_EXECUTOR.submit(contextvars.copy_context().run, self._call_hedge, prompt, sampling_params)
+        pending = {primary, hedge}
+        valid = []
+        while pending and not valid:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            valid = [future for future in done if _valid_answer(future)]
+        for future in pending:
+            future.cancel()
+        if primary in pending:
+            # The primary call finishes in the background, the latency saved is measured when it does
+            won_at = time.perf_counter()
+            primary.add_done_callback(lambda future: self.stats.add_latency_saved(time.perf_counter() - won_at) if _valid_answer(future) else None)
+        return self._hedged_answer(start, primary, hedge, valid)
+
+    async def acall(self, prompt, sampling_params={}) -> List[str]:
+        cached_answer = self._cached_answer(prompt, sampling_params)
+        if cached_answer is not None:
+            return [cached_answer]
+        start = time.perf_counter()
+        primary = asyncio.ensure_future(self._acall_with_failover(prompt, sampling_params))
+        done, _ = await asyncio.wait([primary], timeout=self.hedge_delay())
+        if done:
+            answer, failover = primary.result()
+            self.stats.record(time.perf_counter() - start, failover=failover)
+            return answer
+
+        hedge = asyncio.ensure_future(self._acall_hedge(prompt, sampling_params))
+        pending = {primary, hedge}
+        valid = []
+        while pending and not valid:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            valid = [task for task in done if _valid_answer(task)]
+        # The cancelled primary call never answers, the latency saved is estimated
+        latency_saved = self.expected_excess_latency(time.perf_counter() - start) if primary in pending else 0.0
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        return self._hedged_answer(start, primary, hedge, valid, latency_saved)
+
+    async def aclose(self):
+        await self.llm_caller.aclose()
+        if self.alternate_caller is not None:
+            await self.alternate_caller.aclose()
+
+
+def create_hedged_llm_caller(llm_caller, hedging_config, stats=None, llm_backends=None, api_keys=None, circuit_breaker_config=None, usage=None, llm_cache=None, **caller_kwargs):
+    """
+    Wrap `llm_caller` with a HedgedLLMCaller.
+
+    :param dict hedging_config: Keyword arguments of HedgedLLMCaller, and
+        - alternate_llm_name (str): Backend of the hedged requests and failovers, see get_llm_backend. Default as none
+        - rate_limit (dict): Keyword arguments of the rate limiter of the alternate backend, if not already created
+    :param LLMResponseCache llm_cache: Response cache of the calls. `llm_caller` and the alternate caller are cached
+        separately, the answers of the alternate LLM are stored under its own model
+    :param caller_kwargs: Arguments of the alternate caller, see create_llm_caller
+    """
+    hedging_config = dict(hedging_config)
+    alternate_llm_name = hedging_config.pop("alternate_llm_name", None)
+    rate_limit_config = hedging_config.pop("rate_limit", None) or {}
+    alternate_caller = None
+    if alternate_llm_name:
+        backend = get_llm_backend(alternate_llm_name, llm_backends)
+        if caller_kwargs.get("telemetry") is not None:
+            caller_kwargs["telemetry"] = caller_kwargs["telemetry"].with_provider(alternate_llm_name, backend["model_name"])
+        # The alternate backend shares its rate limiter and circuit breaker with the stages using it as their LLM
+        alternate_caller = create_llm_caller(
+            backend,
+            api_keys,
+            usage=usage,
+            rate_limiter=get_rate_limiter(alternate_llm_name, **rate_limit_config),
+            circuit_breaker=get_circuit_breaker(alternate_llm_name, **(circuit_breaker_config or {})),
+            **caller_kwargs,
+        )
+    if llm_cache is not None:
+        llm_caller = CachedLLMCaller(llm_caller, llm_cache)
+        if alternate_caller is not None:
+            alternate_caller = CachedLLMCaller(alternate_caller, llm_cache)
+    logger.info(f"Hedging the LLM calls of {getattr(llm_caller, 'model_name', type(llm_caller).__name__)} to {alternate_llm_name or 'the same backend'}")
+    return HedgedLLMCaller(llm_caller, alternate_caller, stats=stats, **hedging_config)
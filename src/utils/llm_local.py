@@ -0,0 +1,116 @@
+import logging
+import threading
+import time
+from typing import List
+
+from .llm_backbone import DEFAULT_SAMPLING_PARAMS, LLMCaller, format_logprob_answer, restore_stop_sequence
+
+try:
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+except ImportError:
+    # transformers and torch are optional, they are only needed by the "local" backend
+    AutoModelForCausalLM = None
+
+logger = logging.getLogger(__name__)
+
+# Below these values the sampling is equivalent to greedy decoding, e.g. DEFAULT_SAMPLING_PARAMS
+GREEDY_TEMPERATURE = 0.01
+GREEDY_TOP_P = 0.01
+
+
+_LOCAL_MODELS = {}
+_LOCAL_MODELS_LOCK = threading.Lock()
+
+
+def get_local_model(model_name, device="cpu", num_threads=None):
+    """
+    Get the tokenizer and the model of `model_name` (a Hugging Face model id or a local path) on `device`.
+    They are loaded on first use and shared afterwards, by all the stages using the model.
+
+    :param int num_threads: Number of CPU threads used by torch. Default as the torch default (all the cores)
+    """
+    if AutoModelForCausalLM is None:
+        raise ImportError("The local LLM backend requires transformers and torch: pip install transformers torch")
+    key = (model_name, device)
+    with _LOCAL_MODELS_LOCK:
+        if key not in _LOCAL_MODELS:
+            if num_threads:
+                torch.set_num_threads(num_threads)
+            tokenizer = AutoTokenizer.from_pretrained(model_name)
+            model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32).to(device)
+            model.eval()
+            _LOCAL_MODELS[key] = (tokenizer, model, threading.Lock())
+            logger.info(f"Loaded local LLM {model_name} on {device}")
+        return _LOCAL_MODELS[key]
+
+
+class LocalLLMCaller(LLMCaller):
+    """
+    LLM run in-process with Hugging Face transformers, for tests and low-cost runs with small instruction models
+    (e.g. Qwen/Qwen2.5-0.5B-Instruct on CPU). The prompts are formatted with the chat template of the model.
+    The generations of a model are serialized: one generation already uses all the CPU cores.
+    There is no batch API, the calls of the "batch" execution mode are made one by one.
+    """
+    supports_batch = False
+
+    def __init__(self, model_name, device="cpu", num_threads=None, usage=None, telemetry=None):
+        """
+        :param str model_name: Hugging Face model id or local path of the model
+        :param str device: Torch device of the model
+        :param int num_threads: Number of CPU threads used by torch, see get_local_model
+        :param LLMUsage usage: Token usage counters the generations are added to
+        :param StageTelemetry telemetry: Telemetry the generations are added to, see llm_telemetry
+        """
+        self.model_name = model_name
+        self.device = device
+        self.num_threads = num_threads
+        self.usage = usage
+        self.telemetry = telemetry
+
+    def __call__(self, prompt, sampling_params={}) -> List[str]:
+        tokenizer, model, lock = get_local_model(self.model_name, self.device, self.num_threads)
+        start = time.perf_counter()
+        sampling_params = {**DEFAULT_SAMPLING_PARAMS, **{key: value for key, value in (sampling_params or {}).items() if value is not None}}
+        max_new_tokens = sampling_params.get("max_tokens") or 512
+        stop = sampling_params.get("stop") or []
+        stop = [stop] if isinstance(stop, str) else list(stop)
+
+        input_ids = tokenizer.apply_chat_template(prompt, add_generation_prompt=True, return_tensors="pt").to(self.device)
+        generate_kwargs = {
+            "max_new_tokens": max_new_tokens,
+            "do_sample": sampling_params["temperature"] >= GREEDY_TEMPERATURE and sampling_params["top_p"] >= GREEDY_TOP_P,
+            "return_dict_in_generate": True,
+            "output_scores": bool(sampling_params.get("logprobs")),
+            "pad_token_id": tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
+        }
+        if generate_kwargs["do_sample"]:
+            generate_kwargs["temperature"] = sampling_params["temperature"]
+            generate_kwargs["top_p"] = sampling_params["top_p"]
+        if stop:
+            generate_kwargs["stop_strings"] = stop
+            generate_kwargs["tokenizer"] = tokenizer
+
+        with lock, torch.inference_mode():
+            if generate_kwargs["do_sample"] and sampling_params.get("seed") is not None:
+                torch.manual_seed(sampling_params["seed"])
+            output = model.generate(input_ids, attention_mask=torch.ones_like(input_ids), **generate_kwargs)
+
+        completion_ids = output.sequences[0, input_ids.shape[1]:]
+        answer = tokenizer.decode(completion_ids, skip_special_tokens=True)
+        finish_reason = "length" if len(completion_ids) >= max_new_tokens else "stop"
+        # Generation stops after the token completing a stop sequence, cut the answer before it as the APIs do
+        stop_positions = [answer.find(sequence) for sequence in stop if sequence in answer]
+        if stop_positions:
+            answer = answer[:min(stop_positions)]
+            finish_reason = "stop"
+        self.record_usage({"prompt_tokens": input_ids.shape[1], "completion_tokens": len(completion_ids)})
+        self.record_call(time.perf_counter() - start)
+
+        answer = restore_stop_sequence(answer.strip(), finish_reason, sampling_params)
+        if sampling_params.get("logprobs") and output.scores:
+            top_logprobs = torch.log_softmax(output.scores[0][0].float(), dim=-1).topk(sampling_params.get("top_logprobs") or 5)
+            answer = format_logprob_answer(
+                answer, [(tokenizer.decode([token_id]), logprob) for logprob, token_id in zip(top_logprobs.values.tolist(), top_logprobs.indices.tolist())]
+            )
+        return [answer]
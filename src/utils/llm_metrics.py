@@ -0,0 +1,319 @@
+import math
+import threading
+
+
+def _usage_value(usage, *path):
+    """
+    Read a nested field of a usage object or dict, e.g. _usage_value(usage, "prompt_tokens_details", "cached_tokens").
+    """
+    value = usage
+    for key in path:
+        if value is None:
+            return 0
+        value = value.get(key) if isinstance(value, dict) else getattr(value, key, None)
+    return value or 0
+
+
+def percentile(values, q):
+    """
+    Nearest-rank `q` percentile (0-100) of `values`, None if there is no value.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(q / 100 * len(values)) - 1))]
+
+
+def counters_state(stats):
+    """
+    The counters of a stats object (its public attributes, numbers and lists of latencies), e.g. to send them from a
+    Spark executor to the driver, see merge_llm_metrics_state.
+    """
+    return {key: list(value) if isinstance(value, list) else value for key, value in vars(stats).items() if not key.startswith("_")}
+
+
+def merge_counters(stats, state):
+    """
+    Add the counters of `state`, see counters_state, to those of `stats`.
+    """
+    for key, value in state.items():
+        if isinstance(value, list):
+            getattr(stats, key).extend(value)
+        else:
+            setattr(stats, key, getattr(stats, key) + value)
+
+
+def usage_to_dict(usage):
+    """
+    Compact dict of the token counts of a usage object or dict, in the format of the chat completion `usage` field.
+    """
+    return {
+        "prompt_tokens": _usage_value(usage, "prompt_tokens"),
+        "completion_tokens": _usage_value(usage, "completion_tokens"),
+        "prompt_tokens_details": {"cached_tokens": _usage_value(usage, "prompt_tokens_details", "cached_tokens")},
+    }
+
+
+class LLMUsage:
+    """
+    Token usage of the LLM requests of a stage, aggregated from the `usage` field of the responses.
+    cached_tokens are the prompt tokens served from the provider prompt prefix cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+
+    def record(self, usage):
+        """
+        :param usage: `usage` field of a chat completion, as returned by the client or as a dict
+        """
+        if usage is None:
+            return
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens += _usage_value(usage, "prompt_tokens")
+            self.completion_tokens += _usage_value(usage, "completion_tokens")
+            self.cached_tokens += _usage_value(usage, "prompt_tokens_details", "cached_tokens")
+
+    def state(self):
+        with self._lock:
+            return counters_state(self)
+
+    def merge(self, state):
+        with self._lock:
+            merge_counters(self, state)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "prefix_cache_hit_rate": round(self.cached_tokens / self.prompt_tokens, 4) if self.prompt_tokens else 0.0,
+        }
+
+
+# Usage is aggregated per stage, e.g. "event_relevance", "event_type"
+_LLM_USAGE = {}
+_LLM_USAGE_LOCK = threading.Lock()
+
+
+def get_llm_usage(stage):
+    """
+    Get the usage counters of a stage. They are created on first use and shared afterwards.
+    """
+    with _LLM_USAGE_LOCK:
+        if stage not in _LLM_USAGE:
+            _LLM_USAGE[stage] = LLMUsage()
+        return _LLM_USAGE[stage]
+
+
+def get_llm_usage_report():
+    """
+    Returns the usage stats of all the stages, keyed by stage.
+    """
+    with _LLM_USAGE_LOCK:
+        return {stage: usage.stats() for stage, usage in _LLM_USAGE.items()}
+
+
+class TruncationStats:
+    """
+    Event descriptions truncated to the token budget of a stage, see truncate_event_descriptions.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.articles = 0
+        self.truncated = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+
+    def record(self, tokens_before, tokens_after):
+        with self._lock:
+            self.articles += 1
+            self.truncated += tokens_after < tokens_before
+            self.tokens_before += tokens_before
+            self.tokens_after += tokens_after
+
+    def state(self):
+        with self._lock:
+            return counters_state(self)
+
+    def merge(self, state):
+        with self._lock:
+            merge_counters(self, state)
+
+    def stats(self):
+        return {
+            "articles": self.articles,
+            "truncated": self.truncated,
+            "tokens_before": self.tokens_before,
+            "tokens_saved": self.tokens_before - self.tokens_after,
+        }
+
+
+_TRUNCATION_STATS = {}
+
+
+def get_truncation_stats(stage):
+    """
+    Get the truncation stats of a stage. They are created on first use and shared afterwards.
+    """
+    with _LLM_USAGE_LOCK:
+        if stage not in _TRUNCATION_STATS:
+            _TRUNCATION_STATS[stage] = TruncationStats()
+        return _TRUNCATION_STATS[stage]
+
+
+def get_truncation_report():
+    """
+    Returns the truncation stats of all the stages, keyed by stage.
+    """
+    with _LLM_USAGE_LOCK:
+        return {stage: stats.stats() for stage, stats in _TRUNCATION_STATS.items()}
+
+
+class HedgeStats:
+    """
+    Hedged requests and failovers of the LLM calls of a stage, see HedgedLLMCaller.
+    latency_saved is the latency of the calls won by the hedge minus the latency of their original request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+        self.latency_saved = 0.0
+        self.latencies = []
+
+    def record(self, latency, hedged=False, hedge_won=False, failover=False, latency_saved=0.0):
+        with self._lock:
+            self.calls += 1
+            self.hedged += hedged
+            self.hedge_wins += hedge_won
+            self.failovers += failover
+            self.latency_saved += latency_saved
+            self.latencies.append(latency)
+
+    def add_latency_saved(self, latency_saved):
+        with self._lock:
+            self.latency_saved += latency_saved
+
+    def state(self):
+        with self._lock:
+            return counters_state(self)
+
+    def merge(self, state):
+        with self._lock:
+            merge_counters(self, state)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedged": self.hedged,
+                "hedge_rate": round(self.hedged / self.calls, 4) if self.calls else 0.0,
+                "hedge_wins": self.hedge_wins,
+                "failovers": self.failovers,
+                "latency_saved_seconds": round(self.latency_saved, 2),
+                **{f"p{q}_latency_seconds": round(percentile(self.latencies, q) or 0.0, 3) for q in [50, 95, 99]},
+            }
+
+
+_HEDGE_STATS = {}
+
+
+def get_hedge_stats(stage):
+    """
+    Get the hedging stats of a stage. They are created on first use and shared afterwards.
+    """
+    with _LLM_USAGE_LOCK:
+        if stage not in _HEDGE_STATS:
+            _HEDGE_STATS[stage] = HedgeStats()
+        return _HEDGE_STATS[stage]
+
+
+def get_hedge_report():
+    """
+    Returns the hedging stats of all the stages, keyed by stage.
+    """
+    with _LLM_USAGE_LOCK:
+        return {stage: stats.stats() for stage, stats in _HEDGE_STATS.items()}
+
+
+class AnswerSources:
+    """
+    Sources of the answers of the events of a stage (see ANSWER_SOURCES of llm_dispatch), keyed by event (see
+    event_key): one source per prompt of the event, e.g. the four per-label prompts of the event type stage.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sources = {}
+
+    def record(self, keys, sources):
+        with self._lock:
+            for key, event_sources in zip(keys, sources):
+                self.sources[tuple(key)] = list(event_sources)
+
+    def get(self, key):
+        with self._lock:
+            return self.sources.get(tuple(key))
+
+    def state(self):
+        with self._lock:
+            return [[*key, sources] for key, sources in self.sources.items()]
+
+    def merge(self, state):
+        with self._lock:
+            for source, index, sources in state:
+                self.sources[(source, index)] = sources
+
+
+_ANSWER_SOURCES = {}
+
+
+def get_answer_sources(stage):
+    """
+    Get the answer sources of a stage. They are created on first use and shared afterwards.
+    """
+    with _LLM_USAGE_LOCK:
+        if stage not in _ANSWER_SOURCES:
+            _ANSWER_SOURCES[stage] = AnswerSources()
+        return _ANSWER_SOURCES[stage]
+
+
+def get_llm_metrics_state():
+    """
+    Returns the counters of the usage, truncation and hedging stats and the answer sources of all the stages, e.g. those
+    of a Spark partition to merge on the driver, see merge_llm_metrics_state.
+    """
+    with _LLM_USAGE_LOCK:
+        stats = {"usage": dict(_LLM_USAGE), "truncation": dict(_TRUNCATION_STATS), "hedging": dict(_HEDGE_STATS), "answer_sources": dict(_ANSWER_SOURCES)}
+    return {kind: {stage: stage_stats.state() for stage, stage_stats in kind_stats.items()} for kind, kind_stats in stats.items()}
+
+
+def merge_llm_metrics_state(state):
+    """
+    Add the counters of `state`, see get_llm_metrics_state, to the stats of the stages.
+    """
+    for kind, get_stats in [("usage", get_llm_usage), ("truncation", get_truncation_stats), ("hedging", get_hedge_stats), ("answer_sources", get_answer_sources)]:
+        for stage, stage_state in state.get(kind, {}).items():
+            get_stats(stage).merge(stage_state)
+
+
+def clear_llm_metrics():
+    """
+    Reset the usage, truncation and hedging stats and the answer sources of all the stages.
+    """
+    with _LLM_USAGE_LOCK:
+        _LLM_USAGE.clear()
+        _TRUNCATION_STATS.clear()
+        _HEDGE_STATS.clear()
+        _ANSWER_SOURCES.clear()
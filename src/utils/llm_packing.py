@@ -0,0 +1,118 @@
+import logging
+import os
+import re
+
+from .llm_dispatch import dispatch_llm_calls
+from .utils import count_prompt_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def extract_packed_answers(tag, answer):
+    """
+    Returns the answers of a packed LLM answer as a dict event id (str) -> answer, from its <tag id="...">answer</tag> tags.
+    """
+    matches = re.findall(rf"<{tag}\s+id\s*=\s*[\"']?(\w+)[\"']?\s*>(.*?)</{tag}>", answer, re.DOTALL)
+    return {event_id: value.strip() for event_id, value in matches}
+
+
+def pack_events(num_events, build_packed_prompts, pack_size=10, pack_max_tokens=0):
+    """
+    Groups consecutive events into packs of at most `pack_size` events (0 means no limit) whose packed prompts
+    are at most `pack_max_tokens` prompt tokens (0 means no limit). An event larger than the budget gets its own pack.
+
+    Returns:
+        list: Lists of event indices.
+    """
+    packs = []
+    pack = []
+    for idx in range(num_events):
+        candidate = pack + [idx]
+        too_large = (pack_size and len(candidate) > pack_size) or (
+            pack_max_tokens and max(count_prompt_tokens(prompt) for prompt in build_packed_prompts(candidate)) > pack_max_tokens
+        )
+        if pack and too_large:
+            packs.append(pack)
+            candidate = [idx]
+        pack = candidate
+    if pack:
+        packs.append(pack)
+    return packs
+
+
+def dispatch_packed_llm_calls(llm_caller, prompts, build_packed_prompts, answer_tags, sampling_params, pack_size=10, pack_max_tokens=0, on_answer=None, answer_sources=None, **dispatch_kwargs):
+    """
+    Classify several events per LLM request.
+
+    Each event has one single-event prompt per slot (e.g. one per event type), and each pack of events has one
+    packed prompt per slot. The answers of an event are read from the <tag id="..."> tags of the packed answers;
+    the events whose id is missing from a packed answer are asked again with their single-event prompt.
+
+    Args:
+        llm_caller (LLMCaller): LLM used to answer the prompts.
+        prompts (list): Single-event chat prompts, event-major: prompt of slot k of event e at index e * len(answer_tags) + k.
+        build_packed_prompts (callable): Takes a list of event indices and returns the packed chat prompts of the pack, one per slot.
+            The events of the pack are numbered from 1 in the order of the list.
+        answer_tags (list): For each slot, the list of answer tags expected per event.
+        sampling_params (dict): Sampling parameters passed to the LLM.
+        pack_size (int, default=10): Maximum number of events per request, 0 means no limit.
+        pack_max_tokens (int, default=0): Maximum number of prompt tokens per request, 0 means no limit.
+        on_answer (callable, default=None): Called with the index of a prompt in `prompts` and its answer, once the answer
+            is read from its packed answer or re-asked, see dispatch_llm_calls.
+        answer_sources (list, default=None): Filled with the source of each answer, aligned with `prompts`: the source of
+            its packed answer, or of its re-ask, see dispatch_llm_calls.
+        dispatch_kwargs: Keyword arguments of `dispatch_llm_calls` (execution_mode, max_concurrency, ...).
+
+    Returns:
+        list: Answers aligned with `prompts`, in the format of single-event answers (<response><tag>answer</tag></response>).
+    """
+    if not pack_size and not pack_max_tokens:
+        raise ValueError("pack_max_tokens must be provided when pack_size is 0")
+    slots = len(answer_tags)
+    num_events = len(prompts) // slots
+    packs = pack_events(num_events, build_packed_prompts, pack_size, pack_max_tokens)
+    packed_prompts = [prompt for pack in packs for prompt in build_packed_prompts(pack)]
+    packed_sources = []
+    packed_answers = dispatch_llm_calls(llm_caller, packed_prompts, sampling_params, answer_sources=packed_sources, **dispatch_kwargs)
+
+    answers = [None] * len(prompts)
+    sources = [None] * len(prompts)
+    for pack_idx, pack in enumerate(packs):
+        for slot, tags in enumerate(answer_tags):
+            packed_answer = packed_answers[pack_idx * slots + slot]
+            tag_answers = {tag: extract_packed_answers(tag, packed_answer) for tag in tags}
+            for event_id, event_idx in enumerate(pack, 1):
+                values = [tag_answers[tag].get(str(event_id)) for tag in tags]
+                if all(values):
+                    answers[event_idx * slots + slot] = (
+                        "<response>\n" + "".join(f"<{tag}>{value}</{tag}>\n" for tag, value in zip(tags, values)) + "</response>"
+                    )
+                    sources[event_idx * slots + slot] = packed_sources[pack_idx * slots + slot]
+
+    if on_answer is not None:
+        for idx, answer in enumerate(answers):
+            if answer is not None:
+                on_answer(idx, answer)
+
+    missing = [idx for idx in range(len(prompts)) if answers[idx] is None]
+    logger.info(f"Packed {num_events} events into {len(packs)} requests per slot, {len(missing)} answers missing from the packed answers")
+    if missing:
+        if dispatch_kwargs.get("batch_state_path"):
+            # The re-asks are a separate batch job, they must not overwrite the state of the packed job
+            root, ext = os.path.splitext(dispatch_kwargs["batch_state_path"])
+            dispatch_kwargs = dict(dispatch_kwargs, batch_state_path=f"{root}_reask{ext}")
+        reask_sources = []
+        reask_answers = dispatch_llm_calls(
+            llm_caller,
+            [prompts[idx] for idx in missing],
+            sampling_params,
+            on_answer=(lambda position, answer: on_answer(missing[position], answer)) if on_answer else None,
+            answer_sources=reask_sources,
+            **dispatch_kwargs,
+        )
+        for idx, answer, source in zip(missing, reask_answers, reask_sources):
+            answers[idx] = answer
+            sources[idx] = source
+    if answer_sources is not None:
+        answer_sources[:] = sources
+    return answers
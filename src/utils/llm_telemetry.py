@@ -0,0 +1,262 @@
+import json
+import os
+import threading
+import time
+
+from .llm_backbone import CALL_LABEL
+from .llm_metrics import counters_state, merge_counters, percentile, usage_to_dict
+
+# Estimated prices in USD per million tokens, by model. Override them with the `prices` of the telemetry config
+DEFAULT_LLM_PRICES = {
+    "gpt-4o": {"input": 2.5, "cached_input": 1.25, "output": 10.0},
+    "mistral-large-latest": {"input": 2.0, "output": 6.0},
+}
+# The batch APIs of OpenAI and Mistral bill half of the on-demand price
+BATCH_PRICE_FACTOR = 0.5
+LATENCY_QUANTILES = [50, 95, 99]
+
+
+class CallStats:
+    """
+    LLM calls of a stage label (e.g. "event_type:tribal") and a provider: latency of each call, retries, errors,
+    answers that could not be parsed and token usage of the responses.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.parse_failures = 0
+        self.latencies = []
+        self.responses = 0
+        self.batch_responses = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        # Tokens of the batch responses, billed at BATCH_PRICE_FACTOR
+        self.batch_prompt_tokens = 0
+        self.batch_completion_tokens = 0
+
+    def cost(self, prices):
+        """
+        Estimated cost in USD of the token usage, with `prices` in USD per million tokens (input, cached_input, output).
+        """
+        if not prices:
+            return None
+        input_price = prices.get("input", 0)
+        cached_input_price = prices.get("cached_input", input_price)
+        output_price = prices.get("output", 0)
+        on_demand_prompt_tokens = self.prompt_tokens - self.batch_prompt_tokens
+        on_demand_completion_tokens = self.completion_tokens - self.batch_completion_tokens
+        cost = (
+            (on_demand_prompt_tokens - self.cached_tokens) * input_price
+            + self.cached_tokens * cached_input_price
+            + on_demand_completion_tokens * output_price
+            + BATCH_PRICE_FACTOR * (self.batch_prompt_tokens * input_price + self.batch_completion_tokens * output_price)
+        )
+        return cost / 1e6
+
+    def summary(self, prices=None):
+        summary = {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "parse_failures": self.parse_failures,
+            "responses": self.responses,
+            "batch_responses": self.batch_responses,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "latency_seconds_sum": round(sum(self.latencies), 3),
+        }
+        for q in LATENCY_QUANTILES:
+            latency = percentile(self.latencies, q)
+            summary[f"latency_seconds_p{q}"] = round(latency, 3) if latency is not None else None
+        cost = self.cost(prices)
+        summary["estimated_cost_usd"] = round(cost, 4) if cost is not None else None
+        return summary
+
+
+class LLMTelemetry:
+    """
+    Telemetry of the LLM calls of a run, keyed by stage label, provider (the llm_name of the backend) and model.
+    The callers of a stage record to it through a StageTelemetry, see LLMTelemetry.stage.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.prices = dict(DEFAULT_LLM_PRICES)
+        self.started_at = time.time()
+
+    def stage(self, stage, provider, model):
+        return StageTelemetry(self, stage, provider, model)
+
+    def _call_stats(self, label, provider, model):
+        key = (label, provider, model)
+        if key not in self._stats:
+            self._stats[key] = CallStats()
+        return self._stats[key]
+
+    def record_call(self, label, provider, model, latency, retries=0, error=False):
+        with self._lock:
+            stats = self._call_stats(label, provider, model)
+            stats.calls += 1
+            stats.retries += retries
+            stats.errors += error
+            stats.latencies.append(latency)
+
+    def record_usage(self, label, provider, model, usage, batch=False):
+        usage = usage_to_dict(usage)
+        prompt_tokens = usage["prompt_tokens"]
+        completion_tokens = usage["completion_tokens"]
+        with self._lock:
+            stats = self._call_stats(label, provider, model)
+            stats.responses += 1
+            stats.prompt_tokens += prompt_tokens
+            stats.completion_tokens += completion_tokens
+            stats.cached_tokens += usage["prompt_tokens_details"]["cached_tokens"]
+            if batch:
+                stats.batch_responses += 1
+                stats.batch_prompt_tokens += prompt_tokens
+                stats.batch_completion_tokens += completion_tokens
+
+    def record_parse_failures(self, label, provider, model, count=1):
+        with self._lock:
+            self._call_stats(label, provider, model).parse_failures += count
+
+    def summary(self):
+        """
+        JSON-serializable summary of the run: one entry per stage label, provider and model, and the totals.
+        """
+        with self._lock:
+            stages = [
+                {"stage": label, "provider": provider, "model": model, **stats.summary(self.prices.get(model))}
+                for (label, provider, model), stats in sorted(self._stats.items())
+            ]
+        costs = [stage["estimated_cost_usd"] for stage in stages if stage["estimated_cost_usd"] is not None]
+        return {
+            "started_at": self.started_at,
+            "finished_at": time.time(),
+            "stages": stages,
+            "total": {
+                "calls": sum(stage["calls"] for stage in stages),
+                "errors": sum(stage["errors"] for stage in stages),
+                "prompt_tokens": sum(stage["prompt_tokens"] for stage in stages),
+                "completion_tokens": sum(stage["completion_tokens"] for stage in stages),
+                "estimated_cost_usd": round(sum(costs), 4),
+            },
+        }
+
+    def write_summary(self, path):
+        summary = self.summary()
+        _atomic_write(path, json.dumps(summary, indent=2))
+        return summary
+
+    def prometheus_text(self, prefix="ceha_llm"):
+        """
+        The telemetry in the Prometheus text exposition format, e.g. for the textfile collector of the node exporter.
+        """
+        metrics = [
+            ("calls_total", "counter", "LLM calls", lambda s: [({}, s["calls"])]),
+            ("errors_total", "counter", "LLM calls failed after their retries", lambda s: [({}, s["errors"])]),
+            ("retries_total", "counter", "Retried LLM requests", lambda s: [({}, s["retries"])]),
+            ("parse_failures_total", "counter", "LLM answers not in the expected format", lambda s: [({}, s["parse_failures"])]),
+            (
+                "tokens_total", "counter", "Tokens of the LLM responses",
+                lambda s: [({"type": kind}, s[f"{kind}_tokens"]) for kind in ["prompt", "completion", "cached"]],
+            ),
+            (
+                "latency_seconds", "summary", "Latency of the LLM calls, retries included",
+                lambda s: [({"quantile": str(q / 100)}, s[f"latency_seconds_p{q}"]) for q in LATENCY_QUANTILES if s[f"latency_seconds_p{q}"] is not None],
+            ),
+            ("estimated_cost_usd", "gauge", "Estimated cost of the LLM calls of the run", lambda s: [({}, s["estimated_cost_usd"])] if s["estimated_cost_usd"] is not None else []),
+        ]
+        stages = self.summary()["stages"]
+        lines = []
+        for name, metric_type, help_text, samples in metrics:
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+            for stage in stages:
+                base_labels = {"stage": stage["stage"], "provider": stage["provider"], "model": stage["model"]}
+                for extra_labels, value in samples(stage):
+                    lines.append(f"{prefix}_{name}{{{_prometheus_labels({**base_labels, **extra_labels})}}} {value}")
+                if metric_type == "summary":
+                    lines.append(f"{prefix}_{name}_sum{{{_prometheus_labels(base_labels)}}} {stage['latency_seconds_sum']}")
+                    lines.append(f"{prefix}_{name}_count{{{_prometheus_labels(base_labels)}}} {stage['calls']}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, prefix="ceha_llm"):
+        _atomic_write(path, self.prometheus_text(prefix))
+
+    def state(self):
+        """
+        The counters of the calls, e.g. those of a Spark partition to merge on the driver, see merge.
+        """
+        with self._lock:
+            return [[label, provider, model, counters_state(stats)] for (label, provider, model), stats in self._stats.items()]
+
+    def merge(self, state):
+        with self._lock:
+            for label, provider, model, stats_state in state:
+                merge_counters(self._call_stats(label, provider, model), stats_state)
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+            self.started_at = time.time()
+
+
+class StageTelemetry:
+    """
+    Telemetry of the calls of a stage to a provider. The label of the calls is the stage, followed by the call label
+    set by the dispatch if any, e.g. "event_type:tribal", see CALL_LABEL.
+    """
+
+    def __init__(self, telemetry, stage, provider, model):
+        self.telemetry = telemetry
+        self.stage = stage
+        self.provider = provider
+        self.model = model
+
+    def with_provider(self, provider, model):
+        return StageTelemetry(self.telemetry, self.stage, provider, model)
+
+    def label(self, call_label=None):
+        call_label = call_label if call_label is not None else CALL_LABEL.get()
+        return f"{self.stage}:{call_label}" if call_label else self.stage
+
+    def record_call(self, latency, retries=0, error=False):
+        self.telemetry.record_call(self.label(), self.provider, self.model, latency, retries, error)
+
+    def record_usage(self, usage, batch=False):
+        self.telemetry.record_usage(self.label(), self.provider, self.model, usage, batch)
+
+    def record_parse_failures(self, count=1, call_label=None):
+        if count:
+            self.telemetry.record_parse_failures(self.label(call_label), self.provider, self.model, count)
+
+
+def _prometheus_labels(labels):
+    escaped = {key: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for key, value in labels.items()}
+    return ",".join(f'{key}="{value}"' for key, value in escaped.items())
+
+
+def _atomic_write(path, text):
+    # Scrapers and readers never see a partially written file
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+_LLM_TELEMETRY = LLMTelemetry()
+
+
+def get_llm_telemetry():
+    """
+    Get the telemetry shared by all the stages of the run.
+    """
+    return _LLM_TELEMETRY
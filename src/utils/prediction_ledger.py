@@ -0,0 +1,306 @@
+"""
+Ledger of the predictions of past runs, so that re-pulled events (backfills, reruns of a window) are not classified
+again.
+
+Usage (from the repository root):
+    python -m src.utils.prediction_ledger compact --path <ledger.jsonl> [--max_age_days 365]
+    python -m src.utils.prediction_ledger report --path <ledger.jsonl>
+"""
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from .checkpoint import event_key
+from .llm_backends import get_llm_backend
+from .llm_metrics import get_answer_sources
+
+logger = logging.getLogger(__name__)
+
+# Fields of an event its predictions depend on. An event revised after publication (e.g. ACLED notes) is classified again
+LEDGER_CONTENT_COLUMNS = ["Event Description", "Actor 1", "Actor 2", "Country"]
+
+# Settings of the stages which change how the LLM is called, not the predictions
+LEDGER_OPERATIONAL_KEYS = [
+    "execution_mode", "max_concurrency", "batch_poll_interval", "request_timeout", "mistralai_rps", "hedging",
+]
+
+
+def _json_value(value):
+    # NaN of the missing values of a DataFrame are not valid JSON
+    return None if isinstance(value, float) and math.isnan(value) else value
+
+
+def event_content_hash(event):
+    """
+    Hash of the content of an event (LEDGER_CONTENT_COLUMNS).
+    """
+    payload = json.dumps([_json_value(event.get(column)) for column in LEDGER_CONTENT_COLUMNS], ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def config_fingerprint(stage_configs, llm_backends=None, rules=None):
+    """
+    Hash of the settings the predictions depend on: the configs of the stages, without the operational settings
+    (LEDGER_OPERATIONAL_KEYS), the model of their backend and the rules deciding labels. The predictions of a run are
+    only reused by the runs with the same fingerprint.
+
+    :param list stage_configs: Configs of the classification stages, e.g. event_relevance_classification
+    :param dict llm_backends: Backends by name, see get_llm_backend
+    :param list rules: Rules of the RuleEngine, if any
+    """
+    settings = []
+    for stage_config in stage_configs:
+        stage_settings = {key: value for key, value in stage_config.items() if key not in LEDGER_OPERATIONAL_KEYS}
+        stage_settings["model_name"] = get_llm_backend(stage_config.get("llm_name"), llm_backends)["model_name"]
+        settings.append(stage_settings)
+    if rules:
+        settings.append({"rules": rules})
+    payload = json.dumps(settings, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class PredictionLedger:
+    """
+    Append-only ledger of the predictions of the classified events, across runs.
+
+    The ledger is a JSON lines file with one line per classified event: its source and Index, the hash of its content
+    (see event_content_hash), the fingerprint of the settings of the run (see config_fingerprint), its predictions, the
+    sources of their answers (see event_answer_sources), the run and the time. The last line of an event supersedes the previous ones, which are dropped by `compact`. The reports
+    of the runs (events reused, new and changed) are appended to a separate file next to the ledger.
+    """
+
+    def __init__(self, path):
+        """
+        :param str path: Path of the ledger file, e.g. ledger/predictions.jsonl. Created if missing
+        """
+        self.path = path
+        self.runs_path = f"{os.path.splitext(path)[0]}_runs.jsonl"
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._lines = 0
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning(f"Skipping an incomplete line of the ledger {path}")
+                        continue
+                    self._entries[(entry["source"], entry["index"])] = entry
+                    self._lines += 1
+            logger.info(f"Loaded the predictions of {len(self._entries)} events from the ledger {path}")
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def lookup(self, event, content_hash, fingerprint):
+        """
+        Returns the entry of `event` if it was classified with the same content and settings, else None, and the status
+        of the event: "reused", "new" (not in the ledger), "changed" (another content) or "stale" (other settings).
+        """
+        with self._lock:
+            entry = self._entries.get((event["ACLED/GDELT"], str(event["Index"])))
+        if entry is None:
+            return None, "new"
+        if entry["content_hash"] != content_hash:
+            return None, "changed"
+        if entry["fingerprint"] != fingerprint:
+            return None, "stale"
+        return entry, "reused"
+
+    def add(self, events, predictions, fingerprint, run_name=None, sources=None):
+        """
+        Append the predictions of the classified events, one dict per event (see event_predictions), with the sources
+        of their answers, one dict per event (see event_answer_sources).
+        """
+        now = time.time()
+        lines = []
+        sources = sources or [None] * len(events)
+        with self._lock:
+            for event, event_predictions, event_sources in zip(events, predictions, sources):
+                entry = {
+                    "source": event["ACLED/GDELT"],
+                    "index": str(event["Index"]),
+                    "content_hash": event_content_hash(event),
+                    "fingerprint": fingerprint,
+                    "predictions": event_predictions,
+                    "sources": event_sources,
+                    "run": run_name,
+                    "time": now,
+                }
+                self._entries[(entry["source"], entry["index"])] = entry
+                lines.append(json.dumps(entry, ensure_ascii=False) + "\n")
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self._lines += len(lines)
+
+    def record_run(self, report):
+        """
+        Append the report of a run, see ledger_run_report.
+        """
+        with self._lock:
+            if os.path.dirname(self.runs_path):
+                os.makedirs(os.path.dirname(self.runs_path), exist_ok=True)
+            with open(self.runs_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(report, ensure_ascii=False) + "\n")
+
+    def runs(self):
+        if not os.path.exists(self.runs_path):
+            return []
+        with open(self.runs_path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def compact(self, max_age_days=0):
+        """
+        Rewrite the ledger with the last line of each event only, dropping the events classified more than
+        `max_age_days` ago (0 keeps them all). The file is replaced at once.
+
+        :return dict: Number of lines before and after the compaction
+        """
+        with self._lock:
+            lines_before = self._lines
+            if max_age_days:
+                oldest = time.time() - max_age_days * 86400
+                self._entries = {key: entry for key, entry in self._entries.items() if entry.get("time", 0) >= oldest}
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for entry in self._entries.values():
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self._lines = len(self._entries)
+        return {"lines_before": lines_before, "lines_after": self._lines}
+
+    def stats(self):
+        with self._lock:
+            return {"path": self.path, "events": len(self._entries), "lines": self._lines}
+
+
+# Ledgers are shared by all the runs of the process using the same file
+_PREDICTION_LEDGERS = {}
+_PREDICTION_LEDGERS_LOCK = threading.Lock()
+
+
+def get_prediction_ledger(path):
+    """
+    Get the ledger stored at `path`. It is loaded on first use and shared afterwards.
+    """
+    with _PREDICTION_LEDGERS_LOCK:
+        if path not in _PREDICTION_LEDGERS:
+            _PREDICTION_LEDGERS[path] = PredictionLedger(path)
+        return _PREDICTION_LEDGERS[path]
+
+
+def event_predictions(index, relevance_predictions, relevance_scores, relevant_index, type_predictions, type_scores):
+    """
+    Predictions of each event as stored in the ledger, from the outputs of the two stages: the relevance predictions
+    and scores of the events of `index`, and the type predictions and scores of the relevant events (`relevant_index`).
+
+    :return list: One dict per event of `index`
+    """
+    types = dict(zip(relevant_index, zip(type_predictions, type_scores)))
+    predictions = []
+    for idx, relevance_prediction, relevance_score in zip(index, relevance_predictions, relevance_scores):
+        type_prediction, type_score = types.get(idx, (None, None))
+        predictions.append({
+            "event_relevance_prediction": relevance_prediction,
+            "event_relevance_score": relevance_score,
+            # The event types are sets, stored as sorted lists
+            "event_type_prediction": sorted(type_prediction) if type_prediction is not None else None,
+            "event_type_scores": type_score,
+        })
+    return predictions
+
+
+def event_answer_sources(events):
+    """
+    Sources of the answers of the classified events, as stored in the ledger: per stage, the source of each prompt of
+    the event (see ANSWER_SOURCES of llm_dispatch), None if the stage did not classify the event.
+
+    :return list: One dict per event, e.g. {"event_relevance": ["llm"], "event_type": ["rule", "llm", "cache", "llm"]}
+    """
+    return [
+        {stage: get_answer_sources(stage).get(event_key(event)) for stage in ["event_relevance", "event_type"]}
+        for event in events
+    ]
+
+
+def merge_predictions(index, predictions):
+    """
+    The outputs of the two stages (see event_predictions) from the predictions of each event of `index`.
+
+    :return tuple: Relevance predictions and scores aligned with `index`, index of the relevant events, type
+        predictions and scores aligned with the relevant events
+    """
+    relevant = [(idx, prediction) for idx, prediction in zip(index, predictions) if prediction["event_type_prediction"] is not None]
+    return (
+        [prediction["event_relevance_prediction"] for prediction in predictions],
+        [prediction["event_relevance_score"] for prediction in predictions],
+        [idx for idx, _ in relevant],
+        [set(prediction["event_type_prediction"]) for _, prediction in relevant],
+        [prediction["event_type_scores"] for _, prediction in relevant],
+    )
+
+
+def ledger_run_report(run_name, num_events, reused_entries, new_events, changed_events, stale_events):
+    """
+    Report of a run using the ledger: events reused, new, changed and stale (classified with other settings), the
+    reused relevant events, whose event type predictions are reused too, and the LLM calls of each stage the reused
+    events save: their answers from the LLM, not those of the rules, the cascade classifier, the response cache or a
+    checkpoint. Packed answers (pack_size > 1) count one call each, and the entries without sources (older ledgers)
+    none.
+    """
+    def llm_calls(stage):
+        return sum(((entry.get("sources") or {}).get(stage) or []).count("llm") for entry in reused_entries)
+
+    return {
+        "run": run_name,
+        "time": time.time(),
+        "events": num_events,
+        "reused_events": len(reused_entries),
+        "new_events": new_events,
+        "changed_events": changed_events,
+        "stale_events": stale_events,
+        "reused_relevant_events": sum(entry["predictions"]["event_type_prediction"] is not None for entry in reused_entries),
+        "skipped_relevance_llm_calls": llm_calls("event_relevance"),
+        "skipped_type_llm_calls": llm_calls("event_type"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prediction ledger maintenance")
+    parser.add_argument("command", choices=["compact", "report"], help="compact the ledger, or report the events reused by each run")
+    parser.add_argument("--path", type=str, required=True, help="path of the ledger")
+    parser.add_argument("--max_age_days", type=float, default=0, help="drop the events classified more than max_age_days ago when compacting, 0 keeps them all")
+    args = parser.parse_args()
+
+    ledger = PredictionLedger(args.path)
+    if args.command == "compact":
+        result = ledger.compact(args.max_age_days)
+        print(f"Compacted {args.path}: {result['lines_before']} lines, {result['lines_after']} after compaction")
+    else:
+        print(
+            f"{'run':<40} {'events':>8} {'reused':>8} {'new':>8} {'changed':>8} {'stale':>8} {'reused relevant':>16} "
+            f"{'skipped relevance calls':>24} {'skipped type calls':>19}"
+        )
+        for run in ledger.runs():
+            print(
+                f"{str(run['run']):<40} {run['events']:>8} {run['reused_events']:>8} {run['new_events']:>8} "
+                f"{run['changed_events']:>8} {str(run.get('stale_events', '-')):>8} {str(run.get('reused_relevant_events', '-')):>16} "
+                f"{str(run.get('skipped_relevance_llm_calls', '-')):>24} {str(run.get('skipped_type_llm_calls', '-')):>19}"
+            )
+
+
+if __name__ == "__main__":
+    main()
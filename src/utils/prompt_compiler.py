@@ -0,0 +1,60 @@
+import threading
+
+
+def few_shot_key(few_shot_examples):
+    """
+    Hashable key of sampled few-shot examples: a DataFrame of examples, or a dict of them (possibly nested, e.g. per
+    event type and polarity). Two samples with the same events in the same order have the same key.
+    """
+    if few_shot_examples is None:
+        return None
+    if isinstance(few_shot_examples, dict):
+        return tuple((key, few_shot_key(value)) for key, value in few_shot_examples.items())
+    if len(few_shot_examples) == 0:
+        return ()
+    return tuple(few_shot_examples["Event Description"])
+
+
+class PromptCompiler:
+    """
+    Renders the static blocks of the prompts once per run: the dedented system prompt, guidelines and few-shot turns
+    shared by the prompts of all the events. Blocks are keyed by stage, prompt options and few-shot examples, so the
+    stages (and repeated calls of a stage) reuse them instead of formatting the few-shot examples again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blocks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def compile(self, key, render):
+        """
+        Returns the block of `key`, rendered by `render()` on first use. Blocks are shared: never modify them,
+        build the prompt of an event as a new list, e.g. prefix + [user_message].
+        """
+        with self._lock:
+            if key in self._blocks:
+                self.hits += 1
+                return self._blocks[key]
+            self.misses += 1
+        block = render()
+        with self._lock:
+            return self._blocks.setdefault(key, block)
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+
+    def stats(self):
+        return {"blocks": len(self._blocks), "hits": self.hits, "misses": self.misses}
+
+
+_PROMPT_COMPILER = PromptCompiler()
+
+
+def get_prompt_compiler():
+    """
+    Get the prompt compiler shared by all the stages of the run.
+    """
+    return _PROMPT_COMPILER
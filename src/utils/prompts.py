@@ -1,3 +1,4 @@
+import re
 from textwrap import dedent
 
 system_prompt = """\
@@ -8,6 +9,10 @@ system_prompt_type = """\
 You are a state-of-the-art event classification system. Given an news article, your job is to identify if the main event mentioned in the article can be classified as a particular event type based on the guidance.
 """
 
+system_prompt_type_fused = """\
+You are a state-of-the-art event classification system. Given an news article, your job is to identify which of the given event types the main event mentioned in the article can be classified as based on the guidance.
+"""
+
 
 def format_prompt(document, country):
     return f"""
@@ -104,6 +109,18 @@ def databricks_llm_prompt(system_prompt, user_prompt):
 
 
 def databricks_llm_prompt_chat(system_prompt, user_prompt, pos_examples, neg_examples):
+    output = databricks_llm_prompt_prefix(system_prompt, pos_examples, neg_examples)
+    output.append(
+        {"role": "user", "content": user_prompt},
+    )
+    return output
+
+
+def databricks_llm_prompt_prefix(system_prompt, pos_examples=[], neg_examples=[]):
+    """
+    The messages shared by all the prompts of a stage: the system prompt and the few-shot turns.
+    Build it once and append the user message of each event to a copy of it.
+    """
     output = []
     output.append(
         {
@@ -136,9 +153,6 @@ def databricks_llm_prompt_chat(system_prompt, user_prompt, pos_examples, neg_exa
                 "content": dedent(neg_example[1]).strip(),
             }
         )
-    output.append(
-        {"role": "user", "content": user_prompt},
-    )
     return output
 
 
@@ -462,3 +476,365 @@ Is the main event mentioned in the news article can be classified as a tribal/co
 <event_type>Answer</event_type>
 </response>
 """
+
+
+# Guidance and question of the fused event type prompts, shared by the zero-shot and few-shot prompts
+fused_type_guidance = """\
+Guidance:
+1. Tribal/communal/ethnic conflict (tag <tribal>):
+A tribal/communal/ethnic conflict is a dispute or violence involving ethnic, tribal, OR communal individuals/groups.
+An event should be categorized as tribal/communal/ethnic conflict when:
+- It falls into ANY of the following categories: tribal (including clans) OR communal OR ethnic.
+NOTE:
+- Disputes or violence can be one-sided from ethnic, tribal (including clans), OR communal individuals/groups.
+- If the actor names are confirmed rather than presumed, please reference them to categorize a tribal/communal/ethnic conflict.
+- DO NOT make conclusions based on presumed information.
+
+2. Religious conflict (tag <religious>):
+An event should be categorized as religious conflict as long as it meets any of the following requirements:
+- Religion-related entity invlove in the conflict, which include, but are not limited to religious leaders, reglious military groups and religious staff; OR
+- The conflict targets individuals who engage in religious practice or expressing their religious belief (e.g. pastor), no matter if the conflict itself is religiously motivated or not; OR
+- It involves the enforcement of specific religious norms to force or prevent actions; OR
+- The conflict happend at a religious institution.
+NOTE:
+- An event should be categoried as religious conflict when it meets any one of the above requirements.
+- ALWAYS identity it as a religious conflict when military groups such as Al Shabaab and ISIS are involved.
+- An event may also be categoried as a religous conflict  even though the conflict was not religiously motivated or targeted.
+- DO NOT identify it as a religious conflict if it is explicitly mentioned in the article that the religious group / institution / person is a random target rather than a specific target. (Ex. mortar fire hits church in addition to many other nearby targets).
+
+3. Socio-political violence against women (tag <female>):
+A Socio-political violence against women is civilian targeting event in which women and/or girls are the ‘target’ of the violence.
+An event should be categorized as socio-political violence against women when:
+- The victim(s) of the event are composed entirely of women/girls, or when the majority of victims are women/girls.
+- The primary target was a woman/girl (e.g. a female politician attacked alongside two men working as bodyguards).
+NOTE:
+- DO NOT identify it as a socio-political violence against women event if the targeting of women or girls has the potential to be random. (Ex. woman killed while in a car that ran over an IED).
+
+4. Climate-related security risk (tag <climate>):
+A climate-related security risk is a conflict event (like migration-induced conflict or pastoral conflict) influenced by environmental and climate-related factors.
+These events should have two components: 1) a climate related phenomenon and 2) a conflict event, both of which are explicitly stated.
+An event should be categorized as climate-related security risk when:
+- A conflict event is influenced by environmental or climate related factors, which include, but are not limited to: drought, desertification, temperature rise, flooding.
+- Conflict event centers around resources that have become limited due to environmental and climate-related factors, such as water access, grazing land, farmland, etc.
+NOTE:
+- DO NOT identify it as a climate-related security risk event if that is not directly influenced by climate-related factors, such as climate change protests."""
+
+fused_type_question = """\
+For each of the four event types, can the main event mentioned in the news article be classified as that event type based on its guidance? The event types are judged independently, so any number of them can apply. Answer "Yes" or "No" for each event type in the following format (it must be valid XML):"""
+
+
+def format_prompt_zero_shot_fused(document, actor1, actor2):
+    return f"""
+{fused_type_guidance}
+
+News Article:
+{document}
+
+Event Actors: 
+{actor1};{actor2}
+
+{fused_type_question}
+<response>
+<tribal>Answer</tribal>
+<religious>Answer</religious>
+<female>Answer</female>
+<climate>Answer</climate>
+<reason>reason of your selections</reason>
+</response>
+"""
+
+
+def format_prompt_few_shot_fused(document, actor1, actor2):
+    return f"""
+{fused_type_guidance}
+
+News Article:
+{document}
+
+Event Actors: 
+{actor1};{actor2}
+
+{fused_type_question}
+<response>
+<tribal>Answer</tribal>
+<religious>Answer</religious>
+<female>Answer</female>
+<climate>Answer</climate>
+</response>
+"""
+
+
+def format_answer_fused(tribal, religious, female, climate):
+    return f"""
+<response>
+<tribal>{tribal}</tribal>
+<religious>{religious}</religious>
+<female>{female}</female>
+<climate>{climate}</climate>
+</response>
+"""
+
+
+def generate_few_shot_prompt_list_fused(document, actor1, actor2, examples):
+    """
+    Few-shot examples of the fused event type prompt. Each round pairs a positive example of one event type
+    (rotating over tribal, religious, female and climate) with an example labeled as "Other".
+    The answers of an example carry its annotations for all four event types.
+    """
+    label_columns = {
+        "tribal": "tribal/communal/ethnic conflict",
+        "religious": "religious conflict",
+        "female": "socio-political violence against women",
+        "climate": "climate-related security risks",
+    }
+
+    def format_example(i):
+        answers = ["Yes" if i[column].strip() == "X" else "No" for column in label_columns.values()]
+        return [
+            format_prompt_few_shot_fused(i["Event Description"], i["Actor 1"], i["Actor 2"]),
+            format_answer_fused(*answers),
+        ]
+
+    pos_examples = []
+    neg_examples = []
+    labels = list(label_columns)
+    other_examples = examples["other"]["pos"].to_dict("records")
+    for round_idx, other_example in enumerate(other_examples):
+        label = labels[round_idx % len(labels)]
+        label_examples = examples[label]["pos"].to_dict("records")
+        pos_examples.append(format_example(label_examples[(round_idx // len(labels)) % len(label_examples)]))
+        neg_examples.append(format_example(other_example))
+
+    input_prompt = format_prompt_few_shot_fused(document, actor1, actor2)
+    return input_prompt, pos_examples, neg_examples
+
+
+def split_single_event_prompt(prompt):
+    """
+    Splits a single-event prompt built by one of the format_prompt* functions into its guidance (the text before
+    "News Article:"), its event (the article and the event metadata) and its question (the line introducing
+    the answer format).
+    """
+    guidance, _, rest = prompt.partition("News Article:\n")
+    if "\n<response>" in rest:
+        rest = rest.rpartition("\n<response>")[0]
+    event, _, question = rest.rstrip().rpartition("\n\n")
+    return guidance, event.strip(), question.strip()
+
+
+def get_answer_format(prompt):
+    """
+    Returns the XML answer format ending a single-event prompt, empty for prompts asking for a single word.
+    """
+    if "\n<response>" not in prompt:
+        return ""
+    return prompt[prompt.rindex("\n<response>"):].strip()
+
+
+def format_prompt_packed(prompts, answer_tags, prompt_layout="original"):
+    """
+    Packs several single-event prompts built by the same format_prompt* function into one prompt.
+    The guidance and the question are written once, the events are numbered from 1 and the answer
+    has one tag per event id and answer tag, e.g. <answer id="1">Answer</answer>.
+    The packed answer does not ask for reasons to keep the output short.
+    With the "prefix_cache" layout the articles come after the question and the answer format.
+    """
+    articles = []
+    for event_id, prompt in enumerate(prompts, 1):
+        guidance, event, question = split_single_event_prompt(prompt)
+        articles.append(f'<article id="{event_id}">\n{event}\n</article>')
+    articles = "\n\n".join(articles)
+    answer_format = "\n".join(
+        f'<{tag} id="{event_id}">Answer</{tag}>' for event_id in range(1, len(prompts) + 1) for tag in answer_tags
+    )
+    if prompt_layout == "prefix_cache":
+        return f"""{guidance}Each article below describes a different event. Answer the following question for each article independently, using the article id.
+{question}
+<response>
+{answer_format}
+</response>
+
+News Articles:
+{articles}
+"""
+    return f"""{guidance}News Articles:
+{articles}
+
+Each article above describes a different event. Answer the following question for each article independently, using the article id.
+{question}
+<response>
+{answer_format}
+</response>
+"""
+
+
+def format_answer_packed(answers, answer_tags):
+    """
+    Packs the single-event answers of `answers` in the answer format of format_prompt_packed.
+    """
+    lines = []
+    for event_id, answer in enumerate(answers, 1):
+        for tag in answer_tags:
+            value = re.search(f"<{tag}>(.*?)</{tag}>", answer, re.DOTALL)
+            lines.append(f'<{tag} id="{event_id}">{value.group(1).strip() if value else ""}</{tag}>')
+    answer_lines = "\n".join(lines)
+    return f"""
+<response>
+{answer_lines}
+</response>
+"""
+
+
+def generate_few_shot_packed(pos_examples, neg_examples, answer_tags, prompt_layout="original"):
+    """
+    Packs the few-shot examples into a single example, alternating positive and negative examples.
+    """
+    examples = [example for pair in zip(pos_examples, neg_examples) for example in pair]
+    return [
+        format_prompt_packed([example[0] for example in examples], answer_tags, prompt_layout),
+        format_answer_packed([example[1] for example in examples], answer_tags),
+    ]
+
+
+def databricks_llm_prompt_packed(system_prompt, user_prompt, packed_example=None):
+    output = [
+        {
+            "role": "system",
+            "content": system_prompt,
+        }
+    ]
+    if packed_example:
+        output.append({"role": "user", "content": dedent(packed_example[0]).strip()})
+        output.append({"role": "assistant", "content": dedent(packed_example[1]).strip()})
+    output.append({"role": "user", "content": user_prompt})
+    return output
+
+
+PROMPT_LAYOUTS = ["original", "prefix_cache"]
+
+
+def format_prompt_article_last(prompt):
+    """
+    Moves the event of a single-event prompt after the question and the answer format. All the prompts built by
+    the same format_prompt* function then share everything but their end, which providers serve from their
+    prompt prefix cache.
+    """
+    guidance, event, question = split_single_event_prompt(prompt)
+    answer_format = get_answer_format(prompt)
+    if answer_format:
+        question = f"{question}\n{answer_format}"
+    return f"""{guidance}{question}
+
+News Article:
+{event}
+"""
+
+
+def apply_prompt_layout(prompt, prompt_layout="original"):
+    """
+    Returns a single-event prompt in the given layout: "original" keeps it as built by its format_prompt* function,
+    "prefix_cache" puts the event last (see format_prompt_article_last).
+    """
+    if prompt_layout not in PROMPT_LAYOUTS:
+        raise ValueError(f"Invalid prompt_layout {prompt_layout}. Please select from {PROMPT_LAYOUTS}.")
+    if prompt_layout == "prefix_cache":
+        return format_prompt_article_last(prompt)
+    return prompt
+
+
+def apply_prompt_layout_examples(examples, prompt_layout="original", few_shot_format="full"):
+    """
+    Applies the layout and the few-shot format to the prompts of few-shot examples ([prompt, answer] pairs).
+    """
+    return [[format_user_prompt(example[0], prompt_layout, few_shot_format), example[1]] for example in examples]
+
+
+FEW_SHOT_FORMATS = ["full", "compact"]
+
+
+def format_system_prompt_compact(system_prompt, template_prompt):
+    """
+    System prompt of the "compact" few-shot format: carries the guidance, the question and the answer format of
+    `template_prompt`, a prompt built by the format_prompt* function of the stage, so that they are written once
+    instead of once per few-shot turn.
+    """
+    guidance, _, question = split_single_event_prompt(template_prompt)
+    answer_format = get_answer_format(template_prompt)
+    if answer_format:
+        question = f"{question}\n{answer_format}"
+    return f"""{system_prompt}
+
+{guidance.strip()}
+
+Each user message is a news article. {question}
+"""
+
+
+def format_prompt_compact(prompt):
+    """
+    User message of the "compact" few-shot format: the event of a single-event prompt, without its guidance and question.
+    """
+    _, event, _ = split_single_event_prompt(prompt)
+    return f"""News Article:
+{event}
+"""
+
+
+def format_user_prompt(prompt, prompt_layout="original", few_shot_format="full"):
+    """
+    Returns the user message of a single-event prompt: its event only in the "compact" few-shot format
+    (see format_system_prompt_compact), otherwise the whole prompt in the given layout.
+    """
+    if few_shot_format not in FEW_SHOT_FORMATS:
+        raise ValueError(f"Invalid few_shot_format {few_shot_format}. Please select from {FEW_SHOT_FORMATS}.")
+    if few_shot_format == "compact":
+        return format_prompt_compact(prompt)
+    return apply_prompt_layout(prompt, prompt_layout)
+
+
+ANSWER_MODES = ["reason", "answer_only", "score"]
+
+
+def format_prompt_answer_only(prompt):
+    """
+    Answer-only variant of a single-event prompt: its answer format does not ask for a reason.
+    """
+    return re.sub(r"\n<reason>[^\n]*</reason>", "", prompt)
+
+
+def format_prompt_single_token(prompt):
+    """
+    Single-token variant of a single-event prompt with a single "Yes" or "No" answer: the XML answer format is
+    replaced by asking for the answer as a single word, whose probability is read from the logprobs of the LLM.
+    """
+    return re.sub(
+        r" in the following format \(it must be valid XML\):\n<response>.*?</response>",
+        " with a single word, without any explanation.",
+        prompt,
+        flags=re.DOTALL,
+    )
+
+
+def get_answer_mode_prompt_format(format_event_prompt, answer_mode="reason"):
+    """
+    Returns the format_prompt* function of an answer mode: `format_event_prompt` itself in the "reason" mode,
+    its answer-only variant (see format_prompt_answer_only) in the "answer_only" mode and its single-token
+    variant (see format_prompt_single_token) in the "score" mode.
+    """
+    if answer_mode not in ANSWER_MODES:
+        raise ValueError(f"Invalid answer_mode {answer_mode}. Please select from {ANSWER_MODES}.")
+    if answer_mode == "answer_only":
+        return lambda *event_fields: format_prompt_answer_only(format_event_prompt(*event_fields))
+    if answer_mode == "score":
+        return lambda *event_fields: format_prompt_single_token(format_event_prompt(*event_fields))
+    return format_event_prompt
+
+
+def answer_stop_sequence(prompt):
+    """
+    Closing tag of the last answer tag of a single-event prompt, e.g. </answer>. Once it is generated the answer of
+    an answer-only prompt is complete, so it is used as the stop sequence of the answer-only calls.
+    """
+    answer_format = prompt[prompt.rindex("\n<response>"):]
+    answer_tags = re.findall(r"<(\w+)>Answer</\1>", answer_format)
+    return f"</{answer_tags[-1]}>"
@@ -1,6 +1,14 @@
+import os
 import pandas as pd
 import re
 
+try:
+    import tiktoken
+    _TOKEN_ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    # tiktoken is optional and needs to download its vocabulary once. Fall back to an approximation offline.
+    _TOKEN_ENCODING = None
+
 
 def extract_between_tags(tag: str, string: str, strip: bool = False) -> list[str]:
     string = string.replace("\_type", "_type")
@@ -12,6 +20,96 @@ def extract_between_tags(tag: str, string: str, strip: bool = False) -> list[str
     return ext_list
 
 
+def extract_answer_score(answer: str, tag: str = "answer") -> float:
+    """
+    Probability of "Yes" of an answer of the "score" answer mode, read from its <score> tag.
+    Answers without a score (providers without logprobs, audited answers) score 1.0 if their `tag`
+    answer, or their text, is "Yes" and 0.0 otherwise.
+    """
+    score = extract_between_tags("score", answer)
+    if score:
+        try:
+            return float(score[0])
+        except ValueError:
+            pass
+    parsed_answer = extract_between_tags(tag, answer)
+    text = parsed_answer[0] if parsed_answer else answer
+    return 1.0 if text.strip().lower().startswith("yes") else 0.0
+
+
+def count_tokens(text: str) -> int:
+    """
+    Count the number of tokens of a text. Uses tiktoken when it is available, otherwise
+    approximates the count from words and punctuation marks.
+    """
+    if not text:
+        return 0
+    if _TOKEN_ENCODING is not None:
+        return len(_TOKEN_ENCODING.encode(text, disallowed_special=()))
+    return int(len(re.findall(r"\w+|[^\w\s]", text)) * 1.3) + 1
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """
+    Cut a text to its first `max_tokens` tokens, counted as in count_tokens.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    if _TOKEN_ENCODING is not None:
+        return _TOKEN_ENCODING.decode(_TOKEN_ENCODING.encode(text, disallowed_special=())[:max_tokens])
+    # Inverse of the approximation of count_tokens
+    words = list(re.finditer(r"\w+|[^\w\s]", text))
+    keep = max(0, int((max_tokens - 1) / 1.3))
+    return text[:words[keep - 1].end()] if keep else ""
+
+
+def truncate_to_token_budget(text: str, max_tokens: int) -> str:
+    """
+    Keep the leading sentences of a text that fit in `max_tokens` tokens, e.g. the lead of a news article.
+    If the first sentence alone is over the budget it is cut at the budget.
+    """
+    if not text or count_tokens(text) <= max_tokens:
+        return text
+    # Sentences and the whitespace following them, paragraph breaks are kept
+    pieces = re.split(r"((?<=[.!?])\s+|\n+)", text)
+    kept = ""
+    kept_tokens = 0
+    for idx in range(0, len(pieces), 2):
+        sentence_tokens = count_tokens(pieces[idx])
+        if kept_tokens + sentence_tokens > max_tokens:
+            break
+        kept += pieces[idx] + (pieces[idx + 1] if idx + 1 < len(pieces) else "")
+        kept_tokens += sentence_tokens
+    kept = kept.rstrip()
+    if not kept:
+        return truncate_tokens(text, max_tokens).rstrip()
+    return kept
+
+
+def truncate_event_descriptions(records, max_tokens, stats=None):
+    """
+    Truncate the "Event Description" of events to `max_tokens` tokens with truncate_to_token_budget.
+    The tokens before and after truncation of each event are added to `stats` (see TruncationStats).
+    """
+    for i in records:
+        description = i["Event Description"]
+        # Missing descriptions (NaN of the empty scraped text or notes of the CSVs) are left untouched
+        if not isinstance(description, str):
+            continue
+        truncated = truncate_to_token_budget(description, max_tokens)
+        if stats is not None:
+            stats.record(count_tokens(description), count_tokens(truncated))
+        i["Event Description"] = truncated
+
+
+def count_prompt_tokens(prompt) -> int:
+    """
+    Count the number of tokens of a chat prompt, i.e. a list of {"role", "content"} messages.
+    """
+    # Each message carries a few extra tokens for the role and separators
+    return sum(count_tokens(message["content"]) + 4 for message in prompt)
+
+
 def load_data(input_path):
     df = pd.read_csv(input_path, header=0)
     df = df.fillna("")
@@ -59,3 +157,28 @@ def load_data(input_path):
     df_dev = df[df["train_dev_test_split"] == "dev"]
     df_test = df[df["train_dev_test_split"] == "test"]
     return df_train, df_dev, df_test
+
+
+def to_csv_atomic(df, path, **to_csv_kwargs):
+    """
+    Write `df` to the CSV file `path` through a temporary file renamed over it, so that an interrupted run never
+    leaves a truncated file and readers only see complete results.
+    """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    df.to_csv(tmp_path, **to_csv_kwargs)
+    os.replace(tmp_path, path)
+
+
+_LOADED_DATA = {}
+
+
+def load_data_cached(input_path):
+    """
+    load_data, read and parsed once per run for each path: the stages using the same training file share it.
+    The returned splits are shared, do not modify them in place.
+    """
+    if input_path not in _LOADED_DATA:
+        _LOADED_DATA[input_path] = load_data(input_path)
+    return _LOADED_DATA[input_path]
@@ -0,0 +1,28 @@
+import pytest
+
+from src.utils.fake_llm_server import serve_in_background
+from src.utils.llm_backbone import OpenAILLMCaller
+
+
+@pytest.fixture
+def fake_llm():
+    """
+    Fake OpenAI API (see fake_llm_server) and its state, e.g. the number of requests it answered.
+    """
+    server, state = serve_in_background(latency=0.01, latency_jitter=0.05)
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1", state
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def llm_caller(fake_llm):
+    base_url, _ = fake_llm
+    return OpenAILLMCaller("fake_key", "fake_model", base_url=base_url)
+
+
+def event_prompt(description):
+    """
+    Single-event chat prompt, answered "Yes" by the fake LLM if the description mentions violence.
+    """
+    return [{"role": "user", "content": f"Answer with <response><answer>Yes or No</answer></response>.\nNews Article: {description}"}]
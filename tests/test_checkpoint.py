@@ -0,0 +1,55 @@
+from src.utils.checkpoint import EventCheckpoint, PredictionCheckpoint, event_key
+
+EVENTS = [{"ACLED/GDELT": "ACLED", "Index": f"SUD{idx}"} for idx in range(3)]
+
+
+def write_checkpoint(path, answers):
+    checkpoint = PredictionCheckpoint(str(path))
+    for event, event_answers in zip(EVENTS, answers):
+        checkpoint.add("event_relevance", event_key(event), "fingerprint", event_answers)
+    checkpoint.close()
+
+
+def test_resume_after_a_partial_last_line(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    write_checkpoint(path, [["Yes"], ["No"]])
+    # The run was interrupted while writing the third event
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"stage": "event_relevance", "source": "ACLED", "index": "SUD2", "finger')
+
+    checkpoint = PredictionCheckpoint(str(path))
+    assert len(checkpoint) == 2
+    assert checkpoint.get("event_relevance", event_key(EVENTS[0]), "fingerprint") == ["Yes"]
+    assert checkpoint.get("event_relevance", event_key(EVENTS[2]), "fingerprint") is None
+    # Asked with other requests, the event is not resumed
+    assert checkpoint.get("event_relevance", event_key(EVENTS[1]), "other fingerprint") is None
+
+    # The next event is appended on its own line, and resumed by the next run
+    checkpoint.add("event_relevance", event_key(EVENTS[2]), "fingerprint", ["Yes"])
+    checkpoint.close()
+    resumed = PredictionCheckpoint(str(path))
+    assert len(resumed) == 3
+    assert resumed.get("event_relevance", event_key(EVENTS[2]), "fingerprint") == ["Yes"]
+    resumed.close()
+
+
+def test_resume_the_checkpoints_of_other_files(tmp_path):
+    # e.g. the checkpoints of the partitions of a Spark run with another number of partitions
+    write_checkpoint(tmp_path / "run_part0.jsonl", [["Yes"]])
+
+    checkpoint = PredictionCheckpoint(str(tmp_path / "run_part1.jsonl"), resume_paths=[str(tmp_path / "run_part0.jsonl"), str(tmp_path / "missing.jsonl")])
+    assert checkpoint.get("event_relevance", event_key(EVENTS[0]), "fingerprint") == ["Yes"]
+    checkpoint.close()
+
+
+def test_event_checkpoint_dispatches_the_pending_events_only(tmp_path):
+    checkpoint = PredictionCheckpoint(str(tmp_path / "checkpoint.jsonl"))
+    prompts = [[{"role": "user", "content": f"Event {idx}"}] for idx in range(3)]
+    first_run = EventCheckpoint(checkpoint, "event_relevance", EVENTS, prompts, 1, "fake_model", {})
+    first_run.on_answer(1, "No")
+
+    resumed_run = EventCheckpoint(checkpoint, "event_relevance", EVENTS, prompts, 1, "fake_model", {})
+    assert resumed_run.pending_prompts(prompts) == [prompts[0], prompts[2]]
+    assert resumed_run.merge_answers(["Yes", "Yes"]) == ["Yes", "No", "Yes"]
+    assert resumed_run.merge_sources(["llm", "cache"]) == ["llm", "checkpoint", "cache"]
+    checkpoint.close()
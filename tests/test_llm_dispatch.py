@@ -0,0 +1,31 @@
+from conftest import event_prompt
+
+from src.utils.llm_cache import CachedLLMCaller, LLMResponseCache
+from src.utils.llm_dispatch import dispatch_llm_calls
+
+
+def test_async_dispatch_keeps_the_order_of_the_prompts(fake_llm, llm_caller):
+    _, state = fake_llm
+    # The latencies of the fake LLM are jittered, the answers complete out of order
+    descriptions = [f"Event {idx}: " + ("people killed in clashes" if idx % 3 == 0 else "a market opened") for idx in range(24)]
+    received = {}
+
+    answers = dispatch_llm_calls(
+        llm_caller, [event_prompt(description) for description in descriptions], {}, execution_mode="async", max_concurrency=8,
+        on_answer=lambda idx, answer: received.setdefault(idx, answer),
+    )
+
+    assert [answer.startswith("<response>\n<answer>Yes") for answer in answers] == [idx % 3 == 0 for idx in range(24)]
+    assert received == dict(enumerate(answers))
+    assert state.request_count == 24
+
+
+def test_dispatch_reports_the_answers_of_the_response_cache(tmp_path, llm_caller):
+    cached_caller = CachedLLMCaller(llm_caller, LLMResponseCache(str(tmp_path / "llm_cache.sqlite")))
+    prompts = [event_prompt(f"Event {idx}: people killed") for idx in range(4)]
+    dispatch_llm_calls(cached_caller, prompts[:2], {})
+
+    answer_sources = []
+    dispatch_llm_calls(cached_caller, prompts, {}, execution_mode="async", answer_sources=answer_sources)
+
+    assert answer_sources == ["cache", "cache", "llm", "llm"]
@@ -0,0 +1,37 @@
+from conftest import event_prompt
+
+from src.utils.llm_packing import dispatch_packed_llm_calls, extract_packed_answers
+
+DESCRIPTIONS = ["people killed in clashes", "a market opened", "an attack on a village", "a school reopened", "fighting near the border"]
+
+
+def build_packed_prompts_without_last_id(event_indices):
+    """
+    Packed prompt asking for the answers of all the events of the pack but the last one, whose id is then missing from
+    the packed answer.
+    """
+    articles = "".join(f'<article id="{event_id}">{DESCRIPTIONS[idx]}</article>\n' for event_id, idx in enumerate(event_indices, 1))
+    answers = "".join(f'<answer id="{event_id}">Answer</answer>\n' for event_id in range(1, len(event_indices)))
+    return [[{"role": "user", "content": f"{articles}<response>\n{answers}</response>"}]]
+
+
+def test_extract_packed_answers():
+    answer = '<response>\n<answer id="1">Yes</answer>\n<answer id=\'2\'> No </answer>\n</response>'
+    assert extract_packed_answers("answer", answer) == {"1": "Yes", "2": "No"}
+
+
+def test_packed_answers_with_missing_ids_are_asked_again(fake_llm, llm_caller):
+    _, state = fake_llm
+    received = {}
+    answer_sources = []
+
+    answers = dispatch_packed_llm_calls(
+        llm_caller, [event_prompt(description) for description in DESCRIPTIONS], build_packed_prompts_without_last_id, [["answer"]], {},
+        pack_size=3, on_answer=lambda idx, answer: received.setdefault(idx, answer), answer_sources=answer_sources,
+    )
+
+    # Two packs (3 and 2 events), and the last event of each pack asked again with its single-event prompt
+    assert state.request_count == 2 + 2
+    assert answers == [f"<response>\n<answer>{answer}</answer>\n</response>" for answer in ["Yes", "No", "Yes", "No", "Yes"]]
+    assert received == dict(enumerate(answers))
+    assert answer_sources == ["llm"] * len(DESCRIPTIONS)
@@ -0,0 +1,44 @@
+from src.utils.prediction_ledger import PredictionLedger, event_content_hash, ledger_run_report
+
+EVENT = {"ACLED/GDELT": "ACLED", "Index": "SUD1", "Event Description": "Clashes in Khartoum", "Actor 1": "RSF", "Actor 2": "SAF", "Country": "Sudan"}
+PREDICTIONS = {"event_relevance_prediction": "Yes", "event_relevance_score": None, "event_type_prediction": ["Other"], "event_type_scores": None}
+SOURCES = {"event_relevance": ["llm"], "event_type": ["llm", "rule", "cache", "llm"]}
+
+
+def test_lookup(tmp_path):
+    ledger = PredictionLedger(str(tmp_path / "predictions.jsonl"))
+    assert ledger.lookup(EVENT, event_content_hash(EVENT), "fingerprint") == (None, "new")
+    ledger.add([EVENT], [PREDICTIONS], "fingerprint", "run_1", [SOURCES])
+
+    # The ledger is read back from disk by the next runs
+    ledger = PredictionLedger(str(tmp_path / "predictions.jsonl"))
+    entry, status = ledger.lookup(EVENT, event_content_hash(EVENT), "fingerprint")
+    assert status == "reused"
+    assert entry["predictions"] == PREDICTIONS
+    assert entry["sources"] == SOURCES
+    # Classified with other settings
+    assert ledger.lookup(EVENT, event_content_hash(EVENT), "other fingerprint") == (None, "stale")
+    # Revised after publication
+    revised_event = {**EVENT, "Event Description": "Clashes in Khartoum, 10 killed"}
+    assert ledger.lookup(revised_event, event_content_hash(revised_event), "fingerprint") == (None, "changed")
+
+
+def test_run_report_counts_the_llm_answers_of_the_reused_events(tmp_path):
+    ledger = PredictionLedger(str(tmp_path / "predictions.jsonl"))
+    ledger.add([EVENT], [PREDICTIONS], "fingerprint", "run_1", [SOURCES])
+    entry, _ = ledger.lookup(EVENT, event_content_hash(EVENT), "fingerprint")
+    # Entries of older ledgers have no sources
+    old_entry = {**entry, "sources": None}
+
+    report = ledger_run_report("run_2", 5, [entry, old_entry], 1, 1, 2)
+
+    assert {key: value for key, value in report.items() if key not in ["run", "time"]} == {
+        "events": 5,
+        "reused_events": 2,
+        "new_events": 1,
+        "changed_events": 1,
+        "stale_events": 2,
+        "reused_relevant_events": 2,
+        "skipped_relevance_llm_calls": 1,
+        "skipped_type_llm_calls": 2,
+    }